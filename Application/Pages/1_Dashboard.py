@@ -1,17 +1,24 @@
 import streamlit as st
 import pandas as pd
 import datetime as dt
-import plotly.express as px
-import plotly.graph_objects as go
 import sys, os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from db import get_connection
+from async_db import run_queries
+import analytics
+import kpi_history
+import profiler
+from lazy_imports import lazy_import
+
+# Plotly is only loaded when the gauge is drawn, so the header paints first on a cold worker.
+px = lazy_import("plotly.express")
+go = lazy_import("plotly.graph_objects")
 
 # ---------------------------
 # Page setup
 # ---------------------------
 st.set_page_config(page_title="Pharmacy Dashboard", layout="wide")
+profiler.start("1_Dashboard")
 
 # Subtle, professional UI tweaks
 st.markdown(
@@ -71,22 +78,41 @@ with right:
 st.divider()
 
 # ---------------------------
-# Database connection
-# ---------------------------
-conn = get_connection()
-
-# ---------------------------
-# Data loading (cached)
+# Data loading (cached, read-only -> replica when configured)
 # ---------------------------
 @st.cache_data(ttl=60)
 def load_dashboard_data():
-    total_patients = pd.read_sql("SELECT COUNT(*) AS n FROM PATIENT;", conn).iloc[0, 0]
-    low_stock = pd.read_sql("SELECT COUNT(*) AS n FROM INVENTORY_LOT WHERE Qty_on_hand < 100;", conn).iloc[0, 0]
-    pending_orders = pd.read_sql("SELECT COUNT(*) AS n FROM PURCHASE_ORDER WHERE Status = 'PENDING';", conn).iloc[0, 0]
-    expired_lots = pd.read_sql("SELECT COUNT(*) AS n FROM INVENTORY_LOT WHERE Expiry_date < CURRENT_DATE;", conn).iloc[0, 0]
-    expiring_90 = pd.read_sql("SELECT COUNT(*) AS n FROM INVENTORY_LOT WHERE Expiry_date BETWEEN CURRENT_DATE AND (CURRENT_DATE + INTERVAL '90 days');", conn).iloc[0, 0]
+    # The five KPI counts and the per-drug stock are independent, so they run concurrently (one connection each).
+    # Low stock is per drug: usable (unexpired) stock below that drug's reorder level (DRUG_STOCK_SUMMARY).
+    counts = run_queries({
+        "patients": ("SELECT COUNT(*) AS n FROM PATIENT;", None),
+        "low_stock": ("SELECT COUNT(*) AS n FROM DRUG_STOCK_SUMMARY WHERE Usable_on_hand < Reorder_level;", None),
+        "pending": ("SELECT COUNT(*) AS n FROM PURCHASE_ORDER WHERE Status = 'PENDING';", None),
+        "expired": ("SELECT COUNT(*) AS n FROM INVENTORY_LOT WHERE Expiry_date < CURRENT_DATE;", None),
+        "expiring_90": ("SELECT COUNT(*) AS n FROM INVENTORY_LOT WHERE Expiry_date BETWEEN CURRENT_DATE AND (CURRENT_DATE + INTERVAL '90 days');", None),
+        "stock": ("""
+            SELECT
+                d.Drug_Name AS drug_name,
+                s.Usable_on_hand AS usable_on_hand,
+                s.Total_on_hand AS total_on_hand,
+                s.Reorder_level AS reorder_level,
+                s.Usable_lot_count AS usable_lots,
+                s.Nearest_expiry AS nearest_expiry
+            FROM DRUG_STOCK_SUMMARY s
+            JOIN DRUG_CATALOGUE d ON s.Drug_id = d.Drug_id
+            ORDER BY s.Usable_on_hand - s.Reorder_level ASC;
+        """, None),
+        # Same query the KPI history job samples, so the gauge and the trend charts agree.
+        "current": (kpi_history.CURRENT_QUERY, None),
+    })
+    stock = counts.pop("stock")
+    health = int(counts.pop("current").iloc[0]["stock_health"])
+    total_patients, low_stock, pending_orders, expired_lots, expiring_90 = (
+        df.iloc[0, 0] for df in counts.values()
+    )
 
-    inventory = pd.read_sql(
+    # Chart data comes from the analytics mirror (DuckDB) when it is enabled.
+    inventory = analytics.query(
         """
         SELECT
             d.Drug_Name  AS drug_name,
@@ -95,23 +121,17 @@ def load_dashboard_data():
         FROM INVENTORY_LOT i
         JOIN DRUG_CATALOGUE d ON i.Drug_id = d.Drug_id
         ORDER BY i.Qty_on_hand ASC, i.Expiry_date ASC;
-        """,
-        conn
+        """
     )
     inventory["expiry_date"] = pd.to_datetime(inventory["expiry_date"])
 
-    return int(total_patients), int(low_stock), int(pending_orders), int(expired_lots), int(expiring_90), inventory
-
-total_patients, low_stock_count, pending_count, expired_lots, expiring_90, inventory = load_dashboard_data()
+    return int(total_patients), int(low_stock), int(pending_orders), int(expired_lots), int(expiring_90), inventory, stock, health
 
-# Calculate dynamic health score
-total_inventory_items = len(inventory)
-if total_inventory_items > 0:
-    # Deduct points for low stock and expired lots
-    issues = low_stock_count + expired_lots
-    system_health_score = max(0, 100 - int((issues / total_inventory_items) * 100))
-else:
-    system_health_score = 100
+profiler.mark("load data")
+with st.spinner("Loading dashboard data..."):
+    total_patients, low_stock_count, pending_count, expired_lots, expiring_90, inventory, stock, system_health_score = load_dashboard_data()
+low_drugs = set(stock.loc[stock["usable_on_hand"] < stock["reorder_level"], "drug_name"])
+profiler.mark("kpi cards")
 
 # ---------------------------
 # KPI Cards with Alert Coloring
@@ -132,7 +152,7 @@ def kpi_card(col, title, value, note, alert=False):
     )
 
 kpi_card(k1, "Registered Patients", total_patients, "Live count")
-kpi_card(k2, "Low Stock Items", low_stock_count, "Threshold: < 100", alert=True)
+kpi_card(k2, "Low Stock Drugs", low_stock_count, "Usable stock below reorder level", alert=True)
 kpi_card(k3, "Pending Orders", pending_count, "Status = PENDING")
 kpi_card(k4, "Expired Lots", expired_lots, "Requires action" if expired_lots > 0 else "No expired lots", alert=True)
 kpi_card(k5, "Expiring in 90 Days", expiring_90, "Monitor risk", alert=True)
@@ -144,6 +164,7 @@ st.divider()
 # System Health & Inventory Filters
 # ---------------------------
 # Added Material Icon to header
+profiler.mark("health gauge & filters")
 st.subheader(":material/health_and_safety: Inventory Health Overview")
 
 # Layout: Gauge chart on the left, filters on the right
@@ -175,14 +196,14 @@ with gauge_col:
 with filter_col:
     f1, f2 = st.columns([0.6, 0.4], vertical_alignment="bottom")
     search = f1.text_input("Search by drug name", placeholder="Type a drug name...")
-    only_low = f2.toggle("Show only low stock (<100)", value=False)
+    only_low = f2.toggle("Show only drugs low on stock", value=False)
 
 filtered = inventory.copy()
 
 if search:
     filtered = filtered[filtered["drug_name"].str.contains(search, case=False, na=False)]
 if only_low:
-    filtered = filtered[filtered["qty_on_hand"] < 100]
+    filtered = filtered[filtered["drug_name"].isin(low_drugs)]
 
 if filtered.empty:
     st.info("No rows match your current filters. Try clearing search or turning off low-stock filter.")
@@ -191,7 +212,7 @@ if filtered.empty:
 def highlight_critical(row):
     if row['expiry_date'] < pd.Timestamp.now():
         return ['background-color: #ffebee; color: #b71c1c; font-weight: bold'] * len(row)
-    elif row['qty_on_hand'] < 100:
+    elif row['drug_name'] in low_drugs:
         return ['background-color: #fff8e1; color: #f57f17; font-weight: bold'] * len(row)
     return [''] * len(row)
 
@@ -199,6 +220,7 @@ def highlight_critical(row):
 # Tabbed Layout + Tables + Plotly Chart
 # ---------------------------
 # Added Material Icons to Tabs
+profiler.mark("inventory tables & chart")
 tab1, tab2 = st.tabs([":material/list_alt: Full Inventory Directory", ":material/warning: Action Required"])
 
 with tab1:
@@ -220,45 +242,93 @@ with tab1:
 with tab2:
     col_table, col_chart = st.columns([0.4, 0.6], gap="large")
     
-    top10 = inventory.sort_values("qty_on_hand", ascending=True).head(10).copy()
-    styled_top10 = top10.style.apply(highlight_critical, axis=1)
-    
+    # Per drug, furthest below its reorder level first (already ordered that way by the query).
+    top10 = stock.head(10).copy()
+
     with col_table:
-        st.markdown("**Top 10 Lowest Stock**")
+        st.markdown("**Top 10 Drugs Closest to Reorder**")
         st.dataframe(
-            styled_top10,
+            top10,
             use_container_width=True,
             hide_index=True,
             column_config={
                 "drug_name": st.column_config.TextColumn("Drug"),
-                "qty_on_hand": st.column_config.NumberColumn("Qty on hand"),
-                "expiry_date": st.column_config.DateColumn("Expiry date", format="YYYY-MM-DD"),
+                "usable_on_hand": st.column_config.NumberColumn("Usable"),
+                "total_on_hand": st.column_config.NumberColumn("On hand (incl. expired)"),
+                "reorder_level": st.column_config.NumberColumn("Reorder level"),
+                "usable_lots": st.column_config.NumberColumn("Usable lots"),
+                "nearest_expiry": st.column_config.DateColumn("Nearest expiry", format="YYYY-MM-DD"),
             },
         )
         
     with col_chart:
-        st.markdown("**Lowest Stock Trend (Snapshot)**")
+        st.markdown("**Usable Stock vs Reorder Level**")
         fig_bar = px.bar(
             top10, 
             x="drug_name", 
-            y="qty_on_hand", 
-            color="qty_on_hand",
+            y="usable_on_hand", 
+            color="usable_on_hand",
             color_continuous_scale="Reds_r",
-            labels={"drug_name": "Drug Name", "qty_on_hand": "Quantity"}
+            labels={"drug_name": "Drug Name", "usable_on_hand": "Usable quantity"}
+        )
+        fig_bar.add_scatter(
+            x=top10["drug_name"], y=top10["reorder_level"], mode="markers", name="Reorder level",
+            marker=dict(symbol="line-ew-open", size=24, color="black"),
         )
         fig_bar.update_layout(
             margin=dict(l=0, r=0, t=10, b=0),
             xaxis_tickangle=-45,
-            coloraxis_showscale=False 
+            coloraxis_showscale=False,
+            showlegend=False,
         )
         st.plotly_chart(fig_bar, use_container_width=True)
 
 st.divider()
 
+# ---------------------------
+# KPI Trends (rollups written by kpi_history.py; no transaction history is scanned here)
+# ---------------------------
+profiler.mark("kpi trends")
+st.subheader(":material/monitoring: KPI Trends")
+
+
+@st.cache_data(ttl=300)
+def load_trend(metrics, grain):
+    return kpi_history.series(metrics, grain=grain)
+
+
+t1, t2 = st.columns([0.7, 0.3], vertical_alignment="bottom")
+trend_metrics = t1.multiselect(
+    "Metrics", list(kpi_history.METRICS), default=["stock_health", "dispenses_today"],
+    format_func=kpi_history.METRICS.get,
+)
+trend_grain = t2.radio("Resolution", ["hour", "day", "month"], index=1, horizontal=True)
+
+if trend_metrics:
+    try:
+        trend = load_trend(tuple(trend_metrics), trend_grain)
+    except Exception as e:
+        st.error(f"Could not load KPI history.\n\nError: {e}")
+        trend = pd.DataFrame()
+    if trend.empty:
+        st.info("No KPI history yet. Run `python kpi_history.py --every 300` to start sampling.")
+    else:
+        # "today" counters reset at midnight, so their last value per bucket is the meaningful one.
+        trend["value"] = trend["avg"].where(~trend["metric"].str.endswith("_today"), trend["last"])
+        trend["metric"] = trend["metric"].map(kpi_history.METRICS)
+        fig_trend = px.line(trend, x="bucket", y="value", color="metric", markers=True,
+                            labels={"bucket": "", "value": "", "metric": ""})
+        fig_trend.update_layout(margin=dict(l=0, r=0, t=10, b=0), legend=dict(orientation="h"))
+        st.plotly_chart(fig_trend, use_container_width=True)
+
+st.divider()
+
 # ---------------------------
 # Footer
 # ---------------------------
 st.write(
     "<span class='muted'>Dashboard is a monitoring layer only (no INSERT / UPDATE / DELETE).</span>",
     unsafe_allow_html=True,
-)
\ No newline at end of file
+)
+
+profiler.finish()
@@ -1,17 +1,27 @@
 import streamlit as st
 import pandas as pd
 import datetime as dt
-from db import get_connection
+import uuid
+from db import get_connection, get_read_connection, run_query
+import services
+import statements
+import drug_search
+import memory
+import archive
+import duty
+import patient_history
+import profiler
 
 # =====================================================================
 # Page setup
 # =====================================================================
 st.set_page_config(page_title="Dispense Medication", layout="wide")
+profiler.start("2_Dispense")
 st.title("Dispense Management")
 st.markdown("Dispense medication safely and manage reversals. Inventory safety checks are enforced by database triggers.")
 st.divider()
 
-tab1, tab2 = st.tabs(["Dispense Medication", "Reverse Dispense"])
+tab1, tab2, tab3 = st.tabs(["Dispense Medication", "Reverse Dispense", "Prescription Queue"])
 
 # =====================================================================
 # Session State (fixes Streamlit rerun issue + stale IDs like rx_id=4008)
@@ -19,19 +29,41 @@ tab1, tab2 = st.tabs(["Dispense Medication", "Reverse Dispense"])
 if "dispense_step" not in st.session_state:
     st.session_state.dispense_step = 1  # 1=form, 2=lot+confirm, 3=show results
 
-for k in ["last_receipt_df", "last_inv_before_df", "last_inv_after_df"]:
+# Result frames are stored through memory.store_frame() so each session stays within SESSION_BUDGET_MB.
+RESULT_FRAMES = ["last_receipt_df", "last_inv_before_df", "last_inv_after_df"]
+for k in RESULT_FRAMES:
     if k not in st.session_state:
         st.session_state[k] = None
 
+# Identifies this session's stock hold (services/reservations.py); expired holds are swept in the background.
+if "hold_id" not in st.session_state:
+    st.session_state.hold_id = uuid.uuid4().hex
+services.start_sweeper()
+services.start_audit_drainer()
+# Reversals are recorded in AUDIT_LOG under the pharmacist on duty; dispenses and fills under their own pharmacist.
+duty_actor = duty.select_pharmacist()
+
+
+def release_hold():
+    if st.session_state.get("held_lot"):
+        conn = get_connection()
+        try:
+            services.release(conn, st.session_state.hold_id)
+        finally:
+            conn.close()
+    st.session_state.held_lot = None
+
 
 def reset_dispense_flow():
     st.session_state.dispense_step = 1
+    release_hold()
+    memory.drop_frames(*RESULT_FRAMES, page="2_Dispense")
     for k in [
         "rx_id", "dispense_id", "line_item_id",
         "pharmacist_id", "patient_id", "doctor_id", "drug_id",
         "urgency", "qty_prescribed", "qty_dispensed",
         "dosage", "frequency", "refills_allowed",
-        "lot_batch_id", "unit_cost", "est_total", "est_commission"
+        "lot_batch_id", "unit_cost", "est_total", "est_commission", "edited_ids"
     ]:
         if k in st.session_state:
             del st.session_state[k]
@@ -39,10 +71,12 @@ def reset_dispense_flow():
 
 # =====================================================================
 # Helpers (safe connections: open/close every time)
+# Reads go to a replica when one is configured; next_id and every write
+# stay on the primary.
 # =====================================================================
 @st.cache_data(ttl=60)
 def load_dropdowns():
-    conn = get_connection()
+    conn = get_read_connection()
     try:
         with conn.cursor() as cur:
             cur.execute("SELECT pharmacist_id, name FROM pharmacist ORDER BY pharmacist_id;")
@@ -54,10 +88,7 @@ def load_dropdowns():
             cur.execute("SELECT doctor_id, name FROM doctor ORDER BY doctor_id;")
             doctors = [f"{r[0]} - {r[1]}" for r in cur.fetchall()]
 
-            cur.execute("SELECT drug_id, drug_name FROM drug_catalogue ORDER BY drug_id;")
-            drugs = [f"{r[0]} - {r[1]}" for r in cur.fetchall()]
-
-        return pharmacists, patients, doctors, drugs
+        return pharmacists, patients, doctors
     finally:
         conn.close()
 
@@ -66,43 +97,27 @@ def next_id(table_name: str, id_col: str) -> int:
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(f"SELECT COALESCE(MAX({id_col}), 0) + 1 FROM {table_name};")
-            return int(cur.fetchone()[0])
+            return services.next_id(cur, table_name, id_col)
     finally:
         conn.close()
 
 
+def mark_id_edited(name: str):
+    # Only IDs the user typed are passed to services.dispense(); the rest are assigned
+    # there, so a clash with another counter is retried with fresh IDs.
+    st.session_state.setdefault("edited_ids", set()).add(name)
+
+
 def lots_for_drug(drug_id: int) -> pd.DataFrame:
-    conn = get_connection()
-    try:
-        q = """
-            SELECT
-                lot_batch_id,
-                qty_on_hand,
-                unit_cost,
-                expiry_date
-            FROM inventory_lot
-            WHERE drug_id = %s
-            ORDER BY expiry_date ASC, qty_on_hand DESC;
-        """
-        df = pd.read_sql(q, conn, params=(drug_id,))
-        if not df.empty:
-            df["expiry_date"] = pd.to_datetime(df["expiry_date"]).dt.date
-        return df
-    finally:
-        conn.close()
+    # Prepared statement (statements.py): planned once per pooled connection.
+    df = statements.query("lots_for_drug", (drug_id,))
+    if not df.empty:
+        df["expiry_date"] = pd.to_datetime(df["expiry_date"]).dt.date
+    return df
 
 
-def inventory_snapshot(lot_batch_id: int) -> pd.DataFrame:
-    conn = get_connection()
-    try:
-        return pd.read_sql(
-            "SELECT lot_batch_id, qty_on_hand FROM inventory_lot WHERE lot_batch_id = %s;",
-            conn,
-            params=(lot_batch_id,),
-        )
-    finally:
-        conn.close()
+def inventory_snapshot(lot_batch_id: int, pin_primary: bool = False) -> pd.DataFrame:
+    return statements.query("inventory_snapshot", (lot_batch_id,), pin_primary=pin_primary)
 
 
 # =====================================================================
@@ -112,24 +127,45 @@ with tab1:
     st.subheader("Dispense Medication")
     st.caption("Creates a prescription + dispense record and dispenses one item from a selected lot. Inventory and expiry rules are enforced by DB triggers.")
 
-    pharmacists, patients, doctors, drugs = load_dropdowns()
+    profiler.mark("dispense: dropdowns")
+    with st.spinner("Loading pharmacists, patients and doctors..."):
+        pharmacists, patients, doctors = load_dropdowns()
 
-    # IDs (with keys so we can read from st.session_state reliably)
+    # IDs (with keys so we can read from st.session_state reliably).
+    # The defaults are only a preview of the next free IDs; unless edited, the final ones are assigned on save.
+    profiler.mark("dispense: next_id")
+    auto_help = "Leave unchanged to use the next free ID when the dispense is saved."
     c1, c2, c3 = st.columns(3)
     with c1:
         default_rx = next_id("prescription", "rx_id")
-        st.number_input("Prescription ID", min_value=1, value=default_rx, step=1, key="rx_id_input")
+        st.number_input("Prescription ID", min_value=1, value=default_rx, step=1, key="rx_id_input",
+                        help=auto_help, on_change=mark_id_edited, args=("rx_id",))
     with c2:
         default_dispense = next_id("dispense", "dispense_id")
-        st.number_input("Dispense ID", min_value=1, value=default_dispense, step=1, key="dispense_id_input")
+        st.number_input("Dispense ID", min_value=1, value=default_dispense, step=1, key="dispense_id_input",
+                        help=auto_help, on_change=mark_id_edited, args=("dispense_id",))
     with c3:
         default_line = next_id("dispensed_items", "line_item_id")
-        st.number_input("Dispensed Item Line ID", min_value=1, value=default_line, step=1, key="line_item_id_input")
+        st.number_input("Dispensed Item Line ID", min_value=1, value=default_line, step=1, key="line_item_id_input",
+                        help=auto_help, on_change=mark_id_edited, args=("line_item_id",))
 
+    profiler.mark(f"dispense: step {st.session_state.dispense_step}")
     # -------------------------
     # STEP 1: Fill form
     # -------------------------
     if st.session_state.dispense_step == 1:
+        # Outside the form so the drug list updates while typing (drug_search.py: ranked, cached).
+        drug_query = st.text_input(
+            "Find drug", placeholder="Brand or generic name, form, strength, e.g. amoxi 500", key="drug_query"
+        )
+        try:
+            drugs = drug_search.options(drug_query)
+        except Exception as e:
+            st.error(f"Drug search failed.\n\nError: {e}")
+            drugs = []
+        if drug_query and not drugs:
+            st.warning("No drug matches this search.")
+
         with st.form("dispense_form"):
             left, right = st.columns(2)
 
@@ -149,11 +185,13 @@ with tab1:
 
             submitted = st.form_submit_button("Dispense Now", type="primary")
 
-        if submitted:
-            # ✅ CRITICAL FIX: always overwrite IDs from current screen inputs
-            st.session_state.rx_id = int(st.session_state["rx_id_input"])
-            st.session_state.dispense_id = int(st.session_state["dispense_id_input"])
-            st.session_state.line_item_id = int(st.session_state["line_item_id_input"])
+        if submitted and drug_sel is None:
+            st.error("Find and select a drug first.")
+        elif submitted:
+            # ✅ CRITICAL FIX: always overwrite IDs from current screen inputs (None = assign on save)
+            edited_ids = st.session_state.get("edited_ids", set())
+            for id_key in ("rx_id", "dispense_id", "line_item_id"):
+                st.session_state[id_key] = int(st.session_state[f"{id_key}_input"]) if id_key in edited_ids else None
 
             st.session_state.pharmacist_id = int(pharmacist_sel.split(" - ")[0])
             st.session_state.patient_id = int(patient_sel.split(" - ")[0])
@@ -195,7 +233,7 @@ with tab1:
             st.stop()
 
         lot_options = [
-            f"{int(row['lot_batch_id'])} | on-hand: {int(row['qty_on_hand'])} | unit_cost: {float(row['unit_cost']):.2f} | exp: {row['expiry_date']}"
+            f"{int(row['lot_batch_id'])} | free: {int(row['qty_available'])} of {int(row['qty_on_hand'])} on hand | unit_cost: {float(row['unit_cost']):.2f} | exp: {row['expiry_date']}"
             for _, row in lots_df_valid.iterrows()
         ]
 
@@ -204,6 +242,21 @@ with tab1:
         lot_batch_id = int(selected_lot.split("|")[0].strip())
         st.session_state.lot_batch_id = lot_batch_id
 
+        # Hold the quantity on this lot while the pharmacist confirms, so another counter cannot take it meanwhile.
+        if st.session_state.get("held_lot") != (lot_batch_id, qty_dispensed):
+            conn = get_connection()
+            try:
+                held = services.hold(conn, lot_batch_id, qty_dispensed, st.session_state.hold_id)
+                st.session_state.held_lot = (lot_batch_id, qty_dispensed)
+                st.session_state.hold_expires = held.expires_at
+            except services.ServiceError as e:
+                st.session_state.held_lot = None
+                st.warning(f"{e} Pick another lot or go back and lower the quantity.")
+            finally:
+                conn.close()
+        if st.session_state.get("held_lot"):
+            st.caption(f"{qty_dispensed} held for you on this lot until {st.session_state.hold_expires:%H:%M:%S}.")
+
         chosen = lots_df_valid[lots_df_valid["lot_batch_id"] == lot_batch_id].iloc[0]
         unit_cost = float(chosen["unit_cost"])
         on_hand = int(chosen["qty_on_hand"])
@@ -221,7 +274,7 @@ with tab1:
         )
 
         # BEFORE snapshot
-        st.session_state.last_inv_before_df = inventory_snapshot(lot_batch_id)
+        memory.store_frame("last_inv_before_df", inventory_snapshot(lot_batch_id), page="2_Dispense")
         st.caption("Inventory BEFORE dispensing (snapshot):")
         st.dataframe(st.session_state.last_inv_before_df, use_container_width=True, hide_index=True)
 
@@ -238,87 +291,50 @@ with tab1:
         if confirm:
             conn = get_connection()
             try:
-                with conn.cursor() as cur:
-                    cur.execute("BEGIN;")
-
-                    cur.execute(
-                        """
-                        INSERT INTO prescription (rx_id, rx_date, status, urgency, patient_id, doctor_id, pharmacist_id)
-                        VALUES (%s, CURRENT_DATE, 'Dispensed', %s, %s, %s, %s);
-                        """,
-                        (st.session_state.rx_id, st.session_state.urgency, st.session_state.patient_id,
-                         st.session_state.doctor_id, st.session_state.pharmacist_id),
-                    )
-
-                    cur.execute(
-                        """
-                        INSERT INTO prescription_items (rx_id, drug_id, qty_prescribed, dosage_instruc, frequency, refills_allowed)
-                        VALUES (%s, %s, %s, %s, %s, %s);
-                        """,
-                        (st.session_state.rx_id, st.session_state.drug_id, st.session_state.qty_prescribed,
-                         st.session_state.dosage, st.session_state.frequency, st.session_state.refills_allowed),
-                    )
-
-                    cur.execute(
-                        """
-                        INSERT INTO dispense (dispense_id, dispense_date, total_amount, commission, pharmacist_id, rx_id)
-                        VALUES (%s, CURRENT_DATE, %s, %s, %s, %s);
-                        """,
-                        (st.session_state.dispense_id, st.session_state.est_total, st.session_state.est_commission,
-                         st.session_state.pharmacist_id, st.session_state.rx_id),
-                    )
-
-                    # triggers fire here
-                    cur.execute(
-                        """
-                        INSERT INTO dispensed_items (line_item_id, qty_dispensed, dispense_id, lot_batch_id)
-                        VALUES (%s, %s, %s, %s);
-                        """,
-                        (st.session_state.line_item_id, st.session_state.qty_dispensed,
-                         st.session_state.dispense_id, st.session_state.lot_batch_id),
-                    )
-
-                    conn.commit()
+                with services.acting_as(f"pharmacist {st.session_state.pharmacist_id}"):
+                    result = services.dispense(conn, services.DispenseRequest(
+                        rx_id=st.session_state.rx_id,
+                        dispense_id=st.session_state.dispense_id,
+                        line_item_id=st.session_state.line_item_id,
+                        pharmacist_id=st.session_state.pharmacist_id,
+                        patient_id=st.session_state.patient_id,
+                        doctor_id=st.session_state.doctor_id,
+                        drug_id=st.session_state.drug_id,
+                        lot_batch_id=st.session_state.lot_batch_id,
+                        qty_prescribed=st.session_state.qty_prescribed,
+                        qty_dispensed=st.session_state.qty_dispensed,
+                        urgency=st.session_state.urgency,
+                        dosage=st.session_state.dosage,
+                        frequency=st.session_state.frequency,
+                        refills_allowed=st.session_state.refills_allowed,
+                        holder=st.session_state.hold_id,
+                    ))
+                st.session_state.held_lot = None  # consumed by the dispense
+                patient_history.invalidate(st.session_state.patient_id)
 
                 st.success("Dispense saved successfully. ✅ Triggers executed on dispensed_items insert.")
 
-                receipt_q = """
-                    SELECT
-                        di.line_item_id      AS "Line",
-                        dp.dispense_id       AS "Dispense ID",
-                        dp.dispense_date     AS "Date",
-                        p.name               AS "Patient",
-                        ph.name              AS "Pharmacist",
-                        dc.drug_name         AS "Drug",
-                        di.qty_dispensed     AS "Qty dispensed",
-                        il.unit_cost         AS "Unit cost",
-                        dp.total_amount      AS "Total amount",
-                        dp.commission        AS "Commission",
-                        il.lot_batch_id      AS "Lot batch",
-                        il.expiry_date       AS "Expiry"
-                    FROM dispensed_items di
-                    JOIN dispense dp        ON di.dispense_id = dp.dispense_id
-                    JOIN prescription rx    ON dp.rx_id = rx.rx_id
-                    JOIN patient p          ON rx.patient_id = p.patient_id
-                    JOIN pharmacist ph      ON dp.pharmacist_id = ph.pharmacist_id
-                    JOIN inventory_lot il   ON di.lot_batch_id = il.lot_batch_id
-                    JOIN drug_catalogue dc  ON il.drug_id = dc.drug_id
-                    WHERE dp.dispense_id = %s
-                    ORDER BY di.line_item_id;
-                """
-                conn2 = get_connection()
-                try:
-                    st.session_state.last_receipt_df = pd.read_sql(receipt_q, conn2, params=(st.session_state.dispense_id,))
-                finally:
-                    conn2.close()
-
-                st.session_state.last_inv_after_df = inventory_snapshot(st.session_state.lot_batch_id)
+                # Read-your-own-write: the receipt and AFTER snapshot must come from the primary.
+                memory.store_frame(
+                    "last_receipt_df",
+                    statements.query("dispense_receipt", (result.dispense_id,), pin_primary=True),
+                    page="2_Dispense",
+                )
+
+                memory.store_frame(
+                    "last_inv_after_df",
+                    inventory_snapshot(st.session_state.lot_batch_id, pin_primary=True),
+                    page="2_Dispense",
+                )
 
                 st.session_state.dispense_step = 3
                 st.rerun()
 
+            except services.ServiceError as e:
+                # e.g. another counter took the remaining stock meanwhile: stay here so a different lot can be picked
+                st.error(f"Dispense failed and was rolled back.\n\nError: {e}")
             except Exception as e:
-                conn.rollback()
+                # services.dispense() has already rolled the transaction back
                 st.error(f"Dispense failed and was rolled back.\n\nError: {e}")
 
                 # ✅ reset so stale ids won't stick around
@@ -331,7 +347,10 @@ with tab1:
     # -------------------------
     if st.session_state.dispense_step == 3:
         st.markdown("### Dispense Receipt (Database Proof)")
-        st.dataframe(st.session_state.last_receipt_df, use_container_width=True, hide_index=True)
+        if st.session_state.last_receipt_df is None:
+            st.warning("This result was released to stay within the session memory budget. The dispense itself is saved and listed on the Reverse Dispense tab.")
+        else:
+            st.dataframe(st.session_state.last_receipt_df, use_container_width=True, hide_index=True)
 
         st.markdown("### Inventory Proof (Trigger effect)")
         col1, col2 = st.columns(2)
@@ -353,22 +372,18 @@ with tab1:
 # TAB 2: REVERSE DISPENSE (Tx2) - includes optional PAYS delete
 # =====================================================================
 with tab2:
+    profiler.mark("reverse tab")
     st.subheader("Reverse a Dispense")
     st.caption("Safely reverses a dispense by restoring inventory first, then deleting child → parent records.")
 
-    conn = get_connection()
-    try:
-        dispenses_df = pd.read_sql(
-            """
-            SELECT dispense_id, dispense_date, total_amount, rx_id
-            FROM dispense
-            ORDER BY dispense_id DESC
-            LIMIT 50;
-            """,
-            conn,
-        )
-    finally:
-        conn.close()
+    dispenses_df = run_query(
+        """
+        SELECT dispense_id, dispense_date, total_amount, rx_id
+        FROM dispense
+        ORDER BY dispense_id DESC
+        LIMIT 50;
+        """
+    )
 
     if dispenses_df.empty:
         st.info("No dispense records found yet.")
@@ -391,11 +406,7 @@ with tab2:
             WHERE di.dispense_id = %s
             ORDER BY di.line_item_id;
         """
-        connp = get_connection()
-        try:
-            preview_df = pd.read_sql(preview_q, connp, params=(selected_dispense_id,))
-        finally:
-            connp.close()
+        preview_df = run_query(preview_q, params=(selected_dispense_id,))
 
         st.markdown("### Items in this dispense")
         st.dataframe(preview_df, use_container_width=True, hide_index=True)
@@ -403,61 +414,195 @@ with tab2:
         if st.button("Reverse this dispense", type="primary", use_container_width=True, key="reverse_btn"):
             conn2 = get_connection()
             try:
-                with conn2.cursor() as cur:
-                    cur.execute("BEGIN;")
-
-                    cur.execute("SELECT rx_id FROM dispense WHERE dispense_id = %s;", (selected_dispense_id,))
-                    row = cur.fetchone()
-                    if not row:
-                        raise Exception("Selected dispense no longer exists.")
-                    rx_id_to_delete = int(row[0])
-
-                    # restore inventory
-                    cur.execute("SELECT lot_batch_id, qty_dispensed FROM dispensed_items WHERE dispense_id = %s;", (selected_dispense_id,))
-                    rows = cur.fetchall()
-                    for lot_id, qty in rows:
-                        cur.execute(
-                            "UPDATE inventory_lot SET qty_on_hand = qty_on_hand + %s WHERE lot_batch_id = %s;",
-                            (qty, lot_id),
-                        )
-
-                    # delete child -> parent (include pays just in case)
-                    cur.execute("DELETE FROM pays WHERE dispense_id = %s;", (selected_dispense_id,))
-                    cur.execute("DELETE FROM dispensed_items WHERE dispense_id = %s;", (selected_dispense_id,))
-                    cur.execute("DELETE FROM dispense WHERE dispense_id = %s;", (selected_dispense_id,))
-                    cur.execute("DELETE FROM prescription_items WHERE rx_id = %s;", (rx_id_to_delete,))
-                    cur.execute("DELETE FROM prescription WHERE rx_id = %s;", (rx_id_to_delete,))
-
-                    conn2.commit()
+                with services.acting_as(duty_actor):
+                    services.reverse_dispense(conn2, selected_dispense_id)
+                patient_history.invalidate()
 
                 st.success("Dispense reversed successfully. Inventory restored and records removed.")
 
                 # verify dispense gone
-                connv = get_connection()
-                try:
-                    verify_disp = pd.read_sql("SELECT * FROM dispense WHERE dispense_id = %s;", connv, params=(selected_dispense_id,))
-                finally:
-                    connv.close()
+                verify_disp = run_query(
+                    "SELECT * FROM dispense WHERE dispense_id = %s;", params=(selected_dispense_id,), pin_primary=True
+                )
 
                 st.caption("Verification: dispense should be gone (empty table below):")
                 st.dataframe(verify_disp, use_container_width=True, hide_index=True)
 
                 if not preview_df.empty:
                     lot_ids = preview_df["lot_batch_id"].tolist()
-                    connx = get_connection()
-                    try:
-                        inv_after = pd.read_sql(
-                            "SELECT lot_batch_id, qty_on_hand FROM inventory_lot WHERE lot_batch_id = ANY(%s) ORDER BY lot_batch_id;",
-                            connx,
-                            params=(lot_ids,),
-                        )
-                    finally:
-                        connx.close()
+                    inv_after = run_query(
+                        "SELECT lot_batch_id, qty_on_hand FROM inventory_lot WHERE lot_batch_id = ANY(%s) ORDER BY lot_batch_id;",
+                        params=(lot_ids,),
+                        pin_primary=True,
+                    )
                     st.caption("Inventory after reversal:")
                     st.dataframe(inv_after, use_container_width=True, hide_index=True)
 
             except Exception as e:
-                conn2.rollback()
                 st.error(f"Reversal failed and was rolled back.\n\nError: {e}")
             finally:
-                conn2.close()
\ No newline at end of file
+                conn2.close()
+
+    # -------------------------
+    # Archived dispenses (read-only, see archive.py)
+    # -------------------------
+    with st.expander("Look up an archived dispense"):
+        archived_id = st.number_input("Dispense ID", min_value=1, step=1, key="archived_dispense_id")
+        archived = archive.archived_dispense(int(archived_id))
+        if archived["dispense"].empty:
+            st.caption(f"Dispense {int(archived_id)} is not in the archive.")
+        else:
+            st.caption("Archived dispenses cannot be reversed.")
+            st.dataframe(archived["dispense"].drop(columns=["month"], errors="ignore"), use_container_width=True, hide_index=True)
+            st.dataframe(archived["dispensed_items"], use_container_width=True, hide_index=True)
+
+    # -------------------------
+    # Bulk reversal (recalled lot, bad shift, hand-picked list)
+    # -------------------------
+    st.divider()
+    st.markdown("### Reverse many dispenses at once")
+    st.caption("All selected dispenses are reversed in one transaction: stock is restored per lot in a single UPDATE, then the records are deleted in bulk.")
+
+    bulk_mode = st.radio(
+        "Select dispenses by", ["Hand-picked", "Inventory lot", "Pharmacist shift"], horizontal=True, key="bulk_mode"
+    )
+    if bulk_mode == "Hand-picked":
+        picked = st.multiselect(
+            "Dispenses", dispenses_df["label"].tolist() if not dispenses_df.empty else [], key="bulk_pick"
+        )
+        bulk_q = "SELECT dispense_id, total_amount FROM dispense WHERE dispense_id = ANY(%s) ORDER BY dispense_id;"
+        bulk_params = ([int(p.split("|")[0].strip()) for p in picked],)
+    elif bulk_mode == "Inventory lot":
+        bulk_lot = st.number_input("Lot batch ID", min_value=1, step=1, key="bulk_lot")
+        bulk_q = """
+            SELECT DISTINCT dp.dispense_id, dp.total_amount
+            FROM dispense dp JOIN dispensed_items di ON di.dispense_id = dp.dispense_id
+            WHERE di.lot_batch_id = %s
+            ORDER BY dp.dispense_id;
+        """
+        bulk_params = (int(bulk_lot),)
+    else:
+        s1, s2 = st.columns(2)
+        with s1:
+            bulk_pharmacist = st.selectbox("Pharmacist", pharmacists, key="bulk_pharmacist")
+        with s2:
+            bulk_date = st.date_input("Shift date", value=dt.date.today(), key="bulk_date")
+        bulk_q = """
+            SELECT dispense_id, total_amount FROM dispense
+            WHERE pharmacist_id = %s AND dispense_date = %s
+            ORDER BY dispense_id;
+        """
+        bulk_params = (int(bulk_pharmacist.split(" - ")[0]), bulk_date)
+
+    bulk_df = run_query(bulk_q, params=bulk_params, pin_primary=True)
+    st.caption(f"{len(bulk_df)} dispenses selected, €{float(bulk_df['total_amount'].sum()) if not bulk_df.empty else 0:.2f} in total.")
+
+    if st.button("Reverse all selected", disabled=bulk_df.empty, use_container_width=True, key="bulk_reverse_btn"):
+        conn3 = get_connection()
+        try:
+            with services.acting_as(duty_actor):
+                summary = services.reverse_dispenses(conn3, bulk_df["dispense_id"].astype(int).tolist())
+            patient_history.invalidate()
+            st.success(
+                f"Reversed {len(summary.dispense_ids)} dispenses (€{summary.amount_reversed:.2f}): "
+                f"{summary.items_deleted} items, {summary.payments_deleted} insurance payments and "
+                f"{summary.prescriptions_deleted} prescriptions removed; {summary.refills_restored} refills given back."
+            )
+            if summary.not_found:
+                st.info(f"Already gone (skipped): {', '.join(map(str, summary.not_found))}")
+            st.caption("Stock restored per lot:")
+            st.dataframe(
+                pd.DataFrame(summary.restored, columns=["lot_batch_id", "qty_restored"]),
+                use_container_width=True, hide_index=True,
+            )
+        except Exception as e:
+            st.error(f"Bulk reversal failed and was rolled back.\n\nError: {e}")
+        finally:
+            conn3.close()
+
+
+# =====================================================================
+# TAB 3: PENDING PRESCRIPTION QUEUE (services/rx_queue.py)
+# Each session claims one pending prescription at a time; the claim is
+# kept alive by a heartbeat on every rerun and lapses when the tab is left.
+# =====================================================================
+def call_service(fn, *args, **kwargs):
+    conn = get_connection()
+    try:
+        return fn(conn, *args, **kwargs)
+    finally:
+        conn.close()
+
+
+with tab3:
+    profiler.mark("queue tab")
+    st.subheader("Pending Prescription Queue")
+    st.caption(
+        "Claim the next pending prescription (most urgent, then oldest). Other workstations skip prescriptions "
+        "that are claimed, and a claim that is not kept alive returns to the queue automatically."
+    )
+
+    depth = call_service(services.queue_depth)
+    q1, q2 = st.columns(2)
+    q1.metric("Pending prescriptions", depth["pending"])
+    q2.metric("Being worked on", depth["claimed"])
+
+    claimed = st.session_state.get("queue_item")
+    if claimed is not None and not call_service(services.heartbeat, claimed.rx_id, st.session_state.hold_id):
+        st.warning(f"Your claim on prescription {claimed.rx_id} expired and it went back to the queue.")
+        st.session_state.queue_item = claimed = None
+
+    if claimed is None:
+        if st.button("Claim next prescription", type="primary", use_container_width=True):
+            try:
+                st.session_state.queue_item = call_service(services.claim_next, st.session_state.hold_id)
+                if st.session_state.queue_item is None:
+                    st.info("The queue is empty: every pending prescription is filled or claimed.")
+                else:
+                    st.rerun()
+            except Exception as e:
+                st.error(f"Could not claim a prescription.\n\nError: {e}")
+    else:
+        st.markdown(
+            f"### Prescription {claimed.rx_id} — {claimed.urgency} urgency, written {claimed.rx_date}"
+        )
+        st.caption(f"Patient {claimed.patient_id}, doctor {claimed.doctor_id}. Claimed at {claimed.claimed_at:%H:%M:%S}.")
+        st.dataframe(
+            pd.DataFrame(claimed.items, columns=["drug_id", "qty_prescribed", "dosage", "frequency"]),
+            use_container_width=True, hide_index=True,
+        )
+        queue_pharmacist = st.selectbox("Pharmacist", pharmacists, key="queue_pharmacist_sel")
+        st.caption("Each item is taken from the unexpired lot that expires first and has enough free stock.")
+
+        fill_col, release_col = st.columns([0.7, 0.3])
+        with fill_col:
+            fill = st.button("Fill prescription", type="primary", use_container_width=True)
+        with release_col:
+            give_back = st.button("Return to queue", use_container_width=True)
+
+        if give_back:
+            call_service(services.release_claim, claimed.rx_id, st.session_state.hold_id)
+            st.session_state.queue_item = None
+            st.rerun()
+
+        if fill:
+            try:
+                queue_pharmacist_id = int(queue_pharmacist.split(" - ")[0])
+                with services.acting_as(f"pharmacist {queue_pharmacist_id}"):
+                    filled = call_service(
+                        services.fill_claimed, claimed.rx_id, st.session_state.hold_id, queue_pharmacist_id,
+                    )
+                patient_history.invalidate(claimed.patient_id)
+                st.session_state.queue_item = None
+                st.success(
+                    f"Prescription {filled.rx_id} dispensed as dispense {filled.dispense_id}: "
+                    f"€{filled.total_amount:.2f} (commission €{filled.commission:.2f})."
+                )
+                st.dataframe(
+                    pd.DataFrame(filled.lines, columns=["line_item_id", "drug_id", "lot_batch_id", "qty_dispensed"]),
+                    use_container_width=True, hide_index=True,
+                )
+            except Exception as e:
+                st.error(f"Filling failed and was rolled back; the prescription stays claimed.\n\nError: {e}")
+
+profiler.finish()
\ No newline at end of file
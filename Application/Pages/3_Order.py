@@ -1,6 +1,13 @@
 import streamlit as st
 import pandas as pd
-from db import get_connection
+from decimal import Decimal
+from db import get_connection, get_read_connection, run_query
+from archive import read_history
+import services
+import statements
+import drug_search
+import duty
+import profiler
 
 # =====================================================================
 # UI INITIALIZATION
@@ -9,6 +16,9 @@ from db import get_connection
 # All unnecessary styling has been removed for a professional look.
 # =====================================================================
 st.set_page_config(page_title="Order Stock", layout="wide")
+profiler.start("3_Order")
+# Order changes are recorded in AUDIT_LOG under the pharmacist on duty (duty.py).
+duty_actor = duty.select_pharmacist()
 st.title("Purchase Order Management")
 st.markdown("Execute **Transaction 3**: Safely create a multi-item purchase order, and monitor existing orders.")
 st.divider()
@@ -19,12 +29,13 @@ st.divider()
 # This allows us to separate our Data Entry (INSERT) logic from our 
 # Data Retrieval (SELECT) logic within the same module.
 # =====================================================================
-tab1, tab2, tab3, tab4 = st.tabs(["Create New Order", "Order History & Status", "Revise Order", "Cancel Order"])
+tab1, tab2, tab3, tab4, tab5 = st.tabs(["Create New Order", "Order History & Status", "Revise Order", "Cancel Order", "Reorder Levels"])
 
 # ---------------------------------------------------------------------
 # TAB 1: CREATE NEW ORDER (Data Entry)
 # ---------------------------------------------------------------------
 with tab1:
+    profiler.mark("create order tab")
     # =====================================================================
     # DATA FETCHING FOR DROPDOWNS
     # Professor, instead of making users guess raw Primary/Foreign Keys, 
@@ -34,25 +45,44 @@ with tab1:
     # =====================================================================
     @st.cache_data(ttl=60)
     def load_dropdown_options():
-        """Fetches live suppliers and drugs from the DB to populate our menus."""
-        conn = get_connection()
+        """Fetches live suppliers from the DB to populate our menu."""
+        conn = get_read_connection()
         try:
             with conn.cursor() as cur:
-                # 1. Get Suppliers and format as "1001 - MediSupply"
+                # Get Suppliers and format as "1001 - MediSupply"
                 cur.execute("SELECT Supplier_ID, Company_name FROM SUPPLIER ORDER BY Supplier_ID;")
                 supplier_opts = [f"{row[0]} - {row[1]}" for row in cur.fetchall()]
-                
-                # 2. Get Drugs and format as "2001 - Amoxicillin"
-                cur.execute("SELECT Drug_id, Drug_Name FROM DRUG_CATALOGUE ORDER BY Drug_id;")
-                drug_opts = [f"{row[0]} - {row[1]}" for row in cur.fetchall()]
-                
-            return supplier_opts, drug_opts
+            return supplier_opts
         except Exception as e:
             st.error(f"Failed to load dropdown data: {e}")
-            return [], []
+            return []
+        finally:
+            conn.close()
+
+    def find_drugs(query):
+        """Ranked drug search (drug_search.py). Labels look like "2001 - Amoxicillin (Amoxicillin, Capsule 500mg)"."""
+        try:
+            return drug_search.options(query)
+        except Exception as e:
+            st.error(f"Drug search failed: {e}")
+            return []
 
     # We execute the query and store the options BEFORE drawing the form
-    supplier_options, drug_options = load_dropdown_options()
+    supplier_options = load_dropdown_options()
+
+    # =====================================================================
+    # DRUG SEARCH
+    # Professor, a national catalogue has tens of thousands of drugs, far too
+    # many for one dropdown. Each item row gets its own search box (outside
+    # the form, so the list updates while typing); the dropdown then only
+    # shows the best matches by brand name, generic name, form or strength.
+    # =====================================================================
+    st.caption("Search by brand or generic name, form or strength (e.g. \"amoxi 500\"); leave empty to browse A-Z.")
+    search_cols = st.columns(3)
+    drug_queries = [
+        search_cols[i].text_input(f"Find Drug {i + 1}", key=f"order_drug_query_{i + 1}") for i in range(3)
+    ]
+    drug_choices = [find_drugs(q) for q in drug_queries]
 
     # =====================================================================
     # BATCHING USER INPUT (THE FORM)
@@ -78,29 +108,30 @@ with tab1:
         st.subheader("2. Order Items (Child Records)")
         st.caption("Set quantity to 0 to skip an item.")
         
-        # Safe indices to ensure we don't crash if the database has fewer than 3 drugs
+        # While browsing (no search), rows 2 and 3 default to the 2nd and 3rd drug;
+        # safe indices ensure we don't crash if the list is shorter than that.
         safe_index_1 = 0
-        safe_index_2 = 1 if len(drug_options) > 1 else 0
-        safe_index_3 = 2 if len(drug_options) > 2 else 0
+        safe_index_2 = 1 if not drug_queries[1] and len(drug_choices[1]) > 1 else 0
+        safe_index_3 = 2 if not drug_queries[2] and len(drug_choices[2]) > 2 else 0
 
         # Item 1 Row (Mandatory, minimum quantity is 1)
         col_d1, col_q1 = st.columns([2, 1])
         with col_d1:
-            drug1_selection = st.selectbox("Select Drug 1", drug_options, index=safe_index_1) 
+            drug1_selection = st.selectbox("Select Drug 1", drug_choices[0], index=safe_index_1) 
         with col_q1:
             drug1_qty = st.number_input("Drug 1 Quantity", min_value=1, value=100)
 
         # Item 2 Row (Optional, minimum quantity is 0)
         col_d2, col_q2 = st.columns([2, 1])
         with col_d2:
-            drug2_selection = st.selectbox("Select Drug 2", drug_options, index=safe_index_2)
+            drug2_selection = st.selectbox("Select Drug 2", drug_choices[1], index=safe_index_2)
         with col_q2:
             drug2_qty = st.number_input("Drug 2 Quantity", min_value=0, value=250)
 
         # Item 3 Row (Optional, minimum quantity is 0)
         col_d3, col_q3 = st.columns([2, 1])
         with col_d3:
-            drug3_selection = st.selectbox("Select Drug 3", drug_options, index=safe_index_3)
+            drug3_selection = st.selectbox("Select Drug 3", drug_choices[2], index=safe_index_3)
         with col_q3:
             drug3_qty = st.number_input("Drug 3 Quantity", min_value=0, value=0)
 
@@ -114,59 +145,45 @@ with tab1:
     # Professor, we process this OUTSIDE the 'with st.form' block so the 
     # generated receipt prints below the form area, rather than inside it.
     # =====================================================================
-    if submitted:
+    rows_without_drug = [
+        n for n, (selection, qty) in enumerate(
+            [(drug1_selection, drug1_qty), (drug2_selection, drug2_qty), (drug3_selection, drug3_qty)], start=1
+        ) if selection is None and qty > 0
+    ]
+    if submitted and rows_without_drug:
+        st.error(f"No drug selected for item {', '.join(map(str, rows_without_drug))}. Search for a drug or set the quantity to 0.")
+    elif submitted:
         
         # DATA EXTRACTION: 
         # The UI shows "1001 - MediSupply", but the database Foreign Key requires "1001".
         # We use .split(" - ") to divide the string and extract just the integer ID.
+        # Rows without a drug have quantity 0 (checked above) and are left out.
         final_supplier_id = int(supplier_selection.split(" - ")[0])
-        final_drug1_id = int(drug1_selection.split(" - ")[0])
-        final_drug2_id = int(drug2_selection.split(" - ")[0])
-        final_drug3_id = int(drug3_selection.split(" - ")[0])
+        order_items = [
+            services.OrderItem(int(selection.split(" - ")[0]), qty, unit_cost)
+            for selection, qty, unit_cost in [
+                (drug1_selection, drug1_qty, Decimal("1.90")),
+                (drug2_selection, drug2_qty, Decimal("0.80")),
+                (drug3_selection, drug3_qty, Decimal("2.50")),
+            ]
+            if selection is not None
+        ]
         
         conn = get_connection()
         try:
-            cur = conn.cursor()
-            
             # =================================================================
             # ATOMIC TRANSACTION BLOCK (ACID)
             # Professor, this demonstrates Atomicity. We must insert 1 Parent 
             # record and up to 3 Child records. They must ALL succeed, or ALL fail.
+            # services.create_order() runs the whole block in one transaction
+            # and skips any item whose quantity is 0.
             # =================================================================
-            cur.execute("BEGIN;")
-            
-            # 1. INSERT PARENT RECORD
-            # We let PostgreSQL handle the date math natively (CURRENT_DATE + 5)
-            # to satisfy the check constraint: Expected_delivery_date >= Order_date.
-            cur.execute("""
-                INSERT INTO PURCHASE_ORDER (Order_id, Order_date, Expected_delivery_date, Status, Supplier_ID)
-                VALUES (%s, CURRENT_DATE, CURRENT_DATE + 5, 'PENDING', %s);
-            """, (order_id, final_supplier_id))
-            
-            # 2. CONDITIONALLY INSERT CHILD RECORDS
-            # We only execute the INSERT if the user requested a quantity > 0.
-            # This handles the 1-to-Many relationship dynamically.
-            if drug1_qty > 0:
-                cur.execute("""
-                    INSERT INTO PURCHASE_ORDER_ITEM (Product_id, Drug_id, Qty_ordered, Unit_cost)
-                    VALUES (%s, %s, %s, 1.90);
-                """, (order_id, final_drug1_id, drug1_qty))
-                
-            if drug2_qty > 0:
-                cur.execute("""
-                    INSERT INTO PURCHASE_ORDER_ITEM (Product_id, Drug_id, Qty_ordered, Unit_cost)
-                    VALUES (%s, %s, %s, 0.80);
-                """, (order_id, final_drug2_id, drug2_qty))
-                
-            if drug3_qty > 0:
-                cur.execute("""
-                    INSERT INTO PURCHASE_ORDER_ITEM (Product_id, Drug_id, Qty_ordered, Unit_cost)
-                    VALUES (%s, %s, %s, 2.50); 
-                """, (order_id, final_drug3_id, drug3_qty))
-            
-            # 3. COMMIT THE TRANSACTION
-            # If no errors occurred, permanently save all records to the database.
-            conn.commit()
+            with services.acting_as(duty_actor):
+                services.create_order(conn, services.OrderRequest(
+                    order_id=order_id,
+                    supplier_id=final_supplier_id,
+                    items=order_items,
+                ))
             st.success(f"Success! Purchase Order #{order_id} has been securely saved.")
             
             # =================================================================
@@ -177,44 +194,26 @@ with tab1:
             st.subheader("Order Confirmation Receipt")
             st.caption("Live data pulled directly from the database to verify the transaction.")
             
-            verify_query = """
-                SELECT 
-                    po.Order_id AS "Order ID",
-                    s.Company_name AS "Supplier",
-                    po.Status AS "Status",
-                    dc.Drug_Name AS "Drug Name",
-                    poi.Qty_ordered AS "Quantity",
-                    poi.Unit_cost AS "Unit Cost"
-                FROM PURCHASE_ORDER po
-                JOIN SUPPLIER s ON po.Supplier_ID = s.Supplier_ID
-                JOIN PURCHASE_ORDER_ITEM poi ON po.Order_id = poi.Product_id
-                JOIN DRUG_CATALOGUE dc ON poi.Drug_id = dc.Drug_id
-                WHERE po.Order_id = %s;
-            """
-            
-            # Fetch the newly created records
-            cur.execute(verify_query, (order_id,))
-            columns = [desc[0] for desc in cur.description]
-            receipt_data = cur.fetchall()
-            
-            # Convert to Pandas DataFrame for a clean, read-only table
-            receipt_df = pd.DataFrame(receipt_data, columns=columns)
+            # Fetch the newly created records (prepared statement, from the primary: read-your-own-write)
+            receipt_df = statements.query("order_receipt", (order_id,), pin_primary=True)
             st.dataframe(receipt_df, use_container_width=True, hide_index=True)
 
         except Exception as e:
             # =================================================================
             # ERROR HANDLING & ROLLBACK
             # If the user tries to reuse an Order_id (Primary Key violation),
-            # PostgreSQL throws an error. We catch it and issue a ROLLBACK to 
+            # PostgreSQL throws an error. The service issues a ROLLBACK to 
             # ensure no orphaned records are left in the database.
             # =================================================================
-            conn.rollback()
             st.error(f"Transaction Failed & Rolled Back! The database prevented incomplete data from saving.\n\nError Details: {e}")
+        finally:
+            conn.close()
 
 # ---------------------------------------------------------------------
 # TAB 2: ORDER HISTORY & STATUS (Data Retrieval)
 # ---------------------------------------------------------------------
 with tab2:
+    profiler.mark("order history tab")
     st.subheader("Order Monitoring")
     st.markdown("View all pending and fulfilled purchase orders in the system.")
     
@@ -227,34 +226,48 @@ with tab2:
     
     # =================================================================
     # FETCH ORDER HISTORY
-    # Professor, we use a JOIN here to replace the numeric Supplier_ID 
-    # with the actual Company Name for better user readability. 
+    # Old DELIVERED / CANCELLED orders live in the Parquet archive
+    # (see archive.py), so we read live + archived headers together and
+    # then replace the numeric Supplier_ID with the Company Name.
     # =================================================================
     try:
-        history_conn = get_connection()
-        
+        history_columns = ["order_id", "supplier_id", "order_date", "expected_delivery_date", "status"]
+
         # We start with a base query
         history_query = """
-            SELECT 
-                po.Order_id AS "Order ID",
-                s.Company_name AS "Supplier",
-                po.Order_date AS "Order Date",
-                po.Expected_delivery_date AS "Expected Delivery",
-                po.Status AS "Status"
-            FROM PURCHASE_ORDER po
-            JOIN SUPPLIER s ON po.Supplier_ID = s.Supplier_ID
+            SELECT Order_id, Supplier_ID, Order_date, Expected_delivery_date, Status
+            FROM PURCHASE_ORDER
         """
-        
+        history_params = None
+        history_filters = None
+
         # If the user clicks a specific radio button, we append a WHERE clause
         if status_filter != "All Orders":
-            history_query += f" WHERE po.Status = '{status_filter}'"
-            
+            history_query += " WHERE Status = %s"
+            history_params = (status_filter,)
+            history_filters = [("status", "==", status_filter)]
+
+        with st.spinner("Loading order history..."):
+            history_df = read_history(
+                "purchase_order", history_query, params=history_params,
+                columns=history_columns, filters=history_filters,
+            )
+            suppliers_df = run_query("SELECT Supplier_ID, Company_name FROM SUPPLIER;")
+
         # Finally, we order them so the newest orders appear at the very top
-        history_query += " ORDER BY po.Order_id DESC;"
-        
-        # Execute query and load directly into a Pandas dataframe
-        history_df = pd.read_sql(history_query, history_conn)
-        
+        history_df = (
+            history_df.merge(suppliers_df, on="supplier_id", how="left")
+            .sort_values("order_id", ascending=False)
+            [["order_id", "company_name", "order_date", "expected_delivery_date", "status"]]
+            .rename(columns={
+                "order_id": "Order ID",
+                "company_name": "Supplier",
+                "order_date": "Order Date",
+                "expected_delivery_date": "Expected Delivery",
+                "status": "Status",
+            })
+        )
+
         if history_df.empty:
             st.info("No orders found matching this status.")
         else:
@@ -268,6 +281,7 @@ with tab2:
 # TAB 3: REVISE PURCHASE ORDER (Transaction 4)
 # ---------------------------------------------------------------------
 with tab3:
+    profiler.mark("revise order tab")
     st.subheader("Revise Pending Order")
     st.markdown("Execute **Transaction 4**: Modify an existing `PENDING` order by adding, updating, and removing items in one atomic block.")
     
@@ -316,12 +330,15 @@ with tab3:
             # an UPDATE, and a DELETE. We batch them together so they can 
             # be processed as a single atomic transaction.
             # =================================================================
+            # Search box for the drug to add (outside the form, so the list updates while typing)
+            add_query = st.text_input("Find Drug to Add", placeholder="Brand or generic name, form, strength")
+
             with st.form("real_tx4_form"):
                 st.markdown("### 1. Add a New Item (INSERT)")
                 col1, col2 = st.columns([2, 1])
                 with col1:
-                    # drug_options is inherited from the top of the file!
-                    add_drug = st.selectbox("Select Drug to Add", ["None"] + drug_options)
+                    # find_drugs is inherited from the top of the file!
+                    add_drug = st.selectbox("Select Drug to Add", ["None"] + find_drugs(add_query))
                 with col2:
                     add_qty = st.number_input("Quantity to Add", min_value=0, value=0)
 
@@ -343,42 +360,23 @@ with tab3:
             # =================================================================
             if submitted_tx4:
                 try:
-                    # 🚨 BEGIN ATOMIC BLOCK 🚨
-                    cur.execute("BEGIN;")
-                    
-                    # ACTION 1: INSERT
-                    if add_drug != "None" and add_qty > 0:
-                        add_id = int(add_drug.split(" - ")[0])
-                        # Using 2.00 as a standard unit cost for newly added items
-                        cur.execute("""
-                            INSERT INTO PURCHASE_ORDER_ITEM (Product_id, Drug_id, Qty_ordered, Unit_cost) 
-                            VALUES (%s, %s, %s, 2.00);
-                        """, (selected_order_id, add_id, add_qty))
-                        
-                    # ACTION 2: UPDATE
-                    if update_drug != "None" and update_qty > 0:
-                        update_id = int(update_drug.split(" - ")[0])
-                        cur.execute("""
-                            UPDATE PURCHASE_ORDER_ITEM 
-                            SET Qty_ordered = %s 
-                            WHERE Product_id = %s AND Drug_id = %s;
-                        """, (update_qty, selected_order_id, update_id))
-                        
-                    # ACTION 3: DELETE
-                    if delete_drug != "None":
-                        delete_id = int(delete_drug.split(" - ")[0])
-                        cur.execute("""
-                            DELETE FROM PURCHASE_ORDER_ITEM 
-                            WHERE Product_id = %s AND Drug_id = %s;
-                        """, (selected_order_id, delete_id))
-                        
-                    #COMMIT THE CHANGES
-                    cur.execute("COMMIT;")
+                    # 🚨 ATOMIC BLOCK 🚨
+                    # INSERT, UPDATE and DELETE are applied by services.revise_order()
+                    # in one transaction, after re-checking that the order is still PENDING.
+                    with services.acting_as(duty_actor):
+                        services.revise_order(tx4_conn, selected_order_id, services.OrderRevision(
+                            # Using 2.00 as a standard unit cost for newly added items
+                            add=services.OrderItem(int(add_drug.split(" - ")[0]), add_qty)
+                            if add_drug != "None" else None,
+                            update_drug_id=int(update_drug.split(" - ")[0]) if update_drug != "None" else None,
+                            update_qty=update_qty,
+                            remove_drug_id=int(delete_drug.split(" - ")[0]) if delete_drug != "None" else None,
+                        ))
                     st.success(f"Success! Order #{selected_order_id} has been fully revised.")
                     
                     # --- LIVE RECEIPT GENERATION ---
                     st.caption("Updated Database State for this Order:")
-                    cur.execute("""
+                    tx4_df = run_query("""
                         SELECT 
                             po.Order_id AS "Order ID",
                             dc.Drug_Name AS "Drug Name",
@@ -388,28 +386,26 @@ with tab3:
                         JOIN PURCHASE_ORDER_ITEM poi ON po.Order_id = poi.Product_id
                         JOIN DRUG_CATALOGUE dc ON poi.Drug_id = dc.Drug_id
                         WHERE po.Order_id = %s;
-                    """, (selected_order_id,))
-                    
-                    tx4_columns = [desc[0] for desc in cur.description]
-                    tx4_data = cur.fetchall()
+                    """, params=(selected_order_id,), pin_primary=True)
                     
-                    if tx4_data:
-                        tx4_df = pd.DataFrame(tx4_data, columns=tx4_columns)
+                    if not tx4_df.empty:
                         st.dataframe(tx4_df, use_container_width=True, hide_index=True)
                     else:
                         st.info("This order has no items left in it.")
                         
                 except Exception as e:
-                    tx4_conn.rollback()
                     st.error(f"Transaction Failed & Rolled Back! The database prevented incomplete data from saving.\n\nError Details: {e}")
                     
     except Exception as e:
         st.error(f"Database connection error: {e}")
+    finally:
+        tx4_conn.close()
 
 #---------------------------------------------------------------------
 # TAB 4: CANCEL ORDER
 # ---------------------------------------------------------------------
 with tab4:
+    profiler.mark("cancel order tab")
     st.subheader("Cancel Purchase Order")
     st.markdown("Select a `PENDING` purchase order to cancel it. This executes a simple **UPDATE** statement to change the order status.")
     
@@ -432,26 +428,67 @@ with tab4:
                 
             if submitted_cancel:
                 try:
-                    cur.execute("BEGIN;")
-                    
                     # Update the Status of the Parent Record to CANCELLED
-                    cur.execute("""
-                        UPDATE PURCHASE_ORDER 
-                        SET Status = 'CANCELLED' 
-                        WHERE Order_id = %s;
-                    """, (cancel_order_id,))
-                    
-                    cur.execute("COMMIT;")
+                    # (the service refuses if the order is no longer PENDING)
+                    with services.acting_as(duty_actor):
+                        services.cancel_order(cancel_conn, cancel_order_id)
                     st.success(f"Success! Order #{cancel_order_id} has been officially CANCELLED.")
                     
                     # Prove the database was updated
-                    cur.execute("SELECT Order_id, Status FROM PURCHASE_ORDER WHERE Order_id = %s;", (cancel_order_id,))
-                    result = cur.fetchone()
-                    st.info(f"Current Database Status for Order #{result[0]}: **{result[1]}**")
+                    status_df = run_query(
+                        "SELECT Order_id, Status FROM PURCHASE_ORDER WHERE Order_id = %s;",
+                        params=(cancel_order_id,), pin_primary=True,
+                    )
+                    st.info(f"Current Database Status for Order #{status_df.iloc[0, 0]}: **{status_df.iloc[0, 1]}**")
                     
                 except Exception as e:
-                    cancel_conn.rollback()
                     st.error(f"Failed to cancel order: {e}")
                     
     except Exception as e:
         st.error(f"Database connection error: {e}")
+    finally:
+        cancel_conn.close()
+
+# ---------------------------------------------------------------------
+# TAB 5: REORDER LEVELS (DRUG_STOCK_SUMMARY)
+# Professor, low stock is judged per drug: the usable (unexpired) stock
+# of all its lots against a reorder level the pharmacy sets per drug.
+# The summary itself is kept up to date by a trigger on INVENTORY_LOT.
+# ---------------------------------------------------------------------
+with tab5:
+    profiler.mark("reorder levels tab")
+    st.subheader("Reorder Levels")
+    st.caption("A drug counts as low on stock when its usable (unexpired) quantity across all lots is below its reorder level.")
+
+    levels_df = run_query(
+        """
+        SELECT s.Drug_id AS drug_id, d.Drug_Name AS drug_name, s.Usable_on_hand AS usable_on_hand,
+               s.Total_on_hand AS total_on_hand, s.Reorder_level AS reorder_level
+        FROM DRUG_STOCK_SUMMARY s
+        JOIN DRUG_CATALOGUE d ON s.Drug_id = d.Drug_id
+        ORDER BY s.Drug_id;
+        """,
+        pin_primary=True,
+    )
+    edited_df = st.data_editor(
+        levels_df,
+        use_container_width=True,
+        hide_index=True,
+        disabled=["drug_id", "drug_name", "usable_on_hand", "total_on_hand"],
+        column_config={"reorder_level": st.column_config.NumberColumn("Reorder level", min_value=0, step=1)},
+        key="reorder_levels_editor",
+    )
+    changed = edited_df[edited_df["reorder_level"] != levels_df["reorder_level"]]
+    if st.button(f"Save {len(changed)} changed levels", disabled=changed.empty, type="primary"):
+        levels_conn = get_connection()
+        try:
+            updated = services.set_reorder_levels(
+                levels_conn, dict(zip(changed["drug_id"].astype(int), changed["reorder_level"].astype(int)))
+            )
+            st.success(f"Updated the reorder level of {updated} drugs.")
+        except Exception as e:
+            st.error(f"Failed to update reorder levels: {e}")
+        finally:
+            levels_conn.close()
+
+profiler.finish()
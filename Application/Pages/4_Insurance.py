@@ -1,58 +1,170 @@
 import streamlit as st
 import pandas as pd
-from db import get_connection
+import os
+from db import get_connection, run_query
+from async_db import run_queries
+import archive
+import duty
+import patient_history
+import services
+import profiler
 
 st.set_page_config(page_title="Insurance Coverage", layout="wide")
+profiler.start("4_Insurance")
+# Payments and remittances are recorded in AUDIT_LOG under the pharmacist on duty (duty.py).
+duty_actor = duty.select_pharmacist()
 st.title("Insurance Coverage")
 st.markdown("Record insurance payments for completed dispenses, and undo mistakes safely.")
 st.divider()
 
+INSURANCE_PAGE_SIZE = int(os.getenv("INSURANCE_PAGE_SIZE", "50"))
+
 # ==========================================================
-# Load Dispenses & Insurance Policies
+# Load Insurance Policies
 # ==========================================================
 @st.cache_data(ttl=60)
-def load_data():
-    conn = get_connection()
-
-    dispenses = pd.read_sql("""
-        SELECT dispense_id, total_amount
-        FROM dispense
-        ORDER BY dispense_id DESC;
-    """, conn)
-
-    insurance = pd.read_sql("""
-        SELECT policy_id, company
-        FROM insurance
-        ORDER BY policy_id;
-    """, conn)
-
-    return dispenses, insurance
-
-
-dispenses_df, insurance_df = load_data()
+def load_insurers():
+    return run_query("SELECT policy_id, company FROM insurance ORDER BY policy_id;")
+
+
+def load_outstanding(before_id, date_from, date_to, min_remaining):
+    """
+    One page of dispenses with an open balance, newest first (keyset: dispense_id < before_id).
+    Only the filters that are set go into the SQL, so the planner can use the partial
+    indexes on DISPENSE_BALANCE (Performance_Script.sql section 9).
+    """
+    conditions, params = ["remaining > 0"], []
+    if before_id is not None:
+        conditions.append("dispense_id < %s")
+        params.append(before_id)
+    if date_from is not None:
+        conditions.append("dispense_date >= %s")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("dispense_date <= %s")
+        params.append(date_to)
+    if min_remaining > 0:
+        conditions.append("remaining >= %s")
+        params.append(min_remaining)
+    # One extra row tells whether there is a next page.
+    params.append(INSURANCE_PAGE_SIZE + 1)
+    return run_query(
+        f"""
+        SELECT dispense_id, dispense_date, total_amount, covered_total, remaining
+        FROM dispense_balance
+        WHERE {" AND ".join(conditions)}
+        ORDER BY dispense_id DESC
+        LIMIT %s;
+        """,
+        params=tuple(params),
+    )
+
+
+profiler.mark("load data")
+insurance_df = load_insurers()
 
-if dispenses_df.empty:
-    st.info("No dispenses found. Insurance can only be applied to existing dispenses.")
-    st.stop()
+# ==========================================================
+# Bulk: insurer remittance file (services/remittance.py)
+# ==========================================================
+with st.expander("Import an insurer remittance (CSV)"):
+    st.caption(
+        "One line per paid claim with a dispense column (dispense_id / claim_id) and an amount column "
+        "(amount / paid / betrag). All accepted lines are written in one transaction; the rest are listed as exceptions."
+    )
+    remit_policy = st.selectbox(
+        "Insurer", insurance_df["policy_id"].tolist(),
+        format_func=lambda pid: f"{pid} - {insurance_df.set_index('policy_id').at[pid, 'company']}",
+        key="remit_policy",
+    )
+    remit_file = st.file_uploader("Remittance file", type=["csv", "txt"], key="remit_file")
+
+    if remit_file is not None:
+        r1, r2 = st.columns(2)
+        preview = r1.button("Check file", use_container_width=True)
+        apply = r2.button("Apply remittance", type="primary", use_container_width=True)
+        if preview or apply:
+            conn = get_connection()
+            try:
+                remit_file.seek(0)
+                lines = services.parse_remittance(remit_file)
+                with st.spinner(f"Matching {len(lines)} lines..."):
+                    with services.acting_as(duty_actor):
+                        remit = services.import_remittance(conn, int(remit_policy), lines, dry_run=preview)
+                if not remit.dry_run:
+                    patient_history.invalidate()
+                verb = "would be" if remit.dry_run else "were"
+                st.success(
+                    f"{remit.lines} lines: {remit.inserted} new payments and {remit.updated} corrections {verb} applied "
+                    f"(€{remit.amount_applied:.2f}); {len(remit.exceptions)} exceptions."
+                )
+                if remit.exceptions:
+                    exceptions_df = pd.DataFrame([vars(e) for e in remit.exceptions])
+                    st.dataframe(
+                        exceptions_df.groupby("reason", as_index=False).size().rename(columns={"size": "lines"}),
+                        hide_index=True,
+                    )
+                    st.dataframe(exceptions_df, use_container_width=True, hide_index=True)
+                    st.download_button(
+                        "Download exceptions report (CSV)",
+                        data=exceptions_df.to_csv(index=False),
+                        file_name=f"remittance-exceptions-{remit_policy}.csv",
+                        mime="text/csv",
+                    )
+            except Exception as e:
+                st.error(f"Remittance import failed and was rolled back.\n\nError: {e}")
+            finally:
+                conn.close()
 
 # ==========================================================
 # Select Dispense
 # ==========================================================
-dispenses_df["label"] = dispenses_df.apply(
-    lambda r: f"{int(r['dispense_id'])} | Total: €{float(r['total_amount']):.2f}",
-    axis=1
-)
-
-selected_dispense_label = st.selectbox(
-    "Select Dispense",
-    dispenses_df["label"].tolist()
-)
-
-selected_dispense_id = int(selected_dispense_label.split("|")[0].strip())
-
-selected_total = float(
-    dispenses_df[dispenses_df["dispense_id"] == selected_dispense_id]["total_amount"].values[0]
-)
+find_mode = st.radio("Find dispense", ["Outstanding balances", "By dispense ID"], horizontal=True)
+
+if find_mode == "Outstanding balances":
+    f1, f2, f3 = st.columns(3)
+    with f1:
+        date_from = st.date_input("Dispensed from", value=None)
+    with f2:
+        date_to = st.date_input("Dispensed until", value=None)
+    with f3:
+        min_remaining = st.number_input("Remaining at least (€)", min_value=0.0, value=0.0, step=5.0)
+
+    # Keyset pagination: the stack holds the "before" cursor of every page visited so far.
+    filters = (date_from, date_to, min_remaining)
+    if st.session_state.get("ins_filters") != filters:
+        st.session_state.ins_filters = filters
+        st.session_state.ins_cursors = [None]
+
+    page_df = load_outstanding(st.session_state.ins_cursors[-1], date_from, date_to, min_remaining)
+    has_next = len(page_df) > INSURANCE_PAGE_SIZE
+    page_df = page_df.head(INSURANCE_PAGE_SIZE)
+
+    if page_df.empty:
+        st.info("No dispenses with an outstanding balance match these filters.")
+        st.stop()
+
+    st.dataframe(page_df, use_container_width=True, hide_index=True)
+    p1, p2, p3 = st.columns([0.2, 0.6, 0.2], vertical_alignment="center")
+    with p1:
+        if st.button("Previous", use_container_width=True, disabled=len(st.session_state.ins_cursors) == 1):
+            st.session_state.ins_cursors.pop()
+            st.rerun()
+    with p2:
+        st.caption(f"Page {len(st.session_state.ins_cursors)} ({INSURANCE_PAGE_SIZE} per page)")
+    with p3:
+        if st.button("Next", use_container_width=True, disabled=not has_next):
+            st.session_state.ins_cursors.append(int(page_df["dispense_id"].iloc[-1]))
+            st.rerun()
+
+    page_df["label"] = page_df.apply(
+        lambda r: f"{int(r['dispense_id'])} | Total: €{float(r['total_amount']):.2f} | Open: €{float(r['remaining']):.2f}",
+        axis=1
+    )
+    selected_dispense_label = st.selectbox("Select Dispense", page_df["label"].tolist())
+    selected_dispense_id = int(selected_dispense_label.split("|")[0].strip())
+else:
+    # Also reaches fully covered dispenses, e.g. to undo a payment.
+    selected_dispense_id = int(st.number_input("Dispense ID", min_value=1, step=1))
 
 # ==========================================================
 # Select Insurance Policy
@@ -69,19 +181,54 @@ selected_policy_label = st.selectbox(
 
 selected_policy_id = int(selected_policy_label.split(" - ")[0])
 
+profiler.mark("existing coverage")
 # ==========================================================
 # Check Existing Coverage
+# Everything shown for the selected dispense (balance, payments to
+# undo, verification table) is read from the primary, so it always
+# reflects the last write. services.record_payment()
+# re-checks the balance under a row lock before inserting.
 # ==========================================================
-conn = get_connection()
-
-covered_df = pd.read_sql("""
-    SELECT COALESCE(SUM(amount_covered),0) AS covered
-    FROM pays
-    WHERE dispense_id = %s;
-""", conn, params=(selected_dispense_id,))
+# The payments and the balance (maintained by triggers) are read concurrently on the primary.
+frames = run_queries({
+    "pays_rows": ("""
+        SELECT
+            p.dispense_id,
+            p.policy_id,
+            i.company,
+            p.amount_covered
+        FROM pays p
+        JOIN insurance i ON p.policy_id = i.policy_id
+        WHERE p.dispense_id = %s
+        ORDER BY p.policy_id;
+    """, (selected_dispense_id,)),
+    "balance": ("""
+        SELECT dispense_id, dispense_date, total_amount, covered_total, remaining
+        FROM dispense_balance
+        WHERE dispense_id = %s;
+    """, (selected_dispense_id,)),
+}, pin_primary=True)
+pays_rows, balance_df = frames["pays_rows"], frames["balance"]
+# The verification table is the same rows by insurer name; no second round trip.
+verification_df = pays_rows[["dispense_id", "company", "amount_covered"]].sort_values("company", ignore_index=True)
+if balance_df.empty:
+    # Old dispenses are moved to the Parquet archive (archive.py); their cover can be read, not changed.
+    archived = archive.archived_dispense(selected_dispense_id)
+    if archived["dispense"].empty:
+        st.warning(f"Dispense {selected_dispense_id} does not exist.")
+        st.stop()
+    archived_total = float(archived["dispense"]["total_amount"].iloc[0])
+    archived_pays = archived["pays"].merge(insurance_df[["policy_id", "company"]], on="policy_id", how="left")
+    st.info(
+        f"Dispense {selected_dispense_id} ({archived['dispense']['dispense_date'].iloc[0]}) is archived and read-only. "
+        f"Total €{archived_total:.2f}, covered €{archived_pays['amount_covered'].astype(float).sum():.2f}."
+    )
+    st.dataframe(archived_pays[["policy_id", "company", "amount_covered"]], use_container_width=True, hide_index=True)
+    st.stop()
 
-already_covered = float(covered_df["covered"].values[0])
-remaining_balance = round(selected_total - already_covered, 2)
+selected_total = float(balance_df["total_amount"].values[0])
+already_covered = float(balance_df["covered_total"].values[0])
+remaining_balance = round(float(balance_df["remaining"].values[0]), 2)
 
 st.info(
     f"Total Dispense: €{selected_total:.2f}\n\n"
@@ -98,6 +245,7 @@ tab_add, tab_rollback = st.tabs(["Add Insurance Coverage", "Rollback / Undo"])
 # TAB 1 — Add Insurance Coverage (INSERT into PAYS)
 # ==========================================================
 with tab_add:
+    profiler.mark("add coverage tab")
     if remaining_balance <= 0:
         st.success("This dispense is already fully covered.")
     else:
@@ -112,48 +260,29 @@ with tab_add:
             submitted = st.form_submit_button("Record Insurance Payment", type="primary")
 
         if submitted:
+            conn = get_connection()
             try:
-                with conn.cursor() as cur:
-                    cur.execute("BEGIN;")
-
-                    if amount <= 0:
-                        raise Exception("Amount must be greater than 0.")
-                    if amount > remaining_balance:
-                        raise Exception("Amount exceeds remaining balance.")
-
-                    cur.execute("""
-                        INSERT INTO pays (dispense_id, policy_id, amount_covered)
-                        VALUES (%s, %s, %s);
-                    """, (selected_dispense_id, selected_policy_id, amount))
-
-                    cur.execute("COMMIT;")
+                # The service re-checks the balance with the dispense row locked, then INSERTs.
+                with services.acting_as(duty_actor):
+                    services.record_payment(conn, selected_dispense_id, selected_policy_id, amount)
+                patient_history.invalidate()
 
                 st.success("Insurance coverage recorded successfully.")
-                st.cache_data.clear()
                 st.rerun()
 
             except Exception as e:
-                conn.rollback()
                 st.error(f"Failed to record insurance coverage.\n\nError: {e}")
+            finally:
+                conn.close()
 
 # ==========================================================
 # TAB 2 — Rollback / Undo (DELETE from PAYS)
 # ==========================================================
 with tab_rollback:
+    profiler.mark("rollback tab")
     st.subheader("Undo an Insurance Payment")
     st.caption("Use this if an insurance payment was entered incorrectly. This will delete a PAYS row inside a transaction.")
 
-    pays_rows = pd.read_sql("""
-        SELECT
-            p.dispense_id,
-            p.policy_id,
-            i.company,
-            p.amount_covered
-        FROM pays p
-        JOIN insurance i ON p.policy_id = i.policy_id
-        WHERE p.dispense_id = %s
-        ORDER BY p.policy_id;
-    """, get_connection(), params=(selected_dispense_id,))
 
     if pays_rows.empty:
         st.info("No insurance payments found for this dispense. Nothing to rollback.")
@@ -181,43 +310,23 @@ with tab_rollback:
         confirm = st.checkbox("I confirm I want to undo this insurance payment.")
 
         if st.button("Undo Selected Payment", type="primary", disabled=not confirm):
+            rb_conn = get_connection()
             try:
-                rb_conn = get_connection()
-                with rb_conn.cursor() as cur:
-                    cur.execute("BEGIN;")
-
-                    # Delete the exact row using the composite PK
-                    cur.execute("""
-                        DELETE FROM pays
-                        WHERE dispense_id = %s AND policy_id = %s;
-                    """, (selected_dispense_id, rollback_policy_id))
-
-                    # Safety: ensure something was deleted
-                    if cur.rowcount != 1:
-                        raise Exception("Rollback failed: record not found or multiple rows affected.")
-
-                    cur.execute("COMMIT;")
+                # Delete the exact row using the composite PK (exactly one row, or nothing changes)
+                with services.acting_as(duty_actor):
+                    services.undo_payment(rb_conn, selected_dispense_id, rollback_policy_id)
+                patient_history.invalidate()
 
                 st.success("Insurance payment undone successfully.")
-                st.cache_data.clear()
                 st.rerun()
 
             except Exception as e:
-                try:
-                    rb_conn.rollback()
-                except Exception:
-                    pass
                 st.error(f"Rollback failed.\n\nError: {e}")
+            finally:
+                rb_conn.close()
 
     st.divider()
     st.markdown("### Current Insurance Records (Verification)")
-    verification_df = pd.read_sql("""
-        SELECT p.dispense_id,
-               i.company,
-               p.amount_covered
-        FROM pays p
-        JOIN insurance i ON p.policy_id = i.policy_id
-        WHERE p.dispense_id = %s
-        ORDER BY i.company;
-    """, get_connection(), params=(selected_dispense_id,))
     st.dataframe(verification_df, use_container_width=True, hide_index=True)
+
+profiler.finish()
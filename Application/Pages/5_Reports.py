@@ -0,0 +1,100 @@
+import streamlit as st
+import datetime as dt
+import os
+import tempfile
+import analytics
+import exports
+import profiler
+
+# Larger exports are not offered as a browser download (Streamlit holds a download in memory).
+EXPORT_PAGE_MAX_MB = float(os.getenv("EXPORT_PAGE_MAX_MB", "50"))
+
+st.set_page_config(page_title="Reports", layout="wide")
+profiler.start("5_Reports")
+st.title("Reports")
+st.markdown("Aggregate business reports from `SQL_Queries.md`. They run on the analytics mirror so they never slow down dispensing.")
+st.divider()
+
+# ==========================================================
+# Engine status
+# ==========================================================
+col_engine, col_sync = st.columns([0.7, 0.3], vertical_alignment="center")
+with col_engine:
+    st.caption(f"Query engine: **{analytics.engine_name()}**")
+with col_sync:
+    if analytics.ANALYTICS_DB and st.button("Sync mirror now", use_container_width=True):
+        try:
+            applied = analytics.sync()
+            st.success("Full copy completed." if applied < 0 else f"Applied {applied} changed rows.")
+        except Exception as e:
+            st.error(f"Sync failed.\n\nError: {e}")
+
+# ==========================================================
+# Run a report
+# ==========================================================
+report_name = st.selectbox("Select a report", list(analytics.REPORTS))
+
+if analytics.excludes_archive(analytics.REPORTS[report_name]):
+    st.caption("Archived dispenses and orders are not included. Set `ANALYTICS_DB` to report over the full history.")
+
+try:
+    report_df = analytics.query(analytics.REPORTS[report_name])
+    if report_df.empty:
+        st.info("This report returned no rows.")
+    else:
+        st.dataframe(report_df, use_container_width=True, hide_index=True)
+except Exception as e:
+    st.error(f"Could not run report.\n\nError: {e}")
+
+with st.expander("Show SQL"):
+    st.code(analytics.REPORTS[report_name].strip(), language="sql")
+
+# ==========================================================
+# Exports
+# ==========================================================
+st.divider()
+st.markdown("### Export history")
+st.caption("Streams straight from PostgreSQL (COPY) and the Parquet archive into a file, without loading it into a table first.")
+
+export_name = st.selectbox("Data", list(exports.EXPORTS), format_func=lambda n: exports.EXPORTS[n].label)
+spec = exports.EXPORTS[export_name]
+e1, e2, e3 = st.columns(3)
+with e1:
+    export_from = st.date_input("From", value=None, help=f"Filters on {spec.date_column}")
+with e2:
+    export_to = st.date_input("To", value=None)
+with e3:
+    export_status = st.multiselect("Status", spec.statuses, disabled=not spec.statuses)
+x1, x2 = st.columns(2)
+include_archive = x1.checkbox("Include archived history", value=True, disabled=spec.archive_table is None)
+for_excel = x2.checkbox("Open in Excel", help="Adds a byte order mark so Excel reads the encoding correctly.")
+
+if st.button("Prepare export", type="primary"):
+    # A private file per click; download_button copies the bytes into Streamlit, so it is deleted right after.
+    with tempfile.NamedTemporaryFile(prefix=f"pharmacy-{export_name}-", suffix=".csv", delete=False) as tmp:
+        path = tmp.name
+    try:
+        with st.spinner("Exporting..."):
+            size = exports.write(
+                export_name, path, date_from=export_from, date_to=export_to, statuses=export_status,
+                include_archive=include_archive, excel=for_excel,
+            )
+        if size > EXPORT_PAGE_MAX_MB * 1e6:
+            st.warning(
+                f"The export is {size / 1e6:.0f} MB, too large to download through the browser here. "
+                f"Use the API (`/exports/{export_name}.csv`) or `python exports.py {export_name} -o file.csv`."
+            )
+        else:
+            with open(path, "rb") as f:
+                st.download_button(
+                    f"Download {spec.label} ({size / 1e6:.1f} MB)",
+                    data=f,
+                    file_name=f"{export_name}-{dt.date.today():%Y%m%d}.csv",
+                    mime="text/csv",
+                )
+    except Exception as e:
+        st.error(f"Export failed.\n\nError: {e}")
+    finally:
+        os.remove(path)
+
+profiler.finish()
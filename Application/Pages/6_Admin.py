@@ -0,0 +1,194 @@
+import streamlit as st
+import pandas as pd
+import datetime as dt
+import instrumentation
+import memory
+import slow_queries
+import services
+import statements
+from db import get_connection, run_query
+import profiler
+
+st.set_page_config(page_title="Admin - Query Performance", layout="wide")
+profiler.start("6_Admin")
+st.title("Query Performance")
+st.markdown("Live timings of every SQL statement issued by this app server, grouped by page and query fingerprint.")
+st.divider()
+
+col_info, col_reset = st.columns([0.75, 0.25], vertical_alignment="center")
+with col_info:
+    st.caption(
+        f"Prometheus text file: `{instrumentation.METRICS_FILE or 'disabled'}` "
+        f"(rewritten at most every {instrumentation.METRICS_WRITE_SECONDS:g}s). "
+        "Statistics are per process and reset on restart."
+    )
+with col_reset:
+    if st.button(":material/restart_alt: Reset statistics", use_container_width=True):
+        instrumentation.reset()
+        st.rerun()
+
+tab_pages, tab_queries, tab_slow, tab_prepared, tab_reruns, tab_memory, tab_audit, tab_prom = st.tabs(
+    ["Per Page", "Top Queries", "Slow Queries", "Prepared Statements", "Recent Reruns", "Memory", "Audit Log", "Prometheus"]
+)
+
+# ==========================================================
+# Per-page latency
+# ==========================================================
+with tab_pages:
+    pages_df = pd.DataFrame(instrumentation.page_summary())
+    if pages_df.empty:
+        st.info("No queries recorded yet. Open a few pages first.")
+    else:
+        st.caption("p50 / p95 are bucket upper bounds (ms), the same approximation Prometheus uses.")
+        st.dataframe(pages_df, use_container_width=True, hide_index=True)
+
+# ==========================================================
+# Top queries by total time
+# ==========================================================
+with tab_queries:
+    queries_df = pd.DataFrame(instrumentation.query_summary())
+    if queries_df.empty:
+        st.info("No queries recorded yet.")
+    else:
+        pages = ["All pages"] + sorted(queries_df["page"].unique().tolist())
+        page_filter = st.selectbox("Page", pages)
+        if page_filter != "All pages":
+            queries_df = queries_df[queries_df["page"] == page_filter]
+        st.dataframe(
+            queries_df,
+            use_container_width=True,
+            hide_index=True,
+            column_config={"sql": st.column_config.TextColumn("Normalised SQL", width="large")},
+        )
+
+# ==========================================================
+# Slow-query log with captured plans
+# ==========================================================
+with tab_slow:
+    st.caption(
+        f"Statements slower than {slow_queries.SLOW_QUERY_MS:g} ms are re-planned in the background "
+        "(EXPLAIN ANALYZE, BUFFERS for reads; plain EXPLAIN for writes)."
+    )
+    slow_df = pd.DataFrame(slow_queries.grouped())
+    if slow_df.empty:
+        st.info("No slow statements captured yet.")
+    else:
+        st.dataframe(slow_df, use_container_width=True, hide_index=True)
+
+        selected_qid = st.selectbox("Show worst captured plan for", slow_df["query_id"].tolist())
+        worst = slow_queries.worst_case(selected_qid)
+        if worst:
+            st.markdown(f"**{worst['elapsed_ms']:.1f} ms** on `{worst['page']}` at {worst['captured_at']} UTC, {worst['rows']} rows")
+            st.code(worst["sql"].strip(), language="sql")
+            st.caption(f"Parameters: `{worst['params']}`")
+            st.code(worst["plan"], language="text")
+
+        if st.button("Clear slow-query log"):
+            slow_queries.clear()
+            st.rerun()
+
+# ==========================================================
+# Prepared statements: generic vs custom plans
+# ==========================================================
+with tab_prepared:
+    st.caption(
+        f"Hot statements from statements.py, prepared once per pooled connection. "
+        f"Plan counters are sampled from pg_prepared_statements every {statements.PLAN_SAMPLE_EVERY} calls "
+        f"(PostgreSQL 14+). plan_cache_mode: `{statements.PREPARED_PLAN_CACHE_MODE}`."
+    )
+    prepared_df = pd.DataFrame(statements.plan_summary())
+    st.dataframe(prepared_df, use_container_width=True, hide_index=True)
+    st.caption(
+        "A high generic_share means PostgreSQL reuses one plan for all parameters. If such a statement "
+        "also shows up under Slow Queries for some parameters, set PREPARED_PLAN_CACHE_MODE=force_custom_plan."
+    )
+
+# ==========================================================
+# Recent reruns
+# ==========================================================
+with tab_reruns:
+    reruns_df = pd.DataFrame(instrumentation.recent_reruns())
+    if reruns_df.empty:
+        st.info("No Streamlit reruns recorded yet.")
+    else:
+        st.caption("Database time spent by each recent script rerun (newest first).")
+        st.dataframe(reruns_df, use_container_width=True, hide_index=True)
+
+# ==========================================================
+# Memory: process RSS, per-session stored frames, per-page allocations
+# ==========================================================
+with tab_memory:
+    traced = memory.traced()
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Process RSS", f"{memory.rss_bytes() / 2**20:.1f} MiB")
+    m2.metric("Traced (current)", f"{traced['current'] / 2**20:.1f} MiB" if traced else "off")
+    m3.metric("Traced (peak)", f"{traced['peak'] / 2**20:.1f} MiB" if traced else "off")
+
+    st.markdown("**Stored frames per session**")
+    st.caption(
+        f"Budget {memory.SESSION_BUDGET_MB:g} MiB per session (SESSION_BUDGET_MB). "
+        "Older frames are compacted, then evicted, when a session goes over it."
+    )
+    sessions_df = pd.DataFrame(memory.session_summary())
+    if sessions_df.empty:
+        st.info("No session has stored a result frame yet.")
+    else:
+        st.dataframe(sessions_df, use_container_width=True, hide_index=True)
+
+    st.markdown("**Live allocations by page**")
+    if not traced:
+        st.info("Start the server with MEMORY_TRACE=1 to attribute allocations to pages (tracemalloc adds some overhead).")
+    else:
+        st.dataframe(pd.DataFrame(memory.page_allocations()), use_container_width=True, hide_index=True)
+        st.caption("Largest allocation sites in Application/")
+        st.dataframe(pd.DataFrame(memory.top_sites()), use_container_width=True, hide_index=True)
+
+# ==========================================================
+# Audit log (AUDIT_LOG, drained from AUDIT_STAGING in the background)
+# ==========================================================
+with tab_audit:
+    try:
+        staged = int(run_query("SELECT COUNT(*) AS n FROM audit_staging;", pin_primary=True).iloc[0]["n"])
+    except Exception as e:
+        st.error(f"Audit tables not found. Apply section 7 of Performance_Script.sql.\n\nError: {e}")
+    else:
+        a1, a2 = st.columns([0.75, 0.25], vertical_alignment="center")
+        a1.caption(f"{staged} changes waiting in staging (moved every {services.audit.AUDIT_DRAIN_SECONDS:g}s).")
+        if a2.button("Drain now", use_container_width=True, disabled=staged == 0):
+            conn = get_connection()
+            try:
+                st.success(f"Moved {services.drain_audit(conn)} rows.")
+            finally:
+                conn.close()
+
+        f1, f2, f3 = st.columns(3)
+        audit_table = f1.text_input("Table", placeholder="dispense")
+        audit_actor = f2.text_input("Actor", placeholder="pharmacist 4")
+        audit_since = f3.date_input("Since", value=dt.date.today() - dt.timedelta(days=7))
+        audit_df = run_query(
+            """
+            SELECT audit_id, changed_at, actor, table_name, operation, old_row::text AS before, new_row::text AS after
+            FROM audit_log
+            WHERE changed_at >= %s
+              AND (%s = '' OR table_name = lower(%s))
+              AND (%s = '' OR actor = %s)
+            ORDER BY changed_at DESC, audit_id DESC
+            LIMIT 500;
+            """,
+            params=(audit_since, audit_table, audit_table, audit_actor, audit_actor),
+        )
+        if audit_df.empty:
+            st.info("No audited changes match.")
+        else:
+            st.caption("Newest 500 changes. Operation: I = insert, U = update, D = delete.")
+            st.dataframe(audit_df, use_container_width=True, hide_index=True)
+
+# ==========================================================
+# Raw Prometheus output
+# ==========================================================
+with tab_prom:
+    prom_text = instrumentation.prometheus_text()
+    st.download_button("Download metrics (.prom)", prom_text, file_name="pharmacy_queries.prom", mime="text/plain")
+    st.code(prom_text, language="text")
+
+profiler.finish()
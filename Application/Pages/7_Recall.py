@@ -0,0 +1,129 @@
+import streamlit as st
+import datetime as dt
+from db import get_connection
+import drug_search
+import duty
+import recall
+import services
+import profiler
+
+st.set_page_config(page_title="Lot Recall", layout="wide")
+profiler.start("7_Recall")
+duty_actor = duty.select_pharmacist()
+st.title("Lot Recall")
+st.markdown(
+    "Find every dispense and patient that received a recalled batch, export the list, "
+    "and quarantine the lots so nothing more is dispensed from them."
+)
+st.divider()
+
+# ==========================================================
+# Which lots are recalled?
+# ==========================================================
+mode = st.radio("Recall by", ["Lot IDs", "Drug and expiry window"], horizontal=True)
+
+if mode == "Lot IDs":
+    lot_text = st.text_input("Lot batch IDs (comma separated)", placeholder="3001, 3004")
+    try:
+        requested = [int(x) for x in lot_text.replace(";", ",").split(",") if x.strip()]
+    except ValueError:
+        st.error("Lot IDs must be whole numbers separated by commas.")
+        st.stop()
+    scope = {"lot_ids": requested}
+else:
+    drug_query = st.text_input("Find drug", placeholder="Brand or generic name, form, strength")
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        drug_sel = st.selectbox("Drug", drug_search.options(drug_query))
+    with c2:
+        expiry_from = st.date_input("Expiring from", value=dt.date.today())
+    with c3:
+        expiry_to = st.date_input("Expiring until", value=dt.date.today() + dt.timedelta(days=90))
+    if drug_sel is None:
+        st.info("No drug matches this search.")
+        st.stop()
+    scope = {"drug_id": int(drug_sel.split(" - ")[0]), "expiry_from": expiry_from, "expiry_to": expiry_to}
+
+# The trace is only run by the button; edits to the scope above do not re-run it on their own.
+if st.button("Trace recall", type="primary"):
+    if mode == "Lot IDs" and not scope["lot_ids"]:
+        st.info("Enter at least one lot ID.")
+        st.stop()
+    try:
+        with st.spinner("Tracing dispenses and patients..."):
+            st.session_state.recall_lots = recall.resolve_lots(**scope)
+            st.session_state.recall_trace = recall.trace(st.session_state.recall_lots)
+            st.session_state.recall_scope = scope
+    except Exception as e:
+        st.error(f"Could not trace the recall.\n\nError: {e}")
+        st.stop()
+elif "recall_lots" not in st.session_state:
+    st.stop()
+elif st.session_state.recall_scope != scope:
+    st.info("The recall scope has changed. Press **Trace recall** to update the results.")
+    st.stop()
+
+lots = st.session_state.recall_lots
+trace_df = st.session_state.recall_trace
+if not lots:
+    st.warning("No inventory lots match this recall.")
+    st.stop()
+
+# ==========================================================
+# Impact
+# ==========================================================
+patients_df = recall.affected_patients(lots, trace_df=trace_df)
+k1, k2, k3 = st.columns(3)
+k1.metric("Recalled lots", len(lots))
+k2.metric("Affected dispenses", trace_df["dispense_id"].nunique() if not trace_df.empty else 0)
+k3.metric("Affected patients", len(patients_df))
+
+st.markdown("### Lots")
+st.dataframe(recall.lot_summary(lots, trace_df=trace_df), use_container_width=True, hide_index=True)
+
+st.markdown("### Patients to contact")
+if patients_df.empty:
+    st.success("None of these lots has been dispensed to a patient.")
+else:
+    st.dataframe(patients_df, use_container_width=True, hide_index=True)
+    # Built by recall.iter_csv() (streamed from the database and the archive) only when asked for.
+    if st.button("Prepare full trace (CSV)"):
+        st.download_button(
+            "Download full trace (CSV)",
+            data="".join(recall.iter_csv(lots)),
+            file_name=f"recall-{dt.date.today():%Y%m%d}.csv",
+            mime="text/csv",
+        )
+
+# ==========================================================
+# Quarantine
+# ==========================================================
+st.divider()
+st.markdown("### Quarantine")
+st.caption("Quarantined lots keep their on-hand count but show 0 available; dispensing from them is refused and open holds are dropped.")
+reason = st.text_input("Reason", value="Supplier recall")
+q1, q2 = st.columns(2)
+with q1:
+    if st.button("Quarantine these lots", type="primary", use_container_width=True):
+        conn = get_connection()
+        try:
+            with services.acting_as(duty_actor):
+                result = services.quarantine_lots(conn, lots, reason)
+            st.success(f"Quarantined {len(result.lot_batch_ids)} lots; {result.holds_dropped} stock holds dropped.")
+        except Exception as e:
+            st.error(f"Quarantine failed and was rolled back.\n\nError: {e}")
+        finally:
+            conn.close()
+with q2:
+    if st.button("Release quarantine", use_container_width=True):
+        conn = get_connection()
+        try:
+            with services.acting_as(duty_actor):
+                released = services.release_quarantine(conn, lots)
+            st.success(f"Released {released} lots.")
+        except Exception as e:
+            st.error(f"Release failed.\n\nError: {e}")
+        finally:
+            conn.close()
+
+profiler.finish()
@@ -0,0 +1,97 @@
+import streamlit as st
+import patient_history
+import profiler
+
+st.set_page_config(page_title="Patient History", layout="wide")
+profiler.start("8_Patient_History")
+st.title("Patient Medication History")
+st.markdown(
+    "Everything a patient has been prescribed and dispensed, newest first: items, lots and insurance cover. "
+    "Pages load from indexes only, so this stays quick for patients with a long history. "
+    "Fills already moved to the archive are included and marked **Archived**."
+)
+st.divider()
+
+PAGE_SIZE = patient_history.PATIENT_HISTORY_PAGE_SIZE
+
+# ==========================================================
+# Find the patient
+# ==========================================================
+patient_query = st.text_input("Find patient", placeholder="Name (any part) or patient ID")
+if not patient_query.strip():
+    st.info("Enter a name or patient ID.")
+    st.stop()
+
+try:
+    patients_df = patient_history.find_patients(patient_query)
+except Exception as e:
+    st.error(f"Could not search patients.\n\nError: {e}")
+    st.stop()
+
+if patients_df.empty:
+    st.warning("No patient matches this search.")
+    st.stop()
+
+patients_df["label"] = patients_df.apply(
+    lambda r: f"{int(r['patient_id'])} - {r['name']} (born {r['date_of_birth']:%d.%m.%Y})", axis=1
+)
+patient_sel = st.selectbox("Patient", patients_df["label"].tolist())
+patient_id = int(patient_sel.split(" - ")[0])
+
+# Keyset cursors of the pages visited so far; reset when another patient is chosen.
+if st.session_state.get("ph_patient") != patient_id:
+    st.session_state.ph_patient = patient_id
+    st.session_state.ph_cursors = [None]
+
+# ==========================================================
+# History page
+# ==========================================================
+try:
+    page = patient_history.history(patient_id, st.session_state.ph_cursors[-1], PAGE_SIZE)
+except Exception as e:
+    st.error(f"Could not load the history.\n\nError: {e}")
+    st.stop()
+
+if page.prescriptions.empty:
+    st.info("No prescriptions on record for this patient.")
+    st.stop()
+
+dispensed = page.items.dropna(subset=["dispense_id"])
+k1, k2, k3 = st.columns(3)
+k1.metric("Prescriptions on this page", len(page.prescriptions))
+k2.metric("Items dispensed", len(dispensed))
+k3.metric("Open balance on this page (€)", f"{dispensed.drop_duplicates('dispense_id')['remaining'].sum():.2f}")
+
+for _, rx in page.prescriptions.iterrows():
+    rx_items = page.items[page.items["rx_id"] == rx["rx_id"]]
+    with st.expander(
+        f"Rx {int(rx['rx_id'])} | {rx['rx_date']:%d.%m.%Y} | {rx['status']} | Dr. {rx['doctor'] or '-'}",
+        expanded=False,
+    ):
+        st.caption(f"Urgency: {rx['urgency'] or '-'} | Pharmacist: {rx['pharmacist'] or '-'}")
+        st.dataframe(
+            rx_items.drop(columns=["rx_id"]).rename(columns={
+                "drug_id": "Drug ID", "drug_name": "Drug", "form": "Form", "strength": "Strength",
+                "qty_prescribed": "Prescribed", "dosage_instruc": "Dosage", "frequency": "Frequency",
+                "refills_allowed": "Refills left", "dispense_id": "Dispense ID", "dispense_date": "Dispensed on",
+                "lot_batch_id": "Lot", "expiry_date": "Expiry", "qty_dispensed": "Qty dispensed",
+                "total_amount": "Total (€)", "covered_total": "Covered (€)", "remaining": "Open (€)",
+                "insurers": "Insurers", "archived": "Archived",
+            }),
+            use_container_width=True,
+            hide_index=True,
+        )
+
+p1, p2, p3 = st.columns([0.2, 0.6, 0.2], vertical_alignment="center")
+with p1:
+    if st.button("Newer", use_container_width=True, disabled=len(st.session_state.ph_cursors) == 1):
+        st.session_state.ph_cursors.pop()
+        st.rerun()
+with p2:
+    st.caption(f"Page {len(st.session_state.ph_cursors)} ({PAGE_SIZE} prescriptions per page)")
+with p3:
+    if st.button("Older", use_container_width=True, disabled=page.next_cursor is None):
+        st.session_state.ph_cursors.append(page.next_cursor)
+        st.rerun()
+
+profiler.finish()
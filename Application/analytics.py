@@ -0,0 +1,429 @@
+"""
+Embedded columnar analytics mirror (DuckDB).
+
+The 15 operational tables are copied into a local DuckDB file so that the
+aggregate reports (SQL_Queries.md) and Dashboard charts run on a columnar
+engine instead of competing with dispensing on PostgreSQL.
+
+The first sync installs the CHANGE_LOG triggers (see
+SQL_Scripts/Performance_Script.sql section 1) and copies every table. After
+that only rows listed in CHANGE_LOG are re-fetched by primary key and
+replaced in the mirror, and the applied part of the log is deleted, so
+there is one mirror per database. Without ANALYTICS_DB no triggers are
+installed and nothing is logged.
+
+Rows moved to the Parquet archive (archive.py) stay in the mirror: the
+archiver's deletes are not logged, and a full copy loads the archive too.
+
+Set ANALYTICS_DB to the DuckDB file path to enable the mirror. `query()`
+answers from the mirror at once and, when it is older than
+ANALYTICS_MAX_LAG_SECONDS, starts a sync in a background thread. Without
+ANALYTICS_DB, `query()` runs against PostgreSQL and sees live rows only;
+reports that should include archived history need the mirror
+(`excludes_archive()` tells the page when they are missing it).
+
+Usage:
+    python analytics.py sync
+    python analytics.py rebuild           # full copy, e.g. after a schema change
+    python analytics.py disable           # drop the triggers and empty CHANGE_LOG
+"""
+import argparse
+import decimal
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+
+import archive
+from db import get_connection, run_query
+
+ANALYTICS_DB = os.getenv("ANALYTICS_DB")
+ANALYTICS_MAX_LAG_SECONDS = int(os.getenv("ANALYTICS_MAX_LAG_SECONDS", "120"))
+
+# Table -> primary key columns (with their PostgreSQL types, for jsonb_to_recordset).
+MIRRORED_TABLES = {
+    "doctor": {"doctor_id": "INT"},
+    "patient": {"patient_id": "INT"},
+    "pharmacist": {"pharmacist_id": "INT"},
+    "insurance": {"policy_id": "INT"},
+    "supplier": {"supplier_id": "INT"},
+    "generics": {"drug_name": "VARCHAR"},
+    "drug_catalogue": {"drug_id": "INT"},
+    "inventory_lot": {"lot_batch_id": "INT"},
+    "prescription": {"rx_id": "INT"},
+    "prescription_items": {"rx_id": "INT", "drug_id": "INT"},
+    "dispense": {"dispense_id": "INT"},
+    "dispensed_items": {"line_item_id": "INT"},
+    "purchase_order": {"order_id": "INT"},
+    "purchase_order_item": {"product_id": "INT", "drug_id": "INT"},
+    "pays": {"dispense_id": "INT", "policy_id": "INT"},
+}
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()        # one sync at a time
+_open_lock = threading.Lock()   # the shared connection and the sync thread
+_duck = None
+_last_sync = 0.0
+_sync_thread = None
+
+
+def _duckdb():
+    """
+    One DuckDB connection per process. Each caller works on its own
+    .cursor() of it, so reports keep reading the last committed state while
+    a sync writes.
+    """
+    global _duck
+    with _open_lock:
+        if _duck is None:
+            import duckdb
+            _duck = duckdb.connect(ANALYTICS_DB)
+            _duck.execute("CREATE TABLE IF NOT EXISTS _sync_state (boundary VARCHAR, synced_at TIMESTAMP);")
+        return _duck
+
+
+def _decimals_to_float(df: pd.DataFrame) -> pd.DataFrame:
+    """NUMERIC columns as floats (DuckDB cannot scan Decimal objects)."""
+    for col in df.columns:
+        first = df[col].dropna().head(1)
+        if not first.empty and isinstance(first.iloc[0], decimal.Decimal):
+            df[col] = df[col].astype(float)
+    return df
+
+
+def _fetch_frame(cur, q, params=None) -> pd.DataFrame:
+    cur.execute(q, params)
+    columns = [desc[0] for desc in cur.description]
+    return _decimals_to_float(pd.DataFrame(cur.fetchall(), columns=columns))
+
+
+def _load_archive(duck, table):
+    """Append the archived rows of `table` to the DuckDB table of the same name."""
+    if table not in archive.ARCHIVE_TABLES or not archive.has_archive(table):
+        return
+    columns = ", ".join(duck.table(table).columns)
+    pattern = os.path.join(archive.ARCHIVE_DIR, table, "**", "*.parquet").replace("'", "''")
+    duck.execute(
+        f"""
+        INSERT INTO {table} BY NAME
+        SELECT {columns} FROM read_parquet('{pattern}', hive_partitioning = true, union_by_name = true);
+        """
+    )
+
+
+def _archived_rows(duck, table, pk, key_df) -> pd.DataFrame:
+    """Rows of `key_df` that are in the archive, with the mirror's columns."""
+    first = next(iter(pk))
+    found = archive.read_archive(table, filters=[(first, "in", key_df[first].tolist())])
+    if found.empty:
+        return found
+    found = found.merge(key_df, on=list(pk))
+    return _decimals_to_float(found[duck.table(table).columns])
+
+
+# =====================================================================
+# Change tracking (CHANGE_LOG triggers)
+# =====================================================================
+def install_tracking(conn):
+    """Create the CHANGE_LOG trigger on every mirrored table, in one transaction."""
+    with conn.cursor() as cur:
+        for table, pk in MIRRORED_TABLES.items():
+            key_args = ", ".join(f"'{col}'" for col in pk)
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_track_{table} ON {table};")
+            cur.execute(
+                f"""
+                CREATE TRIGGER trg_track_{table} AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION track_row_change({key_args});
+                """
+            )
+    conn.commit()
+
+
+def uninstall_tracking(conn):
+    """Drop the CHANGE_LOG triggers and empty the log, for a database that no longer has a mirror."""
+    with conn.cursor() as cur:
+        for table in MIRRORED_TABLES:
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_track_{table} ON {table};")
+        cur.execute("TRUNCATE change_log;")
+    conn.commit()
+
+
+# =====================================================================
+# Sync
+# =====================================================================
+def _full_copy(cur, duck):
+    for table in MIRRORED_TABLES:
+        df = _fetch_frame(cur, f"SELECT * FROM {table};")
+        duck.register("incoming", df)
+        duck.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM incoming;")
+        duck.unregister("incoming")
+        _load_archive(duck, table)
+
+
+def _apply_changes(cur, duck, lower, upper) -> int:
+    cur.execute(
+        """
+        SELECT DISTINCT table_name, row_key::text
+        FROM change_log
+        WHERE txid >= %s::xid8 AND txid < %s::xid8;
+        """,
+        (lower, upper),
+    )
+    keys_by_table = {}
+    for table, key in cur.fetchall():
+        keys_by_table.setdefault(table, []).append(json.loads(key))
+
+    for table, keys in keys_by_table.items():
+        pk = MIRRORED_TABLES.get(table)
+        if pk is None:
+            continue
+        key_cols = ", ".join(pk)
+        key_defs = ", ".join(f"{col} {typ}" for col, typ in pk.items())
+
+        # Current state of every touched row; rows that were deleted simply do not come back.
+        rows = _fetch_frame(
+            cur,
+            f"""
+            SELECT t.*
+            FROM {table} t
+            JOIN jsonb_to_recordset(%s::jsonb) AS k({key_defs}) USING ({key_cols});
+            """,
+            (json.dumps(keys),),
+        )
+        key_df = pd.DataFrame(keys, columns=list(pk))
+        if table in archive.ARCHIVE_TABLES:
+            # Changed and then archived before this sync: gone from PostgreSQL, but not deleted.
+            moved = _archived_rows(duck, table, pk, key_df)
+            if not moved.empty:
+                rows = pd.concat([rows, moved], ignore_index=True)
+        match = " AND ".join(f"{table}.{col} = k.{col}" for col in pk)
+
+        duck.register("changed_keys", key_df)
+        duck.register("incoming", rows)
+        duck.execute(f"DELETE FROM {table} USING changed_keys k WHERE {match};")
+        if not rows.empty:
+            duck.execute(f"INSERT INTO {table} BY NAME SELECT * FROM incoming;")
+        duck.unregister("changed_keys")
+        duck.unregister("incoming")
+
+    return sum(len(k) for k in keys_by_table.values())
+
+
+def sync(rebuild: bool = False) -> int:
+    """
+    Bring the mirror up to date and delete the CHANGE_LOG rows it has applied.
+    Returns the number of changed keys applied (-1 for a full copy).
+    """
+    global _last_sync
+    with _lock:
+        duck = _duckdb().cursor()
+        state = duck.execute("SELECT boundary FROM _sync_state;").fetchone()
+        lower = None if rebuild or state is None else state[0]
+
+        conn = get_connection()
+        try:
+            if lower is None:
+                # CREATE TRIGGER waits for running writes on each table, so every
+                # change after the boundary below is logged.
+                install_tracking(conn)
+            with conn.cursor() as cur:
+                # Every transaction below this id has finished, so its changes are final.
+                cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text;")
+                upper = cur.fetchone()[0]
+
+                duck.execute("BEGIN;")
+                try:
+                    if lower is None:
+                        _full_copy(cur, duck)
+                        applied = -1
+                    else:
+                        applied = _apply_changes(cur, duck, lower, upper)
+                    duck.execute("DELETE FROM _sync_state;")
+                    duck.execute("INSERT INTO _sync_state VALUES (?, now());", [upper])
+                    duck.execute("COMMIT;")
+                except Exception:
+                    duck.execute("ROLLBACK;")
+                    raise
+
+                cur.execute("DELETE FROM change_log WHERE txid < %s::xid8;", (upper,))
+            conn.commit()
+        finally:
+            conn.close()
+            duck.close()
+
+        _last_sync = time.monotonic()
+        return applied
+
+
+def _sync_quietly():
+    try:
+        sync()
+    except Exception:
+        log.exception("analytics mirror sync failed")
+
+
+def _sync_in_background():
+    """Start a sync thread unless one is already running."""
+    global _sync_thread
+    with _open_lock:
+        if _sync_thread is not None and _sync_thread.is_alive():
+            return
+        _sync_thread = threading.Thread(target=_sync_quietly, name="analytics-sync", daemon=True)
+        _sync_thread.start()
+
+
+# =====================================================================
+# Query routing
+# =====================================================================
+def _referenced_tables(q) -> list:
+    return [t for t in MIRRORED_TABLES if re.search(rf"\b{t}\b", q, re.IGNORECASE)]
+
+
+def excludes_archive(q) -> bool:
+    """Whether `query(q)` leaves out archived rows: no mirror, and the query reads an archived table."""
+    if ANALYTICS_DB:
+        return False
+    return any(t in archive.ARCHIVE_TABLES and archive.has_archive(t) for t in _referenced_tables(q))
+
+
+def query(q) -> pd.DataFrame:
+    """
+    Run a read-only reporting query on the mirror. If the mirror is older than
+    ANALYTICS_MAX_LAG_SECONDS a sync starts in the background and this query
+    is answered from the mirror as it is; only a mirror that was never synced
+    is filled first. Falls back to PostgreSQL (live rows only) when the mirror
+    is disabled, so report SQL is kept parameter-free and portable.
+    """
+    if not ANALYTICS_DB:
+        return run_query(q)
+
+    duck = _duckdb().cursor()
+    try:
+        if duck.execute("SELECT boundary FROM _sync_state;").fetchone() is None:
+            sync()
+        elif time.monotonic() - _last_sync > ANALYTICS_MAX_LAG_SECONDS:
+            _sync_in_background()
+        return duck.execute(q).df()
+    finally:
+        duck.close()
+
+
+def engine_name() -> str:
+    return "DuckDB mirror" if ANALYTICS_DB else "PostgreSQL"
+
+
+# Reports from SQL_Queries.md, written in SQL both DuckDB and PostgreSQL accept.
+REPORTS = {
+    "Query 4 - Average dispense amount per pharmacist": """
+        SELECT pharmacist_id, AVG(total_amount) AS avg_amount
+        FROM dispense
+        GROUP BY pharmacist_id
+        ORDER BY pharmacist_id;
+    """,
+    "Query 5 - Total quantity dispensed per drug": """
+        SELECT dc.drug_name, SUM(di.qty_dispensed) AS total_quantity
+        FROM drug_catalogue dc
+        JOIN inventory_lot il ON dc.drug_id = il.drug_id
+        JOIN dispensed_items di ON il.lot_batch_id = di.lot_batch_id
+        GROUP BY dc.drug_name
+        ORDER BY total_quantity DESC;
+    """,
+    "Query 6 - Pharmacists earning above average": """
+        SELECT name, salary_pa
+        FROM pharmacist
+        WHERE salary_pa > (SELECT AVG(salary_pa) FROM pharmacist)
+        ORDER BY salary_pa DESC;
+    """,
+    "Query 10 - Total quantity prescribed per patient": """
+        SELECT pa.patient_id, pa.name, SUM(pi.qty_prescribed) AS total_qty_prescribed
+        FROM patient pa
+        JOIN prescription pr ON pa.patient_id = pr.patient_id
+        JOIN prescription_items pi ON pr.rx_id = pi.rx_id
+        GROUP BY pa.patient_id, pa.name
+        ORDER BY total_qty_prescribed DESC;
+    """,
+    "Query 12 - Patients seen by more doctors than average": """
+        SELECT pa.patient_id, pa.name, COUNT(DISTINCT pr.doctor_id) AS doctor_count
+        FROM patient pa
+        JOIN prescription pr ON pa.patient_id = pr.patient_id
+        GROUP BY pa.patient_id, pa.name
+        HAVING COUNT(DISTINCT pr.doctor_id) > (
+            SELECT AVG(sub.doctor_count)
+            FROM (
+                SELECT COUNT(DISTINCT doctor_id) AS doctor_count
+                FROM prescription
+                GROUP BY patient_id
+            ) sub
+        );
+    """,
+    "Query 14 - Line items of PENDING orders": """
+        SELECT po.order_id, s.company_name, poi.drug_id, poi.qty_ordered, poi.unit_cost
+        FROM purchase_order po
+        JOIN supplier s ON s.supplier_id = po.supplier_id
+        JOIN purchase_order_item poi ON poi.product_id = po.order_id
+        WHERE po.status = 'PENDING'
+        ORDER BY po.order_id;
+    """,
+    "Query 15 - Overdue orders": """
+        SELECT po.order_id, s.company_name, po.expected_delivery_date, po.status
+        FROM purchase_order po
+        JOIN supplier s ON s.supplier_id = po.supplier_id
+        WHERE po.expected_delivery_date < CURRENT_DATE
+          AND po.status <> 'DELIVERED'
+        ORDER BY po.expected_delivery_date ASC;
+    """,
+    "Query 16 - Average unit cost per supplier per drug": """
+        SELECT s.supplier_id, s.company_name, poi.drug_id, AVG(poi.unit_cost) AS avg_unit_cost
+        FROM supplier s
+        JOIN purchase_order po ON po.supplier_id = s.supplier_id
+        JOIN purchase_order_item poi ON poi.product_id = po.order_id
+        GROUP BY s.supplier_id, s.company_name, poi.drug_id
+        ORDER BY s.supplier_id, poi.drug_id;
+    """,
+    "Query 18 - Pending orders with stock info": """
+        SELECT po.order_id, poi.drug_id, poi.qty_ordered, il.qty_on_hand
+        FROM purchase_order po
+        JOIN purchase_order_item poi ON poi.product_id = po.order_id
+        JOIN inventory_lot il ON il.drug_id = poi.drug_id
+        WHERE po.status = 'PENDING'
+        ORDER BY po.order_id;
+    """,
+    "Query 19 - Suppliers with more orders than average": """
+        SELECT s.supplier_id, s.company_name, COUNT(po.order_id) AS order_count
+        FROM supplier s
+        JOIN purchase_order po ON po.supplier_id = s.supplier_id
+        GROUP BY s.supplier_id, s.company_name
+        HAVING COUNT(po.order_id) > (
+            SELECT AVG(order_count)
+            FROM (
+                SELECT COUNT(order_id) AS order_count
+                FROM purchase_order
+                GROUP BY supplier_id
+            ) sub
+        );
+    """,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync the DuckDB analytics mirror.")
+    parser.add_argument("command", choices=["sync", "rebuild", "disable"])
+    args = parser.parse_args()
+
+    if args.command == "disable":
+        conn = get_connection()
+        try:
+            uninstall_tracking(conn)
+        finally:
+            conn.close()
+        print("Change tracking removed; delete the DuckDB file if it is no longer used.")
+    else:
+        if not ANALYTICS_DB:
+            parser.error("ANALYTICS_DB is not set.")
+        applied = sync(rebuild=args.command == "rebuild")
+        print("Full copy completed." if applied < 0 else f"Applied {applied} changed rows.")
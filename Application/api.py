@@ -0,0 +1,300 @@
+"""
+HTTP API over the service layer, for barcode stations, batch jobs and load tests.
+
+The service functions are blocking (psycopg), so each request runs on a
+bounded worker pool (API_WORKERS threads) with its own fresh connection;
+the event loop only parses requests and serialises results. Request and
+response bodies are the dataclasses from the services package.
+
+Usage (from Application/):
+    uvicorn api:app --host 0.0.0.0 --port 8000
+    API_WORKERS=32 uvicorn api:app --workers 4      # 4 processes x 32 DB threads
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import datetime as dt
+import functools
+import os
+from typing import List, Optional
+
+import psycopg
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+import drug_search
+import exports
+import patient_history
+import recall
+import services
+from db import get_connection
+
+API_WORKERS = int(os.getenv("API_WORKERS", "16"))
+
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api-db")
+
+app = FastAPI(title="Community Pharmacy API")
+
+
+def _call(fn, *args):
+    conn = get_connection()
+    try:
+        return fn(conn, *args)
+    finally:
+        conn.close()
+
+
+async def _run(fn, *args):
+    """Run one service call on the worker pool and map its errors to HTTP status codes."""
+    loop = asyncio.get_running_loop()
+    try:
+        # The context carries the X-Actor of the request (see _audit_actor) into the worker thread.
+        call = functools.partial(_call, fn, *args)
+        return await loop.run_in_executor(_pool, contextvars.copy_context().run, call)
+    except services.NotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except services.ServiceError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except psycopg.errors.IntegrityError as e:
+        # Duplicate IDs, foreign keys, CHECK constraints
+        raise HTTPException(status_code=409, detail=str(e).strip())
+    except psycopg.errors.RaiseException as e:
+        # Inventory triggers (expired lot, not enough stock)
+        raise HTTPException(status_code=409, detail=str(e).strip())
+
+
+@app.middleware("http")
+async def _audit_actor(request, call_next):
+    """
+    Clients name the person at the station in an X-Actor header; it is recorded in AUDIT_LOG
+    for every write. Dispenses and fills without the header fall back to their pharmacist.
+    """
+    with services.acting_as(request.headers.get("X-Actor")):
+        return await call_next(request)
+
+
+@app.on_event("startup")
+def _startup():
+    services.start_sweeper()
+    services.start_audit_drainer()
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    _pool.shutdown(wait=True)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "workers": API_WORKERS}
+
+
+# =====================================================================
+# Dispensing
+# =====================================================================
+@app.post("/dispenses", response_model=services.DispenseResult, status_code=201)
+async def create_dispense(req: services.DispenseRequest):
+    with services.acting_as(services.current_actor() or f"pharmacist {req.pharmacist_id}"):
+        result = await _run(services.dispense, req)
+    patient_history.invalidate(req.patient_id)
+    return result
+
+
+@app.delete("/dispenses/{dispense_id}", response_model=services.ReversalResult)
+async def reverse_dispense(dispense_id: int):
+    result = await _run(services.reverse_dispense, dispense_id)
+    patient_history.invalidate()
+    return result
+
+
+@app.post("/dispenses/reversals", response_model=services.BulkReversalResult)
+async def reverse_dispenses(dispense_ids: List[int]):
+    """Reverse a batch of dispenses (e.g. a recalled lot) in one transaction."""
+    result = await _run(services.reverse_dispenses, dispense_ids)
+    patient_history.invalidate()
+    return result
+
+
+@app.post("/holds/{holder}", response_model=services.Reservation, status_code=201)
+async def hold_stock(holder: str, lot_batch_id: int, qty: int):
+    """Hold stock before dispensing; pass the same holder in the DispenseRequest to consume it."""
+    return await _run(services.hold, lot_batch_id, qty, holder)
+
+
+@app.delete("/holds/{holder}")
+async def release_stock(holder: str):
+    return {"released": await _run(services.release, holder)}
+
+
+# =====================================================================
+# Pending prescription queue
+# =====================================================================
+@app.post("/queue/claim/{workstation}", response_model=Optional[services.QueueItem])
+async def claim_prescription(workstation: str):
+    """The next pending prescription for this workstation, or null when the queue is empty."""
+    return await _run(services.claim_next, workstation)
+
+
+@app.post("/queue/{rx_id}/heartbeat/{workstation}")
+async def heartbeat(rx_id: int, workstation: str):
+    if not await _run(services.heartbeat, rx_id, workstation):
+        raise HTTPException(status_code=409, detail=f"Claim on prescription {rx_id} was lost.")
+    return {"rx_id": rx_id, "workstation": workstation}
+
+
+@app.delete("/queue/{rx_id}/claim/{workstation}")
+async def release_prescription(rx_id: int, workstation: str):
+    return {"released": await _run(services.release_claim, rx_id, workstation)}
+
+
+@app.post("/queue/{rx_id}/fill/{workstation}", response_model=services.FillResult, status_code=201)
+async def fill_prescription(rx_id: int, workstation: str, pharmacist_id: int):
+    with services.acting_as(services.current_actor() or f"pharmacist {pharmacist_id}"):
+        result = await _run(services.fill_claimed, rx_id, workstation, pharmacist_id)
+    patient_history.invalidate()
+    return result
+
+
+# =====================================================================
+# Drug search
+# =====================================================================
+@app.get("/drugs/search")
+def search_drugs(q: str = "", limit: int = Query(drug_search.DRUG_SEARCH_LIMIT, ge=1, le=100)):
+    """Best matches by brand name, generic name, form or strength (cached per process)."""
+    return drug_search.search(q, limit).to_dict(orient="records")
+
+
+# =====================================================================
+# Patient history
+# =====================================================================
+def _records(df):
+    # SQL NULLs (e.g. an item never dispensed) as null rather than NaN, which JSON cannot carry.
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+
+@app.get("/patients/search")
+def search_patients(q: str, limit: int = Query(20, ge=1, le=100)):
+    return _records(patient_history.find_patients(q, limit))
+
+
+@app.get("/patients/{patient_id}/history")
+def patient_medication_history(
+    patient_id: int,
+    before_date: Optional[dt.date] = None,
+    before_rx: Optional[int] = None,
+    limit: int = Query(patient_history.PATIENT_HISTORY_PAGE_SIZE, ge=1, le=100),
+):
+    """
+    Prescriptions newest first, each with its items, dispensed lots and insurance cover.
+    Pass the returned `next` as before_date / before_rx for the next, older page.
+    """
+    if (before_date is None) != (before_rx is None):
+        raise HTTPException(status_code=422, detail="Pass both before_date and before_rx, or neither.")
+    cursor = (before_date, before_rx) if before_date is not None else None
+    page = patient_history.history(patient_id, cursor, limit)
+    items = collections.defaultdict(list)
+    for item in _records(page.items):
+        items[item["rx_id"]].append(item)
+    return {
+        "patient_id": patient_id,
+        "prescriptions": [dict(rx, items=items[rx["rx_id"]]) for rx in _records(page.prescriptions)],
+        "next": {"before_date": page.next_cursor[0], "before_rx": page.next_cursor[1]} if page.next_cursor else None,
+    }
+
+
+# =====================================================================
+# Recalls
+# =====================================================================
+@app.get("/recalls/trace.csv")
+def recall_trace(lot_ids: List[int] = Query(...), include_archive: bool = True):
+    """Every dispensed item from the lots, with patient, streamed as CSV straight from a server-side cursor."""
+    return StreamingResponse(
+        recall.iter_csv(lot_ids, include_archive),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=recall-trace.csv"},
+    )
+
+
+@app.post("/recalls/quarantine", response_model=services.QuarantineResult)
+async def quarantine(lot_ids: List[int], reason: Optional[str] = None):
+    return await _run(services.quarantine_lots, lot_ids, reason)
+
+
+# =====================================================================
+# Exports
+# =====================================================================
+@app.get("/exports/{name}.csv")
+def export_csv(
+    name: str,
+    date_from: Optional[dt.date] = None,
+    date_to: Optional[dt.date] = None,
+    status: List[str] = Query(default=[]),
+    include_archive: bool = True,
+    excel: bool = False,
+):
+    """A history table as CSV, streamed from COPY ... TO STDOUT (see exports.py)."""
+    if name not in exports.EXPORTS:
+        raise HTTPException(status_code=404, detail=f"Unknown export '{name}'")
+    try:
+        chunks = exports.export(name, date_from, date_to, status, include_archive, excel)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return StreamingResponse(
+        chunks,
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={name}.csv"},
+    )
+
+
+# =====================================================================
+# Purchase orders
+# =====================================================================
+@app.post("/orders", response_model=services.OrderResult, status_code=201)
+async def create_order(req: services.OrderRequest):
+    return await _run(services.create_order, req)
+
+
+@app.patch("/orders/{order_id}", response_model=services.OrderResult)
+async def revise_order(order_id: int, revision: services.OrderRevision):
+    return await _run(services.revise_order, order_id, revision)
+
+
+@app.post("/orders/{order_id}/cancel", response_model=services.OrderResult)
+async def cancel_order(order_id: int):
+    return await _run(services.cancel_order, order_id)
+
+
+# =====================================================================
+# Insurance
+# =====================================================================
+@app.get("/dispenses/{dispense_id}/coverage")
+async def get_coverage(dispense_id: int):
+    result = await _run(services.coverage, dispense_id)
+    return {
+        "dispense_id": result.dispense_id, "total_amount": result.total_amount,
+        "covered": result.covered, "remaining": result.remaining,
+    }
+
+
+@app.post("/dispenses/{dispense_id}/payments/{policy_id}", response_model=services.PaymentResult, status_code=201)
+async def record_payment(dispense_id: int, policy_id: int, amount: float):
+    result = await _run(services.record_payment, dispense_id, policy_id, amount)
+    patient_history.invalidate()
+    return result
+
+
+@app.delete("/dispenses/{dispense_id}/payments/{policy_id}", response_model=services.PaymentResult)
+async def undo_payment(dispense_id: int, policy_id: int):
+    result = await _run(services.undo_payment, dispense_id, policy_id)
+    patient_history.invalidate()
+    return result
+
+
+@app.post("/insurance/{policy_id}/remittances", response_model=services.RemittanceResult)
+async def import_remittance(policy_id: int, lines: List[services.RemittanceLine], dry_run: bool = False):
+    """Apply a whole remittance in one transaction; rejected lines come back as exceptions."""
+    result = await _run(services.import_remittance, policy_id, lines, dry_run)
+    if not dry_run:
+        patient_history.invalidate()
+    return result
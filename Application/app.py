@@ -1,12 +1,18 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-from db import get_connection
+from async_db import run_queries
+import analytics
+import profiler
+from lazy_imports import lazy_import
+
+# Plotly is only loaded when the first chart is drawn, after the header and KPI cards are on screen.
+px = lazy_import("plotly.express")
 
 # =====================================================================
 # UI INITIALIZATION & CSS
 # =====================================================================
 st.set_page_config(page_title="Pharmacy DBMS", layout="wide", initial_sidebar_state="expanded")
+profiler.start("app")
 
 st.markdown(
     """
@@ -89,51 +95,56 @@ st.divider()
 # =====================================================================
 @st.cache_data(ttl=60)
 def fetch_landing_page_data():
-    conn = get_connection()
     try:
-        kpi_df = pd.read_sql("""
-            SELECT 
-                (SELECT COUNT(*) FROM PATIENT) AS total_patients,
-                (SELECT COUNT(*) FROM PURCHASE_ORDER WHERE Status = 'PENDING') AS pending_orders,
-                (SELECT COUNT(*) FROM INVENTORY_LOT WHERE Qty_on_hand < 100) AS low_stock_items,
-                (SELECT COUNT(*) FROM prescription) AS total_prescriptions
-        """, conn)
+        # KPI counts and recent prescriptions are independent reads, so they run concurrently.
+        frames = run_queries({
+            "kpis": ("""
+                SELECT 
+                    (SELECT COUNT(*) FROM PATIENT) AS total_patients,
+                    (SELECT COUNT(*) FROM PURCHASE_ORDER WHERE Status = 'PENDING') AS pending_orders,
+                    (SELECT COUNT(*) FROM DRUG_STOCK_SUMMARY WHERE Usable_on_hand < Reorder_level) AS low_stock_items,
+                    (SELECT COUNT(*) FROM prescription) AS total_prescriptions
+            """, None),
+            "recent_rx": ("""
+                SELECT 
+                    rx_id AS "Rx ID",
+                    rx_date AS "Date",
+                    urgency AS "Urgency",
+                    status AS "Status"
+                FROM prescription
+                ORDER BY rx_date DESC, rx_id DESC
+                LIMIT 5;
+            """, None),
+            # Per drug: usable (unexpired) stock against the drug's own reorder level.
+            "stock_status": ("""
+                SELECT 
+                    CASE 
+                        WHEN Usable_on_hand < Reorder_level THEN 'Low Stock'
+                        ELSE 'Healthy Stock'
+                    END AS stock_status,
+                    COUNT(*) as count
+                FROM DRUG_STOCK_SUMMARY
+                GROUP BY stock_status;
+            """, None),
+        })
         
-        orders_df = pd.read_sql("""
-            SELECT Status, COUNT(*) as count 
+        # The order chart aggregate runs on the analytics mirror (DuckDB) when it is enabled.
+        orders_df = analytics.query("""
+            SELECT status, COUNT(*) as count 
             FROM PURCHASE_ORDER 
-            GROUP BY Status;
-        """, conn)
-        
-        inventory_df = pd.read_sql("""
-            SELECT 
-                CASE 
-                    WHEN Qty_on_hand < 100 THEN 'Low Stock'
-                    ELSE 'Healthy Stock'
-                END AS Stock_Status,
-                COUNT(*) as count
-            FROM INVENTORY_LOT
-            GROUP BY Stock_Status;
-        """, conn)
+            GROUP BY status;
+        """)
         
-        recent_rx_df = pd.read_sql("""
-            SELECT 
-                rx_id AS "Rx ID",
-                rx_date AS "Date",
-                urgency AS "Urgency",
-                status AS "Status"
-            FROM prescription
-            ORDER BY rx_date DESC, rx_id DESC
-            LIMIT 5;
-        """, conn)
-        
-        return kpi_df.iloc[0], orders_df, inventory_df, recent_rx_df
+        return frames["kpis"].iloc[0], orders_df, frames["stock_status"], frames["recent_rx"]
         
     except Exception as e:
         st.error(f"Failed to fetch live database metrics: {e}")
         return None, pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
 
-kpis, orders_data, inventory_data, recent_rx_df = fetch_landing_page_data()
+profiler.mark("load data")
+with st.spinner("Loading live metrics..."):
+    kpis, orders_data, inventory_data, recent_rx_df = fetch_landing_page_data()
+profiler.mark("kpi cards")
 
 # =====================================================================
 # LIVE KPI CARDS
@@ -232,7 +243,7 @@ if kpis is not None:
                 <div class='card-title'>
                     Low Stock Alerts 
                     <div class="custom-tooltip">&#9432;
-                        <span class="tooltip-text">Inventory lots where the quantity on hand has dropped below 100 units.</span>
+                        <span class="tooltip-text">Drugs whose usable (unexpired) stock across all lots is below their reorder level.</span>
                     </div>
                 </div>
                 <div class='card-value'>{kpis['low_stock_items']}</div>
@@ -257,6 +268,7 @@ st.markdown("<br>", unsafe_allow_html=True)
 # =====================================================================
 # CHARTS & RECENT ACTIVITY LAYOUT
 # =====================================================================
+profiler.mark("charts & recent activity")
 left_col, right_col = st.columns([2, 1])
 
 with left_col:
@@ -317,4 +329,6 @@ with right_col:
 # =====================================================================
 # FOOTER
 # =====================================================================
-st.markdown("<div class='footer'>© 2026 Database Management Systems Group Project. Academic Use Only.</div>", unsafe_allow_html=True)
\ No newline at end of file
+st.markdown("<div class='footer'>© 2026 Database Management Systems Group Project. Academic Use Only.</div>", unsafe_allow_html=True)
+
+profiler.finish()
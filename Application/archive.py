@@ -0,0 +1,300 @@
+"""
+Archival of closed history to Parquet.
+
+Completed dispenses (with their line items and insurance payments) and
+DELIVERED / CANCELLED purchase orders older than the retention window are
+moved out of PostgreSQL into compressed Parquet files partitioned by month:
+
+    <ARCHIVE_DIR>/<table>/month=YYYY-MM/batch-<timestamp>-0.parquet
+
+Rows are only deleted from the live tables after their files have been
+written, inside the same transaction, so a failure leaves both sides intact.
+The archiver's deletes run as the pharmacy_archiver role with
+`pharmacy.archiving` set, which the CHANGE_LOG and audit triggers skip
+(Performance_Script.sql section 13), so the analytics mirror (analytics.py)
+keeps the archived rows.
+The same transaction raises ARCHIVE_HIGH_WATER to the highest archived IDs,
+which services.next_id allocates above.
+History views read through `read_history()` / `archived_dispense()`, which
+use column pruning and predicate pushdown.
+
+Usage:
+    python archive.py --retention-days 365
+    python archive.py --dry-run
+"""
+import argparse
+import datetime as dt
+import os
+
+import pandas as pd
+
+from db import get_connection, run_query
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"))
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+
+# Every archived table is partitioned by the month of its parent's date column.
+ARCHIVE_TABLES = {
+    "dispense": "dispense_date",
+    "dispensed_items": "dispense_date",
+    "pays": "dispense_date",
+    "purchase_order": "order_date",
+    "purchase_order_item": "order_date",
+}
+
+# Tables whose application-assigned IDs (services/common.py next_id) must not be reused once archived.
+ARCHIVE_IDS = {
+    "dispense": "dispense_id",
+    "dispensed_items": "line_item_id",
+    "purchase_order": "order_id",
+}
+
+
+# =====================================================================
+# Archiver (write path)
+# =====================================================================
+_SELECT_CLOSED = {
+    # Parents are locked so a reversal or revision cannot race the archiver.
+    "dispense": """
+        SELECT d.*
+        FROM dispense d
+        WHERE d.dispense_date < %s
+        ORDER BY d.dispense_id
+        FOR UPDATE;
+    """,
+    "dispensed_items": """
+        SELECT di.*, d.dispense_date
+        FROM dispensed_items di
+        JOIN dispense d ON di.dispense_id = d.dispense_id
+        WHERE d.dispense_date < %s;
+    """,
+    "pays": """
+        SELECT p.*, d.dispense_date
+        FROM pays p
+        JOIN dispense d ON p.dispense_id = d.dispense_id
+        WHERE d.dispense_date < %s;
+    """,
+    "purchase_order": """
+        SELECT po.*
+        FROM purchase_order po
+        WHERE po.order_date < %s
+          AND po.status IN ('DELIVERED', 'CANCELLED')
+        ORDER BY po.order_id
+        FOR UPDATE;
+    """,
+    "purchase_order_item": """
+        SELECT poi.*, po.order_date
+        FROM purchase_order_item poi
+        JOIN purchase_order po ON poi.product_id = po.order_id
+        WHERE po.order_date < %s
+          AND po.status IN ('DELIVERED', 'CANCELLED');
+    """,
+}
+
+# Child -> parent, same order as Transaction 2 in Transactions.sql.
+# Deleting dispensed_items does NOT touch stock: there is no DELETE trigger,
+# and archived dispenses stay dispensed.
+_DELETE_CLOSED = [
+    "DELETE FROM pays p USING dispense d WHERE p.dispense_id = d.dispense_id AND d.dispense_date < %s;",
+    "DELETE FROM dispensed_items di USING dispense d WHERE di.dispense_id = d.dispense_id AND d.dispense_date < %s;",
+    "DELETE FROM dispense WHERE dispense_date < %s;",
+    """DELETE FROM purchase_order_item poi USING purchase_order po
+       WHERE poi.product_id = po.order_id AND po.order_date < %s AND po.status IN ('DELIVERED', 'CANCELLED');""",
+    "DELETE FROM purchase_order WHERE order_date < %s AND status IN ('DELIVERED', 'CANCELLED');",
+]
+
+
+def _write_partitions(table: str, df: pd.DataFrame, stamp: str) -> list:
+    """Write one table's rows as zstd Parquet, one directory per month. Returns files written."""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    date_col = ARCHIVE_TABLES[table]
+    df = df.copy()
+    df["month"] = pd.to_datetime(df[date_col]).dt.strftime("%Y-%m")
+
+    written = []
+    ds.write_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        os.path.join(ARCHIVE_DIR, table),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive"),
+        basename_template=f"batch-{stamp}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        file_visitor=lambda f: written.append(f.path),
+    )
+    return written
+
+
+def archive_closed_records(retention_days: int = ARCHIVE_RETENTION_DAYS, dry_run: bool = False) -> dict:
+    """Move closed records older than the retention window into Parquet. Returns row counts per table."""
+    cutoff = dt.date.today() - dt.timedelta(days=retention_days)
+    stamp = dt.datetime.now().strftime("%Y%m%dT%H%M%S")
+    written = []
+    counts = {}
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            frames = {}
+            for table, q in _SELECT_CLOSED.items():
+                cur.execute(q, (cutoff,))
+                columns = [desc[0] for desc in cur.description]
+                frames[table] = pd.DataFrame(cur.fetchall(), columns=columns)
+                counts[table] = len(frames[table])
+
+            if dry_run:
+                conn.rollback()
+                return counts
+
+            for table, df in frames.items():
+                if not df.empty:
+                    written += _write_partitions(table, df, stamp)
+
+            # Moved, not deleted: CHANGE_LOG must not tell the analytics mirror to drop these rows.
+            cur.execute("SELECT set_config('pharmacy.archiving', 'on', true);")
+            # The triggers only honour the setting for this role; it ends with the transaction.
+            cur.execute("SET LOCAL ROLE pharmacy_archiver;")
+            for q in _DELETE_CLOSED:
+                cur.execute(q, (cutoff,))
+            _record_high_water(cur)
+
+        conn.commit()
+        return counts
+
+    except Exception:
+        conn.rollback()
+        # The rows are still live, so the half-written batch must not be read back.
+        for path in written:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        conn.close()
+
+
+def _record_high_water(cur):
+    """Store the highest archived ID per table in ARCHIVE_HIGH_WATER (Performance_Script.sql section 12)."""
+    for table, col in ARCHIVE_IDS.items():
+        # Read back from the files (this batch is already written), so archives
+        # written before the marks existed are counted too.
+        if not has_archive(table):
+            continue
+        top = read_archive(table, columns=[col])[col].max()
+        if pd.notna(top):
+            cur.execute(
+                """
+                INSERT INTO archive_high_water (table_name, max_id) VALUES (%s, %s)
+                ON CONFLICT (table_name) DO UPDATE SET max_id = GREATEST(archive_high_water.max_id, EXCLUDED.max_id);
+                """,
+                (table, int(top)),
+            )
+
+
+# =====================================================================
+# Transparent read path
+# =====================================================================
+def _month_filters(table: str, filters: list) -> list:
+    """Derive partition filters from date filters so whole months are skipped."""
+    date_col = ARCHIVE_TABLES[table]
+    extra = []
+    for col, op, value in filters:
+        if col == date_col and isinstance(value, dt.date) and op in (">", ">=", "<", "<=", "=="):
+            month = value.strftime("%Y-%m")
+            extra.append(("month", {">": ">=", "<": "<="}.get(op, op), month))
+    return extra
+
+
+def has_archive(table: str) -> bool:
+    """True if at least one Parquet file has been written for `table`."""
+    path = os.path.join(ARCHIVE_DIR, table)
+    return os.path.isdir(path) and any(f.endswith(".parquet") for _, _, files in os.walk(path) for f in files)
+
+
+def _scan(table: str, filters):
+    """(dataset, filter expression) for one archived table, or (None, None) if nothing is archived."""
+    path = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(path):
+        return None, None
+
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    filters = list(filters or [])
+    filters += _month_filters(table, filters)
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    return dataset, pq.filters_to_expression(filters) if filters else None
+
+
+def read_archive(table: str, columns=None, filters=None) -> pd.DataFrame:
+    """Read archived rows of one table, pruning columns and pushing filters down to Parquet."""
+    dataset, expression = _scan(table, filters)
+    if dataset is None:
+        return pd.DataFrame(columns=columns or [])
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def iter_archive(table: str, columns=None, filters=None, batch_rows: int = 50_000):
+    """Like read_archive(), but yield DataFrames of up to `batch_rows` rows so large ranges stream."""
+    dataset, expression = _scan(table, filters)
+    if dataset is None:
+        return
+    for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=batch_rows):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def read_history(table: str, live_query: str, params=None, columns=None, filters=None) -> pd.DataFrame:
+    """
+    Union live rows with archived rows of the same table.
+
+    `live_query` must already apply the same conditions as `filters` and
+    select `columns` in the same order; archived rows are appended below.
+    """
+    live = run_query(live_query, params=params)
+    archived = read_archive(table, columns=columns, filters=filters)
+    if archived.empty:
+        return live
+    if live.empty:
+        return archived
+    return pd.concat([live, archived[live.columns]], ignore_index=True)
+
+
+def is_archived_id(table: str, value: int) -> bool:
+    """True if an archived row of `table` (one of ARCHIVE_IDS) already uses the ID `value`."""
+    col = ARCHIVE_IDS[table]
+    return not read_archive(table, columns=[col], filters=[(col, "==", int(value))]).empty
+
+
+def archived_last_fills(rx_ids) -> dict:
+    """{rx_id: date of its latest archived dispense}, for those of `rx_ids` that have archived dispenses."""
+    rx_ids = [int(x) for x in rx_ids]
+    if not rx_ids:
+        return {}
+    df = read_archive("dispense", columns=["rx_id", "dispense_date"], filters=[("rx_id", "in", rx_ids)])
+    if df.empty:
+        return {}
+    return {int(rx_id): pd.Timestamp(day).date() for rx_id, day in df.groupby("rx_id")["dispense_date"].max().items()}
+
+
+def archived_dispense(dispense_id: int) -> dict:
+    """The archived dispense, dispensed_items and pays rows of one dispense (all empty if it is not archived)."""
+    key = [("dispense_id", "==", int(dispense_id))]
+    return {
+        "dispense": read_archive("dispense", filters=key),
+        "dispensed_items": read_archive(
+            "dispensed_items", columns=["line_item_id", "qty_dispensed", "lot_batch_id"], filters=key
+        ),
+        "pays": read_archive("pays", columns=["policy_id", "amount_covered"], filters=key),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive closed pharmacy history to Parquet.")
+    parser.add_argument("--retention-days", type=int, default=ARCHIVE_RETENTION_DAYS)
+    parser.add_argument("--dry-run", action="store_true", help="Only count the rows that would be archived.")
+    args = parser.parse_args()
+
+    for table, n in archive_closed_records(args.retention_days, args.dry_run).items():
+        print(f"{table}: {n} rows {'would be ' if args.dry_run else ''}archived")
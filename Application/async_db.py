@@ -0,0 +1,129 @@
+"""
+Concurrent read-only queries on psycopg async connections.
+
+A page that needs several independent SELECTs can hand them over in one
+call; each runs on its own connection and they are awaited together, so
+the page waits roughly as long as the slowest query instead of the sum.
+
+    frames = run_queries({
+        "patients": ("SELECT COUNT(*) AS n FROM PATIENT;", None),
+        "lots": ("SELECT * FROM INVENTORY_LOT WHERE Drug_id = %s;", (drug_id,)),
+    })
+    frames["patients"].iloc[0, 0]
+
+Connections follow the same routing as db.get_read_connection(): a healthy
+replica when DATABASE_REPLICA_URLS is set (sharing db.py's lag cache),
+otherwise the primary, or always the primary with pin_primary=True. At most
+ASYNC_MAX_CONCURRENCY queries run at once per call.
+
+`run_queries()` is the synchronous facade for Streamlit pages; async code
+(e.g. the API) can await `fetch_frames()` directly.
+"""
+import asyncio
+import concurrent.futures
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+import psycopg
+
+import db
+from instrumentation import AsyncInstrumentedCursor
+
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", "8"))
+
+
+async def _connect(url, timeout=None):
+    kwargs = {"connect_timeout": timeout} if timeout else {}
+    return await psycopg.AsyncConnection.connect(url, cursor_factory=AsyncInstrumentedCursor, **kwargs)
+
+
+async def _connect_replica(url):
+    """Async version of db._connect_replica(); updates the same health cache."""
+    checked_at, lag = db._replica_health.get(url, (0.0, 0.0))
+    stale = time.monotonic() - checked_at > db.REPLICA_CHECK_SECONDS
+    if not stale and (lag is None or lag > db.REPLICA_MAX_LAG_SECONDS):
+        return None
+
+    try:
+        conn = await _connect(url, timeout=3)
+    except psycopg.OperationalError:
+        db._replica_health[url] = (time.monotonic(), None)
+        return None
+
+    if stale:
+        async with conn.cursor() as cur:
+            await cur.execute(db._LAG_QUERY)
+            lag = float((await cur.fetchone())[0])
+        await conn.commit()
+        db._replica_health[url] = (time.monotonic(), lag)
+        if lag > db.REPLICA_MAX_LAG_SECONDS:
+            await conn.close()
+            return None
+    return conn
+
+
+async def get_read_connection(pin_primary=False):
+    """Fresh async connection for SELECT-only work (replica when healthy, else primary)."""
+    urls = db.DATABASE_REPLICA_URLS
+    if not pin_primary and urls:
+        start = random.randrange(len(urls))
+        for i in range(len(urls)):
+            conn = await _connect_replica(urls[(start + i) % len(urls)])
+            if conn is not None:
+                return conn
+    if not db.DATABASE_URL:
+        db._missing_database_url()
+    return await _connect(db.DATABASE_URL)
+
+
+async def fetch_frame(query, params=None, pin_primary=False, semaphore=None) -> pd.DataFrame:
+    """One SELECT on its own connection, returned like db.run_query() (Decimals coerced to float)."""
+    async with semaphore or asyncio.Semaphore(1):
+        conn = await get_read_connection(pin_primary=pin_primary)
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                columns = [d.name for d in cur.description]
+                rows = await cur.fetchall()
+            return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        finally:
+            await conn.close()
+
+
+async def fetch_frames(queries: dict, pin_primary=False) -> dict:
+    """Run {name: (sql, params)} concurrently and return {name: DataFrame}. The first error is raised."""
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+    names = list(queries)
+    frames = await asyncio.gather(
+        *(fetch_frame(sql, params, pin_primary=pin_primary, semaphore=semaphore) for sql, params in queries.values())
+    )
+    return dict(zip(names, frames))
+
+
+def _run(coro):
+    # psycopg's async connections need a selector loop; the Windows default (proactor) is not one.
+    if sys.platform == "win32":
+        loop = asyncio.SelectorEventLoop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+    return asyncio.run(coro)
+
+
+def run_queries(queries: dict, pin_primary=False) -> dict:
+    """
+    Synchronous facade over fetch_frames() for Streamlit pages and scripts.
+    When called from a thread that already runs an event loop, the queries
+    are awaited on a helper thread instead.
+    """
+    coro = fetch_frames(queries, pin_primary=pin_primary)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return _run(coro)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_run, coro).result()
@@ -0,0 +1,125 @@
+"""
+Audit overhead benchmark: what does auditing add to one dispense transaction?
+
+Runs --count dispenses of quantity 1 from --lot through services.dispense(),
+one after another on one connection, in three modes:
+
+    off       audit triggers disabled on the tables a dispense writes
+    unlogged  the shipped setup: triggers append to the UNLOGGED AUDIT_STAGING
+    logged    the same triggers with AUDIT_STAGING switched to a logged table,
+              i.e. what writing the audit rows synchronously to WAL would cost
+
+and prints mean / p50 / p95 latency per transaction and the overhead against
+"off", then how fast the staged rows drain into AUDIT_LOG. Every dispense is
+reversed after its mode, so the lot ends where it started. The mode
+switches use ALTER TABLE, so run it as the owner of the tables, against a
+test database, while nothing else is writing.
+
+Usage (from Application/):
+    python benchmarks/bench_audit.py --lot 3001 --count 500
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import services  # noqa: E402
+from db import get_connection  # noqa: E402
+
+# Tables a single dispense inserts into or updates.
+DISPENSE_TABLES = ("prescription", "prescription_items", "dispense", "dispensed_items", "inventory_lot")
+MODES = ("off", "unlogged", "logged")
+
+
+def _first_id(conn, table, col):
+    return conn.execute(f"SELECT MIN({col}) FROM {table};").fetchone()[0]
+
+
+def _set_mode(conn, mode):
+    action = "DISABLE" if mode == "off" else "ENABLE"
+    for table in DISPENSE_TABLES:
+        conn.execute(f"ALTER TABLE {table} {action} TRIGGER trg_audit_{table};")
+    conn.execute(f"ALTER TABLE audit_staging SET {'LOGGED' if mode == 'logged' else 'UNLOGGED'};")
+    conn.commit()
+
+
+def _staged(conn):
+    n = conn.execute("SELECT COUNT(*) FROM audit_staging;").fetchone()[0]
+    conn.commit()
+    return n
+
+
+def run_mode(conn, args, drug_id, people):
+    latencies, ids = [], []
+    for _ in range(args.count):
+        t0 = time.perf_counter()
+        result = services.dispense(conn, services.DispenseRequest(
+            pharmacist_id=people["pharmacist"],
+            patient_id=people["patient"],
+            doctor_id=people["doctor"],
+            drug_id=drug_id,
+            lot_batch_id=args.lot,
+            qty_prescribed=1,
+            qty_dispensed=1,
+        ))
+        latencies.append((time.perf_counter() - t0) * 1000)
+        ids.append(result.dispense_id)
+    return latencies, ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lot", type=int, required=True, help="inventory lot to dispense from (needs --count units)")
+    parser.add_argument("--count", type=int, default=500, help="dispenses per mode")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT drug_id FROM inventory_lot WHERE lot_batch_id = %s;", (args.lot,)).fetchone()
+        if row is None:
+            raise SystemExit(f"Lot {args.lot} does not exist.")
+        drug_id = row[0]
+        people = {
+            "pharmacist": _first_id(conn, "pharmacist", "pharmacist_id"),
+            "patient": _first_id(conn, "patient", "patient_id"),
+            "doctor": _first_id(conn, "doctor", "doctor_id"),
+        }
+        conn.commit()
+        # Start from an empty staging table so the mode switches and the drain timing see only this run.
+        services.drain_audit(conn)
+
+        print(f"{args.count} sequential dispenses per mode from lot {args.lot}\n")
+        print(f"{'mode':<10} {'mean ms':>8} {'p50':>8} {'p95':>8} {'overhead':>9} {'audit rows/tx':>14}")
+        baseline = None
+        try:
+            for mode in MODES:
+                _set_mode(conn, mode)
+                latencies, ids = run_mode(conn, args, drug_id, people)
+                rows_per_tx = _staged(conn) / args.count
+
+                mean = statistics.fmean(latencies)
+                p50 = statistics.median(latencies)
+                p95 = statistics.quantiles(latencies, n=20)[-1]
+                baseline = baseline if baseline is not None else mean
+                print(f"{mode:<10} {mean:8.2f} {p50:8.2f} {p95:8.2f} {mean - baseline:+8.2f}ms {rows_per_tx:14.1f}")
+
+                # The reversals are audited too; drain after them so the next mode starts clean.
+                services.reverse_dispenses(conn, ids)
+                staged = _staged(conn)
+                t0 = time.perf_counter()
+                services.drain_audit(conn)
+                elapsed = time.perf_counter() - t0
+                if staged:
+                    print(f"{'':<10} drained {staged} rows in {elapsed * 1000:.0f} ms ({staged / elapsed:,.0f} rows/s)")
+        finally:
+            _set_mode(conn, "unlogged")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
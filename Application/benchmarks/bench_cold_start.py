@@ -0,0 +1,124 @@
+"""
+Cold-start benchmark: import time and first paint for app.py and each page.
+
+Every measurement runs in a fresh interpreter, like the first request a
+worker serves after a deploy. For each script it reports:
+
+* import_ms      - executing the script's top-level import statements only
+                   (streamlit itself is imported beforehand and not counted),
+* first_paint_ms - from the start of the script run until the first element
+                   reaches the front end (the page title in most pages),
+* full_run_ms    - the whole first run, including database loads.
+
+The page runs use streamlit.testing AppTest, so a configured DATABASE_URL is
+needed for realistic first_paint / full_run numbers; pass --imports-only to
+measure imports without a database.
+
+Usage (from Application/):
+    python benchmarks/bench_cold_start.py
+    python benchmarks/bench_cold_start.py --repeat 7 --pages app 1_Dashboard
+    python benchmarks/bench_cold_start.py --imports-only
+"""
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# app.py plus every page, so a new page is benchmarked without touching this list.
+DEFAULT_PAGES = ["app"] + sorted(
+    name[:-3] for name in os.listdir(os.path.join(APP_DIR, "Pages")) if name.endswith(".py")
+)
+
+# Runs in the child interpreter. Prints one JSON line with the timings.
+_CHILD = r"""
+import json, sys, time
+sys.path.insert(0, {app_dir!r})
+import streamlit  # baseline, not counted
+
+imports = {imports!r}
+t0 = time.perf_counter()
+exec(compile(imports, {script!r}, "exec"), {{"__name__": "__bench__", "__file__": {script!r}}})
+result = {{"import_ms": (time.perf_counter() - t0) * 1000}}
+
+if not {imports_only!r}:
+    from streamlit.testing.v1 import AppTest
+    try:
+        import streamlit.runtime.scriptrunner_utils.script_run_context as src
+    except ImportError:  # streamlit < 1.38
+        import streamlit.runtime.scriptrunner.script_run_context as src
+
+    first = {{}}
+    original = src.ScriptRunContext.enqueue
+
+    def enqueue(self, msg):
+        if "t" not in first and msg.HasField("delta"):
+            first["t"] = time.perf_counter()
+        return original(self, msg)
+
+    src.ScriptRunContext.enqueue = enqueue
+    at = AppTest.from_file({script!r}, default_timeout={timeout!r})
+    t1 = time.perf_counter()
+    at.run()
+    end = time.perf_counter()
+    result["first_paint_ms"] = (first.get("t", end) - t1) * 1000
+    result["full_run_ms"] = (end - t1) * 1000
+    result["exception"] = at.exception[0].message if at.exception else None
+
+print(json.dumps(result))
+"""
+
+
+def _script(page):
+    return os.path.join(APP_DIR, "app.py") if page == "app" else os.path.join(APP_DIR, "Pages", f"{page}.py")
+
+
+def top_level_imports(path) -> str:
+    """Source of the script's module-level import statements, in order."""
+    with open(path) as f:
+        source = f.read()
+    tree = ast.parse(source)
+    lines = source.splitlines()
+    return "\n".join(
+        "\n".join(lines[node.lineno - 1:node.end_lineno])
+        for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+def measure(page, imports_only, timeout):
+    script = _script(page)
+    code = _CHILD.format(
+        app_dir=APP_DIR, imports=top_level_imports(script), script=script,
+        imports_only=imports_only, timeout=timeout,
+    )
+    proc = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{page}: {proc.stderr.strip().splitlines()[-1] if proc.stderr else 'failed'}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold import time and first paint of each page.")
+    parser.add_argument("--pages", nargs="+", default=DEFAULT_PAGES)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per page (median is reported).")
+    parser.add_argument("--imports-only", action="store_true", help="Skip the page runs (no database needed).")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds allowed per page run.")
+    args = parser.parse_args()
+
+    metrics = ["import_ms"] if args.imports_only else ["import_ms", "first_paint_ms", "full_run_ms"]
+    print(f"{'page':<14}" + "".join(f"{m:>16}" for m in metrics))
+    for page in args.pages:
+        runs = [measure(page, args.imports_only, args.timeout) for _ in range(args.repeat)]
+        medians = [statistics.median(r[m] for r in runs) for m in metrics]
+        print(f"{page:<14}" + "".join(f"{v:>16.1f}" for v in medians))
+        errors = {r.get("exception") for r in runs if r.get("exception")}
+        for err in errors:
+            print(f"    ! {page} raised: {err}")
+
+
+if __name__ == "__main__":
+    main()
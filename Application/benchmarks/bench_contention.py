@@ -0,0 +1,141 @@
+"""
+Contention benchmark: many counters dispensing from the same popular lot at once.
+
+Every worker thread has its own connection and repeatedly dispenses a
+quantity of 1 from --lot through services.dispense() with auto-assigned
+IDs, exactly like the Dispense page does. Afterwards the script checks that
+no update was lost: the lot's qty_on_hand must have dropped by exactly the
+number of successful dispenses. Retries (lock timeouts, deadlocks, ID
+collisions) and failures are reported per type.
+
+All dispenses created by the run are reversed at the end unless --keep is
+passed, so the lot is back where it started.
+
+Usage (from Application/):
+    python benchmarks/bench_contention.py --lot 3001 --workers 16 --per-worker 20
+    TX_LOCK_TIMEOUT_MS=200 python benchmarks/bench_contention.py --lot 3001 --workers 32
+"""
+import argparse
+import collections
+import os
+import sys
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import services  # noqa: E402
+from db import get_connection  # noqa: E402
+from services.common import reset_retry_stats  # noqa: E402
+
+
+def _first_id(conn, table, col):
+    return conn.execute(f"SELECT MIN({col}) FROM {table};").fetchone()[0]
+
+
+def _qty(conn, lot):
+    row = conn.execute(
+        "SELECT drug_id, qty_on_hand FROM inventory_lot WHERE lot_batch_id = %s;", (lot,)
+    ).fetchone()
+    conn.commit()
+    if row is None:
+        raise SystemExit(f"Lot {lot} does not exist.")
+    return row
+
+
+def worker(args, drug_id, people, results, lock, start):
+    conn = get_connection()
+    try:
+        start.wait()
+        for _ in range(args.per_worker):
+            try:
+                result = services.dispense(conn, services.DispenseRequest(
+                    pharmacist_id=people["pharmacist"],
+                    patient_id=people["patient"],
+                    doctor_id=people["doctor"],
+                    drug_id=drug_id,
+                    lot_batch_id=args.lot,
+                    qty_prescribed=1,
+                    qty_dispensed=1,
+                ))
+                with lock:
+                    results["ok"].append(result.dispense_id)
+            except Exception as e:
+                with lock:
+                    results["failed"][type(e).__name__] += 1
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lot", type=int, required=True, help="inventory lot all workers dispense from")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--per-worker", type=int, default=20, help="dispenses attempted per worker")
+    parser.add_argument("--pharmacist", type=int, help="default: lowest pharmacist_id")
+    parser.add_argument("--patient", type=int, help="default: lowest patient_id")
+    parser.add_argument("--doctor", type=int, help="default: lowest doctor_id")
+    parser.add_argument("--keep", action="store_true", help="do not reverse the dispenses afterwards")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        people = {
+            "pharmacist": args.pharmacist or _first_id(conn, "pharmacist", "pharmacist_id"),
+            "patient": args.patient or _first_id(conn, "patient", "patient_id"),
+            "doctor": args.doctor or _first_id(conn, "doctor", "doctor_id"),
+        }
+        drug_id, qty_before = _qty(conn, args.lot)
+    finally:
+        conn.close()
+    print(f"lot {args.lot} (drug {drug_id}): {qty_before} on hand, "
+          f"{args.workers} workers x {args.per_worker} dispenses of 1")
+
+    reset_retry_stats()
+    results = {"ok": [], "failed": collections.Counter()}
+    lock = threading.Lock()
+    start = threading.Barrier(args.workers + 1)
+    threads = [
+        threading.Thread(target=worker, args=(args, drug_id, people, results, lock, start))
+        for _ in range(args.workers)
+    ]
+    for t in threads:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    conn = get_connection()
+    try:
+        _, qty_after = _qty(conn, args.lot)
+    finally:
+        conn.close()
+
+    ok = len(results["ok"])
+    print(f"\n{ok} dispensed in {elapsed:.2f}s ({ok / elapsed:.1f}/s)")
+    for (fn, outcome), n in sorted(services.retry_stats().items()):
+        print(f"  {fn:<16} {outcome:<8} {n}")
+    for name, n in results["failed"].most_common():
+        print(f"  failed: {name:<24} {n}")
+
+    lost = (qty_before - qty_after) - ok
+    print(f"\nqty_on_hand {qty_before} -> {qty_after}; successful dispenses {ok}; "
+          + ("no lost updates" if lost == 0 else f"MISMATCH of {lost}"))
+
+    if not args.keep and results["ok"]:
+        conn = get_connection()
+        try:
+            services.reverse_dispenses(conn, results["ok"])
+            _, qty_restored = _qty(conn, args.lot)
+        finally:
+            conn.close()
+        print(f"reversed {ok} dispenses; lot {args.lot} back at {qty_restored}")
+
+    sys.exit(1 if lost else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Patient history latency: is a counter lookup under 100 ms?
+
+Takes the --patients patients with the most prescriptions, loads the first
+history page of each (and, with --pages, the older pages after it) with the
+cache cleared, then once more from the cache, and prints mean / p50 / p95 /
+max per page load. Exits with status 1 if the uncached p95 is above
+--budget-ms. Read-only, so it can run against a live database.
+
+Usage (from Application/):
+    python benchmarks/bench_patient_history.py --patients 200 --pages 3
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import patient_history  # noqa: E402
+from db import run_query  # noqa: E402
+
+
+def _timed_pages(patient_ids, pages):
+    latencies = []
+    for patient_id in patient_ids:
+        cursor = None
+        for _ in range(pages):
+            t0 = time.perf_counter()
+            page = patient_history.history(patient_id, cursor)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+    return latencies
+
+
+def _report(label, latencies):
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+    print(
+        f"{label:<9} {len(latencies):>6} {statistics.fmean(latencies):8.2f} "
+        f"{statistics.median(latencies):8.2f} {p95:8.2f} {max(latencies):8.2f}"
+    )
+    return p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=200, help="patients with the longest histories")
+    parser.add_argument("--pages", type=int, default=1, help="pages to walk per patient")
+    parser.add_argument("--budget-ms", type=float, default=100.0, help="fail above this uncached p95")
+    args = parser.parse_args()
+
+    patient_ids = run_query(
+        """
+        SELECT patient_id FROM prescription
+        GROUP BY patient_id ORDER BY COUNT(*) DESC, patient_id LIMIT %s;
+        """,
+        params=(args.patients,),
+    )["patient_id"].astype(int).tolist()
+    if not patient_ids:
+        raise SystemExit("No prescriptions to read.")
+
+    # Warm the statement pools (PREPARE) so the first sample does not pay for them.
+    patient_history.history(patient_ids[0])
+    patient_history.clear_cache()
+
+    print(f"{len(patient_ids)} patients, up to {args.pages} page(s) each, "
+          f"{patient_history.PATIENT_HISTORY_PAGE_SIZE} prescriptions per page\n")
+    print(f"{'':<9} {'pages':>6} {'mean ms':>8} {'p50':>8} {'p95':>8} {'max':>8}")
+    p95 = _report("uncached", _timed_pages(patient_ids, args.pages))
+    _report("cached", _timed_pages(patient_ids, args.pages))
+
+    if p95 > args.budget_ms:
+        print(f"\nFAIL: uncached p95 {p95:.1f} ms is above the {args.budget_ms:.0f} ms budget")
+        sys.exit(1)
+    print(f"\nOK: uncached p95 within {args.budget_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Queue benchmark: many workstations draining the pending-prescription queue at once.
+
+Every worker thread is a workstation with its own connection that keeps
+calling services.claim_next() until the queue is empty. Claims are not
+filled, so nothing but RX_CLAIM rows is written, and all of them are
+released at the end. The run fails if any prescription was handed to two
+workstations, or if a pending prescription was never handed out.
+
+Reports claims per second and claim latency percentiles; with SKIP LOCKED
+the latency should stay flat as --workers grows instead of queueing up.
+
+Usage (from Application/):
+    python benchmarks/bench_rx_queue.py --workers 8
+    python benchmarks/bench_rx_queue.py --workers 32
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import services  # noqa: E402
+from db import get_connection  # noqa: E402
+
+
+def worker(name, claims, latencies, lock, start):
+    conn = get_connection()
+    try:
+        start.wait()
+        while True:
+            t0 = time.perf_counter()
+            item = services.claim_next(conn, name)
+            elapsed = (time.perf_counter() - t0) * 1000
+            if item is None:
+                return
+            with lock:
+                claims.append((item.rx_id, name))
+                latencies.append(elapsed)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    conn = get_connection()
+    try:
+        depth = services.queue_depth(conn)
+    finally:
+        conn.close()
+    if depth["claimed"]:
+        raise SystemExit(f"{depth['claimed']} prescriptions are claimed right now; run this on an idle queue.")
+    print(f"{depth['pending']} pending prescriptions, {args.workers} workstations")
+
+    claims, latencies = [], []
+    lock = threading.Lock()
+    start = threading.Barrier(args.workers + 1)
+    threads = [
+        threading.Thread(target=worker, args=(f"bench-{i}", claims, latencies, lock, start))
+        for i in range(args.workers)
+    ]
+    for t in threads:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    rx_ids = [rx_id for rx_id, _ in claims]
+    duplicates = len(rx_ids) - len(set(rx_ids))
+    missing = depth["pending"] - len(set(rx_ids))
+
+    print(f"{len(claims)} claims in {elapsed:.2f}s ({len(claims) / elapsed:.1f}/s)")
+    if len(latencies) >= 2:
+        q = statistics.quantiles(latencies, n=100)
+        print(f"claim latency ms: p50 {q[49]:.1f}  p95 {q[94]:.1f}  max {max(latencies):.1f}")
+    print(f"double claims: {duplicates}; never handed out: {missing}")
+
+    conn = get_connection()
+    try:
+        for rx_id, name in claims:
+            services.release_claim(conn, rx_id, name)
+    finally:
+        conn.close()
+    print(f"released {len(claims)} claims")
+
+    sys.exit(1 if duplicates or missing else 0)
+
+
+if __name__ == "__main__":
+    main()
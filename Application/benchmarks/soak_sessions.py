@@ -0,0 +1,114 @@
+"""
+Soak test: open hundreds of Streamlit sessions against the pages and watch memory.
+
+Each simulated session is a streamlit.testing AppTest that runs a page
+script in this process, exactly as a browser session would on the server.
+The last --keep sessions stay open (like idle tabs at the counter), older
+ones are dropped. Every --sample-every sessions the process RSS, traced
+memory and the stored-frame ledger from memory.py are sampled.
+
+On the Dispense page the form is submitted once per session, which reaches
+the lot selection step and stores the BEFORE snapshot frame. The only
+write is the stock hold that step places; the soak run shortens its TTL to
+30 seconds (unless RESERVATION_TTL_SECONDS is set) so the holds of dropped
+sessions expire quickly.
+
+Once --keep sessions are open, memory should flatten out. The test fails
+(exit code 1) if RSS keeps growing faster than --max-growth-kib per
+session over the second half of the run.
+
+Usage (from Application/):
+    python benchmarks/soak_sessions.py --sessions 300
+    MEMORY_TRACE=1 python benchmarks/soak_sessions.py --sessions 500 --keep 100 --pages 2_Dispense
+"""
+import argparse
+import collections
+import gc
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+os.environ.setdefault("RESERVATION_TTL_SECONDS", "30")
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+import memory  # noqa: E402
+
+DEFAULT_PAGES = ["app", "1_Dashboard", "2_Dispense", "3_Order", "4_Insurance"]
+
+
+def _script(page):
+    return os.path.join(APP_DIR, "app.py") if page == "app" else os.path.join(APP_DIR, "Pages", f"{page}.py")
+
+
+def open_session(page, timeout):
+    at = AppTest.from_file(_script(page), default_timeout=timeout)
+    at.run()
+    if page == "2_Dispense":
+        submit = [b for b in at.button if b.label == "Dispense Now"]
+        if submit:
+            submit[0].click().run()
+    if at.exception:
+        raise RuntimeError(f"{page} raised: {at.exception[0].message}")
+    return at
+
+
+def sample(n_sessions, started):
+    gc.collect()
+    traced = memory.traced()
+    sessions = memory.session_summary()
+    return {
+        "sessions": n_sessions,
+        "seconds": round(time.perf_counter() - started, 1),
+        "rss_mib": round(memory.rss_bytes() / 2**20, 1),
+        "traced_mib": round(traced["current"] / 2**20, 1) if traced else None,
+        "stored_kib": round(sum(s["stored_kib"] for s in sessions), 1),
+        "evictions": sum(s["evictions"] for s in sessions),
+    }
+
+
+def growth_kib_per_session(samples):
+    """Least-squares slope of RSS over the second half of the run."""
+    tail = samples[len(samples) // 2:]
+    if len(tail) < 2:
+        return 0.0
+    xs = [s["sessions"] for s in tail]
+    ys = [s["rss_mib"] * 1024 for s in tail]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    var = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var if var else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open many sessions against the pages and report memory growth.")
+    parser.add_argument("--sessions", type=int, default=300, help="Total sessions to open (default 300).")
+    parser.add_argument("--keep", type=int, default=50, help="Sessions kept open at once (default 50).")
+    parser.add_argument("--pages", nargs="+", default=DEFAULT_PAGES, help="Pages to cycle through.")
+    parser.add_argument("--sample-every", type=int, default=25, help="Sample memory every N sessions.")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds allowed per page run.")
+    parser.add_argument("--max-growth-kib", type=float, default=64,
+                        help="Fail if RSS grows faster than this per session in the second half.")
+    args = parser.parse_args()
+
+    open_sessions = collections.deque(maxlen=args.keep)
+    started = time.perf_counter()
+    samples = [sample(0, started)]
+    for i in range(1, args.sessions + 1):
+        open_sessions.append(open_session(args.pages[(i - 1) % len(args.pages)], args.timeout))
+        if i % args.sample_every == 0 or i == args.sessions:
+            samples.append(sample(i, started))
+            print(samples[-1], flush=True)
+
+    slope = growth_kib_per_session(samples)
+    print(f"\nRSS {samples[0]['rss_mib']} -> {samples[-1]['rss_mib']} MiB over {args.sessions} sessions "
+          f"({args.keep} kept open); second-half growth {slope:.1f} KiB/session")
+    if slope > args.max_growth_kib:
+        print(f"FAIL: growth above {args.max_growth_kib:g} KiB/session")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
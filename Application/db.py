@@ -1,23 +1,107 @@
 import os
+import random
+import time
 import psycopg
 import pandas as pd
-import streamlit as st
 from dotenv import load_dotenv
+from instrumentation import InstrumentedCursor
+import slow_queries
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Optional read replicas (comma-separated DSNs). Without them every read goes to the primary.
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", "10"))
+
+# Seconds of replay lag; 0 when fully caught up (or when the server is not a standby at all).
+_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+slow_queries.install()
+
+# url -> (monotonic time of last check, lag in seconds or None if unreachable)
+_replica_health = {}
+
+
+def _missing_database_url():
+    """Stop the page with a message inside Streamlit; raise outside it (API, jobs, scripts)."""
+    message = "Missing DATABASE_URL! Please make sure your .env file is set up correctly."
+    try:
+        import streamlit as st
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        raise RuntimeError(message)
+    if get_script_run_ctx(suppress_warning=True) is None:
+        raise RuntimeError(message)
+    st.error(message)
+    st.stop()
+
+
 def get_connection():
-    """Always return a fresh connection (safe with Streamlit reruns)."""
+    """Always return a fresh connection (safe with Streamlit reruns). Every statement is timed by instrumentation.py."""
     if not DATABASE_URL:
-        st.error("Missing DATABASE_URL! Please make sure your .env file is set up correctly.")
-        st.stop()
-    return psycopg.connect(DATABASE_URL)
+        _missing_database_url()
+    return psycopg.connect(DATABASE_URL, cursor_factory=InstrumentedCursor)
+
+
+def _connect_replica(url):
+    """Connect to one replica, or return None if it is down or lagging too far behind."""
+    checked_at, lag = _replica_health.get(url, (0.0, 0.0))
+    stale = time.monotonic() - checked_at > REPLICA_CHECK_SECONDS
+    if not stale and (lag is None or lag > REPLICA_MAX_LAG_SECONDS):
+        return None
+
+    try:
+        conn = psycopg.connect(url, connect_timeout=3, cursor_factory=InstrumentedCursor)
+    except psycopg.OperationalError:
+        _replica_health[url] = (time.monotonic(), None)
+        return None
+
+    if stale:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(_LAG_QUERY)
+                lag = float(cur.fetchone()[0])
+            conn.commit()
+        except Exception:
+            # e.g. the replica went down between connect and query; skip it like an unreachable one.
+            conn.close()
+            _replica_health[url] = (time.monotonic(), None)
+            return None
+        _replica_health[url] = (time.monotonic(), lag)
+        if lag > REPLICA_MAX_LAG_SECONDS:
+            conn.close()
+            return None
+    return conn
+
+
+def get_read_connection(pin_primary=False):
+    """
+    Fresh connection for SELECT-only work. Uses a healthy replica when one is
+    configured and falls back to the primary. Pass pin_primary=True for reads
+    that must see the caller's own write (e.g. a receipt right after COMMIT).
+    """
+    if not pin_primary and DATABASE_REPLICA_URLS:
+        # Random start spreads the load; the loop gives every replica a chance before falling back.
+        start = random.randrange(len(DATABASE_REPLICA_URLS))
+        for i in range(len(DATABASE_REPLICA_URLS)):
+            conn = _connect_replica(DATABASE_REPLICA_URLS[(start + i) % len(DATABASE_REPLICA_URLS)])
+            if conn is not None:
+                return conn
+    return get_connection()
+
 
-def run_query(query, params=None):
-    """Safe SELECT helper that opens/closes connection each time."""
-    conn = get_connection()
+def run_query(query, params=None, pin_primary=False):
+    """Safe SELECT helper that opens/closes connection each time (routed to a replica when available)."""
+    conn = get_read_connection(pin_primary=pin_primary)
     try:
         return pd.read_sql(query, conn, params=params)
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
@@ -0,0 +1,104 @@
+"""
+Drug lookup by brand name, generic name, form or strength.
+
+`search()` runs one ranked, limited query on DRUG_SEARCH
+(Performance_Script.sql section 8) through the prepared statements in
+statements.py: every typed word is matched as a prefix against the
+weighted tsvector, and the whole text fuzzily against the trigram index,
+so "amoxi 500" and "ibuprofn" both find their drug.
+
+Results are kept in a small in-process LRU cache for DRUG_SEARCH_CACHE_SECONDS:
+the catalogue changes rarely, and every Streamlit rerun of a page repeats
+the same search. The cache is per process and keyed on the normalised text,
+so "Amoxi  500" and "amoxi 500" share an entry.
+
+Usage:
+    labels = drug_search.options("amoxi 500")     # ["2001 - Amoxicillin (Amoxicillin, Capsule 500mg)", ...]
+    df = drug_search.search("ibuprofen", limit=10)
+"""
+import collections
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+
+import statements
+
+DRUG_SEARCH_LIMIT = int(os.getenv("DRUG_SEARCH_LIMIT", "25"))
+DRUG_SEARCH_CACHE_SECONDS = float(os.getenv("DRUG_SEARCH_CACHE_SECONDS", "300"))
+DRUG_SEARCH_CACHE_SIZE = int(os.getenv("DRUG_SEARCH_CACHE_SIZE", "1000"))
+
+_WORDS = re.compile(r"\w+")
+
+_cache = collections.OrderedDict()   # (normalised text, limit) -> (expires at, DataFrame)
+_cache_lock = threading.Lock()
+_counts = collections.Counter()      # "hits" / "misses"
+
+
+def _normalise(text) -> str:
+    return " ".join(_WORDS.findall((text or "").lower()))
+
+
+def _cached(key):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _cache.move_to_end(key)
+            _counts["hits"] += 1
+            return entry[1]
+        _counts["misses"] += 1
+        return None
+
+
+def _store(key, df):
+    with _cache_lock:
+        _cache[key] = (time.monotonic() + DRUG_SEARCH_CACHE_SECONDS, df)
+        _cache.move_to_end(key)
+        while len(_cache) > DRUG_SEARCH_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def search(text, limit=None) -> pd.DataFrame:
+    """
+    Best matches first: drug_id, drug_name, generic_name, form, strength, score.
+    An empty search lists the first drugs alphabetically.
+    """
+    limit = int(limit or DRUG_SEARCH_LIMIT)
+    normalised = _normalise(text)
+    key = (normalised, limit)
+    df = _cached(key)
+    if df is None:
+        if normalised:
+            # "amoxi 500" -> "amoxi:* & 500:*" (\w+ words cannot contain tsquery operators)
+            prefix_query = " & ".join(f"{word}:*" for word in normalised.split())
+            df = statements.query("drug_search", (prefix_query, normalised, limit))
+        else:
+            df = statements.query("drug_browse", (limit,))
+        _store(key, df)
+    # Callers may add columns; the cached frame stays as it was.
+    return df.copy()
+
+
+def label(row) -> str:
+    """ "2001 - Amoxicillin (Amoxicillin, Capsule 500mg)"; pages read the ID back with split(" - ")[0]."""
+    details = ", ".join(
+        part for part in (row["generic_name"], " ".join(p for p in (row["form"], row["strength"]) if p)) if part
+    )
+    return f"{row['drug_id']} - {row['drug_name']}" + (f" ({details})" if details else "")
+
+
+def options(text, limit=None) -> list:
+    """search() as selectbox labels."""
+    return [label(row) for _, row in search(text, limit).iterrows()]
+
+
+def cache_stats() -> dict:
+    with _cache_lock:
+        return {"entries": len(_cache), "hits": _counts["hits"], "misses": _counts["misses"]}
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,36 @@
+"""
+The pharmacist on duty at this workstation, for the audit trail.
+
+Pages that write call `select_pharmacist()` once; it shows a sidebar picker
+that keeps its choice across pages and returns the actor string to pass to
+services.acting_as(), so every change lands in AUDIT_LOG under a name:
+
+    actor = duty.select_pharmacist()
+    with services.acting_as(actor):
+        services.record_payment(conn, dispense_id, policy_id, amount)
+"""
+from typing import Optional
+
+import streamlit as st
+
+from db import run_query
+
+
+@st.cache_data(ttl=300)
+def _pharmacists():
+    df = run_query("SELECT pharmacist_id, name FROM pharmacist ORDER BY pharmacist_id;")
+    return [f"{int(r.pharmacist_id)} - {r.name}" for r in df.itertuples()]
+
+
+def select_pharmacist() -> Optional[str]:
+    """Sidebar picker for the pharmacist on duty; returns e.g. "pharmacist 4"."""
+    labels = _pharmacists()
+    if not labels:
+        return None
+    # A plain session key (not the widget key) so the choice survives switching pages.
+    current = st.session_state.get("duty_pharmacist")
+    chosen = st.sidebar.selectbox(
+        "Pharmacist on duty", labels, index=labels.index(current) if current in labels else 0
+    )
+    st.session_state.duty_pharmacist = chosen
+    return f"pharmacist {int(chosen.split(' - ')[0])}"
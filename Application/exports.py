@@ -0,0 +1,236 @@
+"""
+Streaming CSV exports of the history tables for auditors.
+
+Live rows are sent by PostgreSQL with `COPY (SELECT ...) TO STDOUT` and
+passed on in chunks of about EXPORT_CHUNK_BYTES, so a multi-year extract
+never sits in the app server's memory (or in a DataFrame). Rows already
+moved to the Parquet archive (archive.py) are read batch by batch with
+archive.iter_archive() and come first, as they are the oldest.
+
+Every export can be filtered by an inclusive date range and, where the rows
+have one, a status. `excel=True` prefixes a UTF-8 byte order mark so Excel
+opens the file with the right encoding (€, accents); a native .xlsx cannot
+be written as a stream.
+
+Usage (from Application/):
+    python exports.py dispenses --from 2021-01-01 --to 2024-12-31 -o dispenses.csv
+    python exports.py order_lines --status DELIVERED --status CANCELLED -o orders.csv
+
+    for chunk in exports.export("inventory", statuses=["EXPIRED"]):
+        out.write(chunk)
+"""
+import argparse
+import codecs
+import datetime as dt
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from psycopg import sql
+
+from archive import iter_archive, read_archive
+from db import get_read_connection, run_query
+
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(256 * 1024)))
+EXPORT_ARCHIVE_ROWS = int(os.getenv("EXPORT_ARCHIVE_ROWS", "50000"))
+
+
+@dataclass(frozen=True)
+class Export:
+    label: str
+    # SELECT without ORDER BY / semicolon, returning `columns`
+    query: str
+    columns: Tuple[str, ...]
+    # output column the date range applies to
+    date_column: str
+    # allowed values of the output column "status", if the export has one
+    statuses: Tuple[str, ...] = ()
+    # archived table (archive.ARCHIVE_TABLES) holding older rows, if any
+    archive_table: Optional[str] = None
+
+
+EXPORTS = {
+    "dispenses": Export(
+        label="Dispenses",
+        query="""
+            SELECT dispense_id, dispense_date, rx_id, pharmacist_id, total_amount, commission
+            FROM dispense
+        """,
+        columns=("dispense_id", "dispense_date", "rx_id", "pharmacist_id", "total_amount", "commission"),
+        date_column="dispense_date",
+        archive_table="dispense",
+    ),
+    "order_lines": Export(
+        label="Purchase order lines",
+        query="""
+            SELECT po.order_id, po.order_date, po.status, po.supplier_id, poi.drug_id, poi.qty_ordered, poi.unit_cost
+            FROM purchase_order_item poi
+            JOIN purchase_order po ON po.order_id = poi.product_id
+        """,
+        columns=("order_id", "order_date", "status", "supplier_id", "drug_id", "qty_ordered", "unit_cost"),
+        date_column="order_date",
+        statuses=("PENDING", "DELIVERED", "CANCELLED"),
+        archive_table="purchase_order_item",
+    ),
+    "insurance_payments": Export(
+        label="Insurance payments",
+        query="""
+            SELECT p.dispense_id, d.dispense_date, p.policy_id, i.company, p.amount_covered
+            FROM pays p
+            JOIN dispense d  ON d.dispense_id = p.dispense_id
+            JOIN insurance i ON i.policy_id = p.policy_id
+        """,
+        columns=("dispense_id", "dispense_date", "policy_id", "company", "amount_covered"),
+        date_column="dispense_date",
+        archive_table="pays",
+    ),
+    "inventory": Export(
+        label="Inventory lots",
+        query="""
+            SELECT
+                s.lot_batch_id, s.drug_id, dc.drug_name, s.expiry_date, s.unit_cost, s.qty_on_hand, s.qty_available,
+                CASE
+                    WHEN s.quarantined THEN 'QUARANTINED'
+                    WHEN s.expiry_date < CURRENT_DATE THEN 'EXPIRED'
+                    WHEN s.qty_on_hand = 0 THEN 'EMPTY'
+                    ELSE 'IN_STOCK'
+                END AS status
+            FROM available_stock s
+            JOIN drug_catalogue dc ON dc.drug_id = s.drug_id
+        """,
+        columns=("lot_batch_id", "drug_id", "drug_name", "expiry_date", "unit_cost", "qty_on_hand", "qty_available", "status"),
+        date_column="expiry_date",
+        statuses=("IN_STOCK", "EMPTY", "EXPIRED", "QUARANTINED"),
+    ),
+}
+
+
+def _copy_statement(spec: Export, date_from, date_to, statuses) -> sql.Composed:
+    """COPY of the export query with the filters applied, oldest first. Values are quoted by psycopg."""
+    date_col = sql.Identifier(spec.date_column)
+    conditions = [sql.SQL("TRUE")]
+    if date_from is not None:
+        conditions.append(sql.SQL("{} >= {}").format(date_col, sql.Literal(date_from)))
+    if date_to is not None:
+        conditions.append(sql.SQL("{} <= {}").format(date_col, sql.Literal(date_to)))
+    if statuses:
+        conditions.append(sql.SQL("status = ANY({})").format(sql.Literal(list(statuses))))
+    # The subquery is flattened by the planner, so the filters still reach the base tables' indexes.
+    return sql.SQL("COPY (SELECT {columns} FROM ({query}) x WHERE {where} ORDER BY {date_col}, {key}) TO STDOUT (FORMAT CSV)").format(
+        columns=sql.SQL(", ").join(sql.Identifier(c) for c in spec.columns),
+        query=sql.SQL(spec.query.strip()),
+        where=sql.SQL(" AND ").join(conditions),
+        date_col=date_col,
+        key=sql.Identifier(spec.columns[0]),
+    )
+
+
+def _iter_live(spec: Export, date_from, date_to, statuses):
+    conn = get_read_connection()
+    try:
+        with conn.cursor() as cur:
+            with cur.copy(_copy_statement(spec, date_from, date_to, statuses)) as copy:
+                buffer = bytearray()
+                for data in copy:
+                    buffer += data
+                    if len(buffer) >= EXPORT_CHUNK_BYTES:
+                        yield bytes(buffer)
+                        buffer.clear()
+                if buffer:
+                    yield bytes(buffer)
+    finally:
+        conn.close()
+
+
+def _iter_archived(name: str, spec: Export, date_from, date_to, statuses):
+    """Archived rows as DataFrames with the export's columns."""
+    filters = []
+    if date_from is not None:
+        filters.append((spec.date_column, ">=", date_from))
+    if date_to is not None:
+        filters.append((spec.date_column, "<=", date_to))
+
+    if name == "order_lines":
+        # Order headers are one row per order, small next to their lines.
+        parents = read_archive("purchase_order", columns=["order_id", "status", "supplier_id"], filters=filters)
+        if statuses:
+            parents = parents[parents["status"].isin(statuses)]
+    elif name == "insurance_payments":
+        companies = run_query("SELECT policy_id, company FROM insurance;").set_index("policy_id")["company"]
+
+    columns = {
+        "dispenses": list(spec.columns),
+        "order_lines": ["product_id", "order_date", "drug_id", "qty_ordered", "unit_cost"],
+        "insurance_payments": ["dispense_id", "dispense_date", "policy_id", "amount_covered"],
+    }[name]
+    for df in iter_archive(spec.archive_table, columns=columns, filters=filters, batch_rows=EXPORT_ARCHIVE_ROWS):
+        if name == "order_lines":
+            df = df.rename(columns={"product_id": "order_id"}).merge(parents, on="order_id")
+        elif name == "insurance_payments":
+            df["company"] = df["policy_id"].map(companies)
+        if not df.empty:
+            yield df[list(spec.columns)]
+
+
+def export(name: str, date_from=None, date_to=None, statuses=None, include_archive=True, excel=False):
+    """
+    Iterator of CSV bytes for one export (header first). The arguments are
+    checked here, before anything is read, so callers can report a bad
+    request before they start streaming.
+    """
+    if name not in EXPORTS:
+        raise ValueError(f"Unknown export '{name}'. Choose from: {', '.join(EXPORTS)}")
+    spec = EXPORTS[name]
+    statuses = [s.upper() for s in statuses or []]
+    if statuses and not spec.statuses:
+        raise ValueError(f"The {name} export has no status to filter on.")
+    unknown = sorted(set(statuses) - set(spec.statuses))
+    if unknown:
+        raise ValueError(f"Unknown status {', '.join(unknown)}. Choose from: {', '.join(spec.statuses)}")
+    if date_from is not None and date_to is not None and date_from > date_to:
+        raise ValueError("The start date is after the end date.")
+
+    def chunks():
+        if excel:
+            yield codecs.BOM_UTF8
+        yield (",".join(spec.columns) + "\n").encode()
+        if include_archive and spec.archive_table:
+            for df in _iter_archived(name, spec, date_from, date_to, statuses):
+                yield df.to_csv(header=False, index=False).encode()
+        yield from _iter_live(spec, date_from, date_to, statuses)
+
+    return chunks()
+
+
+def write(name: str, path: str, **filters) -> int:
+    """Stream one export to a file. Returns the bytes written."""
+    written = 0
+    with open(path, "wb") as f:
+        for chunk in export(name, **filters):
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export pharmacy history as CSV.")
+    parser.add_argument("name", choices=list(EXPORTS))
+    parser.add_argument("--from", dest="date_from", type=dt.date.fromisoformat)
+    parser.add_argument("--to", dest="date_to", type=dt.date.fromisoformat)
+    parser.add_argument("--status", action="append", help="repeat for several statuses")
+    parser.add_argument("--no-archive", action="store_true", help="live tables only")
+    parser.add_argument("--excel", action="store_true", help="add a UTF-8 byte order mark for Excel")
+    parser.add_argument("-o", "--output", help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    options = dict(
+        date_from=args.date_from, date_to=args.date_to, statuses=args.status,
+        include_archive=not args.no_archive, excel=args.excel,
+    )
+    if args.output:
+        size = write(args.name, args.output, **options)
+        print(f"{args.output}: {size / 1e6:.1f} MB", file=sys.stderr)
+    else:
+        for chunk in export(args.name, **options):
+            sys.stdout.buffer.write(chunk)
@@ -0,0 +1,319 @@
+"""
+Query instrumentation for every connection opened by db.py and async_db.py.
+
+Each statement executed through an `InstrumentedCursor` (or its async
+twin) is timed, reduced to a fingerprint (normalised SQL with literals and
+parameters replaced by `?`) and attributed to the Streamlit page and rerun
+that issued it. The results are kept in in-process latency histograms,
+shown on the Admin page and written periodically to a Prometheus text file
+(METRICS_FILE) for the node_exporter textfile collector.
+"""
+import collections
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+
+import psycopg
+
+METRICS_FILE = os.getenv(
+    "METRICS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics", "pharmacy_queries.prom"),
+)
+METRICS_WRITE_SECONDS = float(os.getenv("METRICS_WRITE_SECONDS", "15"))
+
+# Latency bucket upper bounds in milliseconds (Prometheus "le" labels are written in seconds).
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+RECENT_RERUNS = 200
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_lock = threading.Lock()
+
+
+class QueryStats:
+    """Latency histogram and row count for one (page, fingerprint) pair."""
+
+    __slots__ = ("count", "total_ms", "max_ms", "rows", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.buckets = [0] * len(BUCKETS_MS)
+
+    def observe(self, elapsed_ms, rows):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += max(rows, 0)
+        for i, bound in enumerate(BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+
+
+_stats = collections.defaultdict(QueryStats)   # (page, fingerprint) -> QueryStats
+_fingerprints = {}                             # query_id -> normalised SQL
+_reruns = collections.OrderedDict()            # (session, seq) -> dict
+_last_write = 0.0
+
+# Extra callbacks run after every statement, e.g. the slow-query log.
+_listeners = []
+
+
+# =====================================================================
+# Fingerprinting
+# =====================================================================
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_PARAMS = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def normalise(sql) -> str:
+    """Strip comments, literals and parameters so equivalent statements share one fingerprint."""
+    if not isinstance(sql, str):
+        sql = sql.as_string(None) if hasattr(sql, "as_string") else str(sql)
+    sql = _COMMENTS.sub(" ", sql)
+    sql = _STRINGS.sub("?", sql)
+    sql = _PARAMS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    sql = _IN_LISTS.sub("(...)", sql)
+    return _SPACES.sub(" ", sql).strip().rstrip(";").strip().lower()
+
+
+def query_id(normalised_sql: str) -> str:
+    return hashlib.md5(normalised_sql.encode()).hexdigest()[:12]
+
+
+# =====================================================================
+# Attribution
+# =====================================================================
+def _current_page() -> str:
+    """Name of the page script (or app.py) on the call stack, else the outermost script."""
+    frame = sys._getframe(2)
+    outermost = None
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if path.startswith(_APP_DIR):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if os.path.basename(os.path.dirname(path)) == "Pages" or name == "app":
+                return name
+            outermost = name
+        frame = frame.f_back
+    return outermost or "other"
+
+
+def _current_rerun():
+    """(session id, rerun sequence number) for the Streamlit run on this thread, or (None, None)."""
+    try:
+        import streamlit as st
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+        # profiler.start() counts the session's reruns at the top of every page.
+        seq = st.session_state.get("_rerun_seq") if ctx is not None else None
+    except Exception:
+        return None, None
+    if seq is None:
+        return None, None
+    return ctx.session_id, seq
+
+
+# =====================================================================
+# Recording
+# =====================================================================
+def record(sql, elapsed_ms, rows=-1, params=None):
+    """Add one executed statement to the histograms and notify listeners."""
+    norm = normalise(sql)
+    qid = query_id(norm)
+    page = _current_page()
+
+    with _lock:
+        session, seq = _current_rerun()
+        _fingerprints[qid] = norm
+        _stats[(page, qid)].observe(elapsed_ms, rows)
+
+        if session is not None:
+            run = _reruns.get((session, seq))
+            if run is None:
+                run = _reruns[(session, seq)] = {
+                    "page": page, "session": session[:8], "rerun": seq,
+                    "started": time.strftime("%H:%M:%S"), "queries": 0, "db_ms": 0.0,
+                }
+                while len(_reruns) > RECENT_RERUNS:
+                    _reruns.popitem(last=False)
+            run["queries"] += 1
+            run["db_ms"] += elapsed_ms
+
+    for listener in list(_listeners):
+        try:
+            listener(sql=sql, normalised=norm, query_id=qid, page=page,
+                     elapsed_ms=elapsed_ms, rows=rows, params=params)
+        except Exception:
+            pass
+
+    _maybe_write_metrics()
+
+
+def add_listener(fn):
+    """Register a callback(**statement_info) that runs after every recorded statement."""
+    if fn not in _listeners:
+        _listeners.append(fn)
+
+
+class InstrumentedCursor(psycopg.Cursor):
+    """psycopg cursor that reports every execute() to this module."""
+
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            record(query, (time.perf_counter() - start) * 1000, self.rowcount, params)
+
+    def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            record(query, (time.perf_counter() - start) * 1000, self.rowcount)
+
+
+class AsyncInstrumentedCursor(psycopg.AsyncCursor):
+    """Async twin of InstrumentedCursor for connections opened by async_db.py."""
+
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            record(query, (time.perf_counter() - start) * 1000, self.rowcount, params)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            record(query, (time.perf_counter() - start) * 1000, self.rowcount)
+
+
+# =====================================================================
+# Reporting
+# =====================================================================
+def _quantile(stats: QueryStats, q: float) -> float:
+    """Upper bucket bound containing the q-quantile (what Prometheus histogram_quantile approximates)."""
+    target = stats.count * q
+    seen = 0
+    for bound, n in zip(BUCKETS_MS, stats.buckets):
+        seen += n
+        if seen >= target:
+            return stats.max_ms if bound == float("inf") else bound
+    return stats.max_ms
+
+
+def query_summary() -> list:
+    """One dict per (page, fingerprint), slowest total time first."""
+    with _lock:
+        rows = [
+            {
+                "page": page, "query_id": qid, "calls": s.count,
+                "total_ms": round(s.total_ms, 1), "avg_ms": round(s.total_ms / s.count, 2),
+                "p95_ms": _quantile(s, 0.95), "max_ms": round(s.max_ms, 1),
+                "rows": s.rows, "sql": _fingerprints.get(qid, ""),
+            }
+            for (page, qid), s in _stats.items()
+        ]
+    return sorted(rows, key=lambda r: r["total_ms"], reverse=True)
+
+
+def page_summary() -> list:
+    """Per-page totals with an approximate latency distribution over all of the page's queries."""
+    with _lock:
+        pages = collections.defaultdict(QueryStats)
+        for (page, _), s in _stats.items():
+            agg = pages[page]
+            agg.count += s.count
+            agg.total_ms += s.total_ms
+            agg.max_ms = max(agg.max_ms, s.max_ms)
+            agg.rows += s.rows
+            agg.buckets = [a + b for a, b in zip(agg.buckets, s.buckets)]
+    return sorted(
+        (
+            {
+                "page": page, "queries": s.count, "total_ms": round(s.total_ms, 1),
+                "p50_ms": _quantile(s, 0.5), "p95_ms": _quantile(s, 0.95), "max_ms": round(s.max_ms, 1),
+            }
+            for page, s in pages.items()
+        ),
+        key=lambda r: r["total_ms"], reverse=True,
+    )
+
+
+def recent_reruns() -> list:
+    with _lock:
+        return [dict(r, db_ms=round(r["db_ms"], 1)) for r in reversed(_reruns.values())]
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _fingerprints.clear()
+        _reruns.clear()
+
+
+def _label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def prometheus_text() -> str:
+    """Current histograms in the Prometheus text exposition format."""
+    lines = [
+        "# HELP pharmacy_query_duration_seconds Latency of SQL statements issued by the app.",
+        "# TYPE pharmacy_query_duration_seconds histogram",
+    ]
+    with _lock:
+        items = list(_stats.items())
+        fingerprints = dict(_fingerprints)
+    for (page, qid), s in items:
+        labels = f'page="{_label(page)}",query_id="{qid}"'
+        cumulative = 0
+        for bound, n in zip(BUCKETS_MS, s.buckets):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else f"{bound / 1000:g}"
+            lines.append(f'pharmacy_query_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"pharmacy_query_duration_seconds_sum{{{labels}}} {s.total_ms / 1000:.6f}")
+        lines.append(f"pharmacy_query_duration_seconds_count{{{labels}}} {s.count}")
+
+    lines += ["# HELP pharmacy_query_rows_total Rows returned or affected.", "# TYPE pharmacy_query_rows_total counter"]
+    for (page, qid), s in items:
+        lines.append(f'pharmacy_query_rows_total{{page="{_label(page)}",query_id="{qid}"}} {s.rows}')
+
+    lines += ["# HELP pharmacy_query_info Normalised SQL for each query_id.", "# TYPE pharmacy_query_info gauge"]
+    for qid, sql in fingerprints.items():
+        lines.append(f'pharmacy_query_info{{query_id="{qid}",sql="{_label(sql[:300])}"}} 1')
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path=METRICS_FILE):
+    """Atomically replace the Prometheus text file so the collector never reads half a file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+def _maybe_write_metrics():
+    global _last_write
+    if not METRICS_FILE or time.monotonic() - _last_write < METRICS_WRITE_SECONDS:
+        return
+    _last_write = time.monotonic()
+    try:
+        write_metrics()
+    except OSError:
+        pass
@@ -0,0 +1,190 @@
+"""
+KPI history: periodic samples of the Dashboard numbers, rolled up for trend charts.
+
+`snapshot()` computes the current KPIs with one query (cheap counts on
+DRUG_STOCK_SUMMARY, PURCHASE_ORDER, INVENTORY_LOT and today's DISPENSE
+rows), stores them in KPI_SAMPLE and, in the same statement, folds the
+samples it actually inserted into the hourly, daily and monthly buckets of
+KPI_ROLLUP with an upsert, so the rollups never have to be rebuilt from the
+samples and a repeated `at` is not counted twice. `series()` reads
+only KPI_ROLLUP (Performance_Script.sql section 6).
+
+Old data is pruned per grain by `prune()`: raw samples after
+KPI_RAW_RETENTION_DAYS, hourly buckets after KPI_HOURLY_RETENTION_DAYS,
+daily buckets after KPI_DAILY_RETENTION_DAYS; monthly buckets are kept.
+
+Usage (from Application/, e.g. from cron every 5 minutes):
+    python kpi_history.py
+    python kpi_history.py --every 300        # keep sampling in a loop
+"""
+import argparse
+import datetime as dt
+import os
+import time
+
+import pandas as pd
+
+from db import get_connection, run_query
+
+KPI_RAW_RETENTION_DAYS = int(os.getenv("KPI_RAW_RETENTION_DAYS", "7"))
+KPI_HOURLY_RETENTION_DAYS = int(os.getenv("KPI_HOURLY_RETENTION_DAYS", "90"))
+KPI_DAILY_RETENTION_DAYS = int(os.getenv("KPI_DAILY_RETENTION_DAYS", "1095"))
+
+# metric -> label shown on the Dashboard
+METRICS = {
+    "stock_health": "Stock health score (%)",
+    "low_stock_drugs": "Drugs below reorder level",
+    "pending_orders": "Pending purchase orders",
+    "expired_lots": "Expired lots",
+    "dispenses_today": "Dispenses today",
+    "revenue_today": "Revenue today (€)",
+}
+
+GRAINS = ("hour", "day", "month")
+
+# One row, one column per metric. The health score is the Dashboard's: 100 minus half the share of
+# drugs below their reorder level and half the share of expired lots.
+CURRENT_QUERY = """
+    WITH s AS (
+        SELECT COUNT(*) AS drugs, COUNT(*) FILTER (WHERE Usable_on_hand < Reorder_level) AS low
+        FROM DRUG_STOCK_SUMMARY
+    ), l AS (
+        SELECT COUNT(*) AS lots, COUNT(*) FILTER (WHERE Expiry_date < CURRENT_DATE) AS expired
+        FROM INVENTORY_LOT
+    ), d AS (
+        SELECT COUNT(*) AS n, COALESCE(SUM(Total_amount), 0) AS revenue
+        FROM DISPENSE WHERE Dispense_date = CURRENT_DATE
+    )
+    SELECT
+        CASE WHEN s.drugs = 0 OR l.lots = 0 THEN 100
+             ELSE GREATEST(0, 100 - FLOOR(50 * (s.low::numeric / s.drugs + l.expired::numeric / l.lots)))
+        END AS stock_health,
+        s.low AS low_stock_drugs,
+        (SELECT COUNT(*) FROM PURCHASE_ORDER WHERE Status = 'PENDING') AS pending_orders,
+        l.expired AS expired_lots,
+        d.n AS dispenses_today,
+        d.revenue AS revenue_today
+    FROM s, l, d;
+"""
+
+# Only the samples the first INSERT added (RETURNING) reach the rollup; a sample already stored for `at` is skipped.
+_SAMPLE_AND_ROLLUP = """
+    WITH added AS (
+        INSERT INTO KPI_SAMPLE (Metric, Sampled_at, Value)
+        SELECT v.metric, %(at)s, v.value
+        FROM unnest(%(metrics)s::text[], %(values)s::numeric[]) AS v(metric, value)
+        ON CONFLICT DO NOTHING
+        RETURNING Metric, Value
+    )
+    INSERT INTO KPI_ROLLUP AS r (Metric, Grain, Bucket, Samples, Sum_value, Min_value, Max_value, Last_value, Last_at)
+    SELECT a.Metric, g.grain, date_trunc(g.grain, %(at)s::timestamptz), 1, a.Value, a.Value, a.Value, a.Value, %(at)s
+    FROM added a
+    CROSS JOIN unnest(%(grains)s::text[]) AS g(grain)
+    ON CONFLICT (Metric, Grain, Bucket) DO UPDATE SET
+        Samples = r.Samples + 1,
+        Sum_value = r.Sum_value + EXCLUDED.Sum_value,
+        Min_value = LEAST(r.Min_value, EXCLUDED.Min_value),
+        Max_value = GREATEST(r.Max_value, EXCLUDED.Max_value),
+        Last_value = CASE WHEN EXCLUDED.Last_at >= r.Last_at THEN EXCLUDED.Last_value ELSE r.Last_value END,
+        Last_at = GREATEST(r.Last_at, EXCLUDED.Last_at);
+"""
+
+
+def current(pin_primary=False) -> dict:
+    """The KPIs right now, {metric: float}."""
+    row = run_query(CURRENT_QUERY, pin_primary=pin_primary).iloc[0]
+    return {metric: float(row[metric]) for metric in METRICS}
+
+
+def snapshot(at=None) -> dict:
+    """Record one sample of every KPI and update its rollup buckets. Returns the sampled values."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            if at is None:
+                cur.execute("SELECT now();")
+                at = cur.fetchone()[0]
+            cur.execute(CURRENT_QUERY)
+            columns = [d.name for d in cur.description]
+            values = dict(zip(columns, cur.fetchone()))
+            cur.execute(
+                _SAMPLE_AND_ROLLUP,
+                {"at": at, "metrics": list(METRICS), "values": [values[m] for m in METRICS], "grains": list(GRAINS)},
+            )
+        conn.commit()
+        return {metric: float(values[metric]) for metric in METRICS}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def prune() -> dict:
+    """Apply the retention windows. Returns deleted rows per table / grain."""
+    deleted = {}
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM KPI_SAMPLE WHERE Sampled_at < now() - make_interval(days => %s);",
+                (KPI_RAW_RETENTION_DAYS,),
+            )
+            deleted["samples"] = cur.rowcount
+            for grain, days in (("hour", KPI_HOURLY_RETENTION_DAYS), ("day", KPI_DAILY_RETENTION_DAYS)):
+                cur.execute(
+                    "DELETE FROM KPI_ROLLUP WHERE Grain = %s AND Bucket < now() - make_interval(days => %s);",
+                    (grain, days),
+                )
+                deleted[grain] = cur.rowcount
+        conn.commit()
+        return deleted
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def series(metrics, grain="day", since=None) -> pd.DataFrame:
+    """
+    Trend rows (bucket, metric, avg, min, max, last) from KPI_ROLLUP only.
+    `since` defaults to 48 hours for hourly, 90 days for daily and everything for monthly buckets.
+    """
+    if grain not in GRAINS:
+        raise ValueError(f"grain must be one of {GRAINS}")
+    if since is None and grain != "month":
+        since = dt.datetime.now(dt.timezone.utc) - (dt.timedelta(hours=48) if grain == "hour" else dt.timedelta(days=90))
+    return run_query(
+        """
+        SELECT
+            Bucket AS bucket,
+            Metric AS metric,
+            ROUND(Sum_value / Samples, 2) AS avg,
+            Min_value AS min,
+            Max_value AS max,
+            Last_value AS last
+        FROM KPI_ROLLUP
+        WHERE Grain = %s AND Metric = ANY(%s) AND (%s::timestamptz IS NULL OR Bucket >= %s::timestamptz)
+        ORDER BY Bucket, Metric;
+        """,
+        params=(grain, list(metrics), since, since),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sample the pharmacy KPIs into KPI_SAMPLE / KPI_ROLLUP.")
+    parser.add_argument("--every", type=float, help="keep sampling every N seconds instead of once")
+    parser.add_argument("--no-prune", action="store_true", help="skip the retention clean-up")
+    args = parser.parse_args()
+
+    while True:
+        values = snapshot()
+        print(f"{dt.datetime.now():%Y-%m-%d %H:%M:%S} " + ", ".join(f"{k}={v:g}" for k, v in values.items()))
+        if not args.no_prune:
+            pruned = prune()
+            if any(pruned.values()):
+                print("pruned " + ", ".join(f"{k}: {v}" for k, v in pruned.items()))
+        if not args.every:
+            break
+        time.sleep(args.every)
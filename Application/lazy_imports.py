@@ -0,0 +1,35 @@
+"""
+Deferred imports for heavy libraries.
+
+`lazy_import("plotly.express")` returns the module object straight away but
+only executes it on the first attribute access (`px.pie(...)`). A page that
+draws its charts below the header therefore paints the header first, and a
+freshly restarted worker does not pay for Plotly on pages that never chart.
+Modules that are already imported are returned as they are.
+"""
+import importlib.util
+import sys
+import threading
+
+_lock = threading.Lock()
+
+
+def lazy_import(name: str):
+    """Import `name` lazily (importlib.util.LazyLoader). Raises ModuleNotFoundError like import would."""
+    with _lock:
+        if name in sys.modules:
+            return sys.modules[name]
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+
+        # Match a normal `import a.b`: the submodule is also an attribute of its package.
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(sys.modules[parent], child, module)
+        return module
@@ -0,0 +1,226 @@
+"""
+Memory reporting and a per-session budget for stored DataFrames.
+
+Two things grow on a long-running app server: DataFrames kept in
+`st.session_state` (one copy per browser session) and whatever the page
+scripts allocate and never release. This module covers both:
+
+* `store_frame(key, df)` puts a DataFrame into the session state and keeps
+  the session's frames under SESSION_BUDGET_MB. When the budget is exceeded
+  the oldest frames are compacted first (numeric downcast, repeated strings
+  to categories) and then evicted (set to None) until the session fits.
+* With MEMORY_TRACE=1, tracemalloc records where memory is allocated, and
+  `page_allocations()` attributes live allocations to the page script that
+  made them.
+
+The Admin page shows process RSS, the per-session ledger and the per-page
+allocations. benchmarks/soak_sessions.py opens hundreds of sessions against
+the pages and reports how RSS grows.
+"""
+import collections
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+import streamlit as st
+
+MEMORY_TRACE = os.getenv("MEMORY_TRACE", "0") == "1"
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "25"))
+SESSION_BUDGET_MB = float(os.getenv("SESSION_BUDGET_MB", "20"))
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_LEDGER_KEY = "_frame_ledger"
+MAX_SESSIONS = 1000
+
+_lock = threading.Lock()
+_sessions = collections.OrderedDict()  # session id -> dict (see _note_session)
+
+if MEMORY_TRACE and not tracemalloc.is_tracing():
+    # Enough frames to reach the page script from inside pandas / psycopg.
+    tracemalloc.start(MEMORY_TRACE_FRAMES)
+
+
+# =====================================================================
+# Sizing and compaction
+# =====================================================================
+def frame_bytes(df) -> int:
+    """Deep in-memory size of a DataFrame (0 for None)."""
+    if df is None:
+        return 0
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    """Smaller copy of df: downcast numbers and turn repetitive text columns into categories."""
+    out = df.copy()
+    for col in out.columns:
+        series = out[col]
+        if pd.api.types.is_integer_dtype(series):
+            out[col] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series):
+            out[col] = pd.to_numeric(series, downcast="float")
+        elif series.dtype == object and len(series) > 1:
+            try:
+                if series.nunique(dropna=False) <= len(series) // 2:
+                    out[col] = series.astype("category")
+            except TypeError:
+                pass  # unhashable values (lists, dicts) stay as they are
+    return out
+
+
+# =====================================================================
+# Per-session budget
+# =====================================================================
+def _session_id():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+    except Exception:
+        return None
+    return ctx.session_id if ctx is not None else None
+
+
+def _note_session(page, ledger, evictions=0):
+    session = _session_id()
+    if session is None:
+        return
+    with _lock:
+        entry = _sessions.get(session) or {"session": session[:8], "evictions": 0, "compactions": 0}
+        entry["page"] = page
+        entry["frames"] = sum(1 for v in ledger.values() if v["bytes"])
+        entry["stored_kib"] = round(sum(v["bytes"] for v in ledger.values()) / 1024, 1)
+        entry["compactions"] = sum(1 for v in ledger.values() if v["compacted"])
+        entry["evictions"] += evictions
+        entry["last_seen"] = time.strftime("%H:%M:%S")
+        _sessions[session] = entry
+        _sessions.move_to_end(session)
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last=False)
+
+
+def store_frame(key: str, df, page: str = None):
+    """
+    Keep df in st.session_state[key] within the session's SESSION_BUDGET_MB.
+    Older frames are compacted, then evicted (set to None), to make room.
+    """
+    ledger = st.session_state.setdefault(_LEDGER_KEY, {})
+    ledger.pop(key, None)  # re-storing a key makes it the newest
+    st.session_state[key] = df
+    ledger[key] = {"bytes": frame_bytes(df), "compacted": False}
+
+    budget = SESSION_BUDGET_MB * 1024 * 1024
+    evictions = 0
+    if sum(v["bytes"] for v in ledger.values()) > budget:
+        # Oldest first; the frame just stored is compacted last and never evicted.
+        for k, info in ledger.items():
+            if info["bytes"] and not info["compacted"]:
+                st.session_state[k] = compact(st.session_state[k])
+                info.update(bytes=frame_bytes(st.session_state[k]), compacted=True)
+                if sum(v["bytes"] for v in ledger.values()) <= budget:
+                    break
+        for k, info in ledger.items():
+            if sum(v["bytes"] for v in ledger.values()) <= budget or k == key:
+                break
+            if info["bytes"]:
+                st.session_state[k] = None
+                info["bytes"] = 0
+                evictions += 1
+
+    _note_session(page or "other", ledger, evictions)
+    return st.session_state[key]
+
+
+def drop_frames(*keys, page: str = None):
+    """Release stored frames (e.g. when a flow is reset) and update the ledger."""
+    ledger = st.session_state.setdefault(_LEDGER_KEY, {})
+    for key in keys:
+        st.session_state[key] = None
+        ledger.pop(key, None)
+    _note_session(page or "other", ledger)
+
+
+def session_summary() -> list:
+    """One dict per recently seen session, largest stored frames first."""
+    with _lock:
+        rows = [dict(v) for v in _sessions.values()]
+    return sorted(rows, key=lambda r: r["stored_kib"], reverse=True)
+
+
+# =====================================================================
+# Process and page reporting
+# =====================================================================
+def rss_bytes() -> int:
+    """Current resident set size of this process (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def traced() -> dict:
+    """tracemalloc current/peak in bytes, or None when tracing is off."""
+    if not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    return {"current": current, "peak": peak}
+
+
+def _app_frame(traceback):
+    """Most recent frame of an allocation that is inside Application/ (None for library-only stacks)."""
+    for frame in reversed(traceback):  # tracemalloc orders frames oldest first
+        if frame.filename.startswith(_APP_DIR):
+            return frame
+    return None
+
+
+def _page_of(traceback):
+    """Page script on the allocation's stack, else the nearest app module (like instrumentation._current_page())."""
+    nearest = _app_frame(traceback)
+    if nearest is None:
+        return None
+    for frame in traceback:
+        name = os.path.splitext(os.path.basename(frame.filename))[0]
+        if frame.filename.startswith(_APP_DIR) and (
+            os.path.basename(os.path.dirname(frame.filename)) == "Pages" or name == "app"
+        ):
+            return name
+    return os.path.splitext(os.path.basename(nearest.filename))[0]
+
+
+def page_allocations() -> list:
+    """Live traced allocations grouped by the page (or app module) that made them."""
+    if not tracemalloc.is_tracing():
+        return []
+    totals = collections.defaultdict(lambda: [0, 0])
+    for stat in tracemalloc.take_snapshot().statistics("traceback"):
+        page = _page_of(stat.traceback)
+        if page is not None:
+            totals[page][0] += stat.size
+            totals[page][1] += stat.count
+    return sorted(
+        ({"page": page, "live_kib": round(size / 1024, 1), "blocks": count} for page, (size, count) in totals.items()),
+        key=lambda r: r["live_kib"], reverse=True,
+    )
+
+
+def top_sites(limit=15) -> list:
+    """Largest live allocations grouped by the line in Application/ that caused them."""
+    if not tracemalloc.is_tracing():
+        return []
+    totals = collections.defaultdict(lambda: [0, 0])
+    for stat in tracemalloc.take_snapshot().statistics("traceback"):
+        frame = _app_frame(stat.traceback)
+        if frame is not None:
+            site = f"{os.path.relpath(frame.filename, _APP_DIR)}:{frame.lineno}"
+            totals[site][0] += stat.size
+            totals[site][1] += stat.count
+    rows = sorted(totals.items(), key=lambda kv: kv[1][0], reverse=True)[:limit]
+    return [{"site": site, "live_kib": round(size / 1024, 1), "blocks": count} for site, (size, count) in rows]
@@ -0,0 +1,195 @@
+"""
+Patient medication history: what a patient was prescribed and dispensed, newest first.
+
+A history page is two prepared statements (statements.py), each a handful
+of index lookups (Performance_Script.sql section 11):
+
+    patient_prescriptions  PATIENT_HISTORY_PAGE_SIZE prescriptions, keyset-paginated
+                           on (rx_date, rx_id) descending from the patient's index
+    patient_rx_items       their items, the dispenses and lots each item was filled
+                           from, and the dispense's insurance cover (DISPENSE_BALANCE)
+
+so a page costs the same whether the patient has ten prescriptions or
+ten thousand, and page 50 costs the same as page 1. Dispenses already moved
+to the Parquet archive (archive.py) are merged in from the page's
+prescriptions (archived = True); the read is pruned to the months since the
+page's oldest prescription, so recent pages skip most of the archive.
+
+Pages are kept in a small in-process cache for PATIENT_HISTORY_CACHE_SECONDS,
+because the counter reruns the same lookup on every interaction. Every write
+path of the pages and the API calls `invalidate()` in its own process: with the
+patient after a dispense, without one (whole cache) after reversals, fills,
+payments and remittances, whose patients are not at hand. Writes from another
+process (the refill CLI, the API for the pages and vice versa) show up once
+the cached page expires, so PATIENT_HISTORY_CACHE_SECONDS bounds the staleness.
+
+Usage:
+    page = patient_history.history(1001)
+    page.prescriptions, page.items          # DataFrames
+    older = patient_history.history(1001, cursor=page.next_cursor)
+"""
+import collections
+import datetime as dt
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import pandas as pd
+
+import archive
+import statements
+from db import run_query
+
+PATIENT_HISTORY_PAGE_SIZE = int(os.getenv("PATIENT_HISTORY_PAGE_SIZE", "20"))
+PATIENT_HISTORY_CACHE_SECONDS = float(os.getenv("PATIENT_HISTORY_CACHE_SECONDS", "30"))
+PATIENT_HISTORY_CACHE_SIZE = int(os.getenv("PATIENT_HISTORY_CACHE_SIZE", "500"))
+
+# Keyset position before the newest prescription.
+_FIRST_PAGE = (dt.date.max, 2**31 - 1)
+
+_cache = collections.OrderedDict()   # (patient_id, cursor, page_size) -> (expires at, HistoryPage)
+_cache_lock = threading.Lock()
+_counts = collections.Counter()      # "hits" / "misses"
+
+
+@dataclass
+class HistoryPage:
+    patient_id: int
+    # rx_id, rx_date, status, urgency, doctor, pharmacist; newest first
+    prescriptions: pd.DataFrame
+    # one row per prescription item and lot it was dispensed from (dispense columns empty if never
+    # dispensed); `archived` marks fills read back from the Parquet archive
+    items: pd.DataFrame
+    # (rx_date, rx_id) to pass as `cursor` for the next, older page; None on the last page
+    next_cursor: Optional[Tuple[dt.date, int]] = None
+
+
+def find_patients(text, limit=20) -> pd.DataFrame:
+    """patient_id, name, date_of_birth of patients whose name contains `text` (or whose ID it is)."""
+    text = (text or "").strip()
+    patient_id = int(text) if text.isdigit() else None
+    return statements.query("patient_find", (text, patient_id, int(limit)))
+
+
+def _cached(key):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _cache.move_to_end(key)
+            _counts["hits"] += 1
+            return entry[1]
+        _counts["misses"] += 1
+        return None
+
+
+def _store(key, page):
+    with _cache_lock:
+        _cache[key] = (time.monotonic() + PATIENT_HISTORY_CACHE_SECONDS, page)
+        _cache.move_to_end(key)
+        while len(_cache) > PATIENT_HISTORY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+# Columns of `patient_rx_items` that describe the fill rather than the prescribed item.
+_FILL_COLUMNS = [
+    "dispense_id", "dispense_date", "lot_batch_id", "expiry_date", "qty_dispensed",
+    "total_amount", "covered_total", "remaining", "insurers",
+]
+
+
+def _with_archived_fills(prescriptions, items, pin_primary) -> pd.DataFrame:
+    """`items` plus the archived fills of the page's prescriptions, flagged in an `archived` column."""
+    items = items.assign(archived=False)
+    if prescriptions.empty or not archive.has_archive("dispense"):
+        return items
+    rx_ids = [int(x) for x in prescriptions["rx_id"]]
+    # Nothing is dispensed before it is prescribed, so older months are never read.
+    since = [("dispense_date", ">=", pd.Timestamp(prescriptions["rx_date"].min()).date())]
+    dispenses = archive.read_archive(
+        "dispense", columns=["dispense_id", "rx_id", "dispense_date", "total_amount"],
+        filters=[("rx_id", "in", rx_ids)] + since,
+    )
+    if dispenses.empty:
+        return items
+
+    key = [("dispense_id", "in", [int(x) for x in dispenses["dispense_id"]])] + since
+    lines = archive.read_archive("dispensed_items", columns=["dispense_id", "lot_batch_id", "qty_dispensed"], filters=key)
+    pays = archive.read_archive("pays", columns=["dispense_id", "policy_id", "amount_covered"], filters=key)
+    lots = run_query(
+        "SELECT lot_batch_id, drug_id, expiry_date FROM inventory_lot WHERE lot_batch_id = ANY(%s);",
+        params=([int(x) for x in lines["lot_batch_id"]],), pin_primary=pin_primary,
+    )
+    insurers = run_query(
+        "SELECT policy_id, company FROM insurance WHERE policy_id = ANY(%s);",
+        params=([int(x) for x in pays["policy_id"]],), pin_primary=pin_primary,
+    )
+    cover = (
+        pays.merge(insurers, on="policy_id", how="left")
+        .groupby("dispense_id", as_index=False)
+        .agg(covered_total=("amount_covered", "sum"), insurers=("company", lambda c: ", ".join(sorted(c.dropna()))))
+    )
+    fills = (
+        lines.merge(dispenses, on="dispense_id")
+        .merge(lots, on="lot_batch_id")
+        .merge(cover, on="dispense_id", how="left")
+    )
+    fills["covered_total"] = fills["covered_total"].fillna(0)
+    fills["remaining"] = fills["total_amount"] - fills["covered_total"]
+
+    prescribed = items.drop(columns=_FILL_COLUMNS + ["archived"]).drop_duplicates(["rx_id", "drug_id"])
+    fills = prescribed.merge(fills, on=["rx_id", "drug_id"]).assign(archived=True)
+    # An item whose fills are all archived is no longer "never dispensed".
+    filled = pd.MultiIndex.from_frame(fills[["rx_id", "drug_id"]])
+    unfilled = items["dispense_id"].isna() & pd.MultiIndex.from_frame(items[["rx_id", "drug_id"]]).isin(filled)
+    return pd.concat([items[~unfilled], fills[items.columns]], ignore_index=True).sort_values(
+        ["rx_id", "drug_name", "dispense_date", "dispense_id"],
+        ascending=[False, True, False, False], na_position="last", ignore_index=True,
+    )
+
+
+def history(patient_id, cursor=None, page_size=None, pin_primary=False) -> HistoryPage:
+    """One page of a patient's history, starting after `cursor` (None for the newest prescriptions)."""
+    page_size = int(page_size or PATIENT_HISTORY_PAGE_SIZE)
+    cursor = tuple(cursor) if cursor is not None else None
+    key = (int(patient_id), cursor, page_size)
+    page = None if pin_primary else _cached(key)
+    if page is None:
+        rx_date, rx_id = cursor or _FIRST_PAGE
+        # One extra row tells whether there is an older page.
+        prescriptions = statements.query(
+            "patient_prescriptions", (int(patient_id), rx_date, int(rx_id), page_size + 1), pin_primary=pin_primary
+        )
+        next_cursor = None
+        if len(prescriptions) > page_size:
+            prescriptions = prescriptions.head(page_size)
+            last = prescriptions.iloc[-1]
+            next_cursor = (last["rx_date"], int(last["rx_id"]))
+        rx_ids = [int(x) for x in prescriptions["rx_id"]]
+        items = statements.query("patient_rx_items", (rx_ids,), pin_primary=pin_primary)
+        items = _with_archived_fills(prescriptions, items, pin_primary)
+        page = HistoryPage(int(patient_id), prescriptions, items, next_cursor)
+        _store(key, page)
+    # Callers may add columns; the cached frames stay as they were.
+    return HistoryPage(page.patient_id, page.prescriptions.copy(), page.items.copy(), page.next_cursor)
+
+
+def invalidate(patient_id=None):
+    """Drop the cached pages of one patient, or of every patient when `patient_id` is None."""
+    with _cache_lock:
+        if patient_id is None:
+            _cache.clear()
+            return
+        for key in [k for k in _cache if k[0] == int(patient_id)]:
+            del _cache[key]
+
+
+def cache_stats() -> dict:
+    with _cache_lock:
+        return {"entries": len(_cache), "hits": _counts["hits"], "misses": _counts["misses"]}
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
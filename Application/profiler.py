@@ -0,0 +1,225 @@
+"""
+Opt-in per-rerun profiler for the Streamlit pages.
+
+Turn it on with `?profile=1` in the URL or the "Profile this page" toggle in
+the sidebar. While it is on, every rerun of a page records:
+
+* wall-clock spans for each script section (`mark()` / `section()`),
+* one span per database statement (hooked into instrumentation.py),
+* a cProfile of the whole rerun, split into Python / pandas / Plotly /
+  Streamlit / database driver time.
+
+At `finish()` the rerun is written to PROFILE_DIR as a `.folded` file
+(collapsed stacks for flamegraph.pl, speedscope or inferno) and a `.prof`
+file (pstats, for snakeviz), and a summary of the costliest sections is
+shown in the sidebar.
+
+Usage in a page:
+    profiler.start("2_Dispense")
+    profiler.mark("load dropdowns")
+    ...
+    profiler.finish()
+"""
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+
+import pandas as pd
+import streamlit as st
+
+import instrumentation
+
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics", "profiles"),
+)
+
+# Library time is grouped by the first matching path fragment of each function's file.
+_CATEGORIES = [
+    ("pandas", (os.sep + "pandas" + os.sep, os.sep + "numpy" + os.sep)),
+    ("plotly", (os.sep + "plotly" + os.sep,)),
+    ("database driver", (os.sep + "psycopg" + os.sep, os.sep + "psycopg_binary" + os.sep)),
+    ("streamlit", (os.sep + "streamlit" + os.sep,)),
+]
+
+_local = threading.local()
+
+
+class _Run:
+    def __init__(self, page):
+        self.page = page
+        self.started = time.perf_counter()
+        self.stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.spans = []          # (path tuple, start, end, kind)
+        self.stack = []          # open nested sections: (name, start)
+        self.current = None      # open flat section from mark(): (name, start)
+        self.profile = cProfile.Profile()
+
+    def path(self):
+        names = [self.page]
+        if self.current:
+            names.append(self.current[0])
+        names += [name for name, _ in self.stack]
+        return tuple(names)
+
+
+def _enabled() -> bool:
+    default = st.query_params.get("profile") == "1"
+    return st.sidebar.toggle("Profile this page", value=default, key="_profile_enabled",
+                             help="Record section, database and cProfile timings for every rerun.")
+
+
+def start(page: str):
+    """
+    Begin profiling this rerun if profiling is on. Call right after
+    st.set_page_config() on every page: it also starts the rerun that
+    instrumentation.py attributes the page's statements to.
+    """
+    # A previous rerun that ended in st.stop()/st.rerun() never reached finish(); save it now.
+    pending = st.session_state.pop("_profiler_run", None)
+    if pending is not None:
+        _finalise(pending)
+    # Numbers this session's reruns, so instrumentation.py can group statements per rerun.
+    st.session_state["_rerun_seq"] = st.session_state.get("_rerun_seq", 0) + 1
+
+    _local.run = None
+    if not _enabled():
+        return
+    run = _Run(page)
+    st.session_state["_profiler_run"] = run
+    _local.run = run
+    run.profile.enable()
+
+
+def mark(name: str):
+    """Close the current top-level section and open a new one (for straight-line page scripts)."""
+    run = getattr(_local, "run", None)
+    if run is None:
+        return
+    now = time.perf_counter()
+    if run.current:
+        run.spans.append(((run.page, run.current[0]), run.current[1], now, "section"))
+    run.current = (name, now)
+
+
+@contextlib.contextmanager
+def section(name: str):
+    """Nested span inside the current section."""
+    run = getattr(_local, "run", None)
+    if run is None:
+        yield
+        return
+    run.stack.append((name, time.perf_counter()))
+    try:
+        yield
+    finally:
+        path = run.path()
+        _, began = run.stack.pop()
+        run.spans.append((path, began, time.perf_counter(), "section"))
+
+
+def _on_statement(sql, normalised, query_id, page, elapsed_ms, rows, params):
+    """instrumentation listener: one span per statement, under the section that issued it."""
+    run = getattr(_local, "run", None)
+    if run is None:
+        return
+    end = time.perf_counter()
+    run.spans.append((run.path() + (f"db:{query_id}",), end - elapsed_ms / 1000, end, "db"))
+
+
+instrumentation.add_listener(_on_statement)
+
+
+# =====================================================================
+# Finishing a rerun
+# =====================================================================
+def _close(run):
+    now = time.perf_counter()
+    run.profile.disable()
+    if run.current:
+        run.spans.append(((run.page, run.current[0]), run.current[1], now, "section"))
+        run.current = None
+    run.spans.append(((run.page,), run.started, now, "page"))
+
+
+def _self_times(run) -> dict:
+    """Self time in microseconds per stack path (a span minus its direct children)."""
+    totals = {}
+    for path, began, ended, _ in run.spans:
+        totals[path] = totals.get(path, 0.0) + (ended - began)
+    selfs = dict(totals)
+    for path, total in totals.items():
+        if len(path) > 1 and path[:-1] in selfs:
+            selfs[path[:-1]] -= total
+    return {path: max(int(t * 1_000_000), 0) for path, t in selfs.items()}
+
+
+def _categories(run) -> dict:
+    stats = pstats.Stats(run.profile)
+    by_category = {}
+    for (filename, _, _), (_, _, tottime, _, _) in stats.stats.items():
+        category = next((c for c, frags in _CATEGORIES if any(f in filename for f in frags)), "python / other")
+        by_category[category] = by_category.get(category, 0.0) + tottime
+    return by_category
+
+
+def _finalise(run) -> dict:
+    """Stop the run, write its .folded and .prof files, and return a summary."""
+    _close(run)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{run.page}-{run.stamp}-{id(run) % 10000:04d}")
+
+    with open(base + ".folded", "w") as f:
+        for path, micros in sorted(_self_times(run).items()):
+            if micros > 0:
+                f.write(";".join(p.replace(";", ",").replace(" ", "_") for p in path) + f" {micros}\n")
+    run.profile.dump_stats(base + ".prof")
+
+    sections = {}
+    db_ms = 0.0
+    for path, began, ended, kind in run.spans:
+        if kind == "db":
+            db_ms += (ended - began) * 1000
+        elif kind == "section":
+            name = " / ".join(path[1:])
+            sections[name] = sections.get(name, 0.0) + (ended - began) * 1000
+
+    return {
+        "wall_ms": (time.perf_counter() - run.started) * 1000,
+        "db_ms": db_ms,
+        "sections": sorted(sections.items(), key=lambda kv: kv[1], reverse=True),
+        "categories": _categories(run),
+        "files": base,
+        "profile": run.profile,
+    }
+
+
+def finish():
+    """End profiling for this rerun and show where the time went. Call at the very end of the page."""
+    run = st.session_state.pop("_profiler_run", None)
+    _local.run = None
+    if run is None:
+        return
+    summary = _finalise(run)
+
+    with st.sidebar.expander("Profile of this rerun", expanded=True):
+        st.markdown(f"**{summary['wall_ms']:.0f} ms** wall, of which **{summary['db_ms']:.0f} ms** in SQL")
+        st.dataframe(
+            pd.DataFrame(summary["sections"], columns=["Section", "ms"]).round(1),
+            hide_index=True, use_container_width=True,
+        )
+        st.caption("CPU time by library (cProfile)")
+        st.dataframe(
+            pd.DataFrame(sorted(summary["categories"].items(), key=lambda kv: kv[1], reverse=True),
+                         columns=["Library", "s"]).round(3),
+            hide_index=True, use_container_width=True,
+        )
+        out = io.StringIO()
+        pstats.Stats(summary["profile"], stream=out).sort_stats("cumulative").print_stats(12)
+        with st.popover("Top functions"):
+            st.code(out.getvalue(), language="text")
+        st.caption(f"Saved `{os.path.basename(summary['files'])}.folded` / `.prof` in `{PROFILE_DIR}`")
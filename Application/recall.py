@@ -0,0 +1,203 @@
+"""
+Lot recall impact: which dispenses, and which patients, received a recalled batch.
+
+The trace walks DISPENSED_ITEMS -> DISPENSE -> PRESCRIPTION -> PATIENT in
+one set-based query for all recalled lots at once. It starts from the
+covering index idx_dispensed_items_lot (Performance_Script.sql section 4);
+every later join is a primary key lookup, so the cost grows with the
+number of affected dispenses, not with the size of the history. Dispenses
+already moved to the Parquet archive (archive.py) are traced too.
+
+The live part is read through a server-side cursor in batches of
+RECALL_FETCH_ROWS, so `iter_trace()` / `iter_csv()` can stream a large
+recall to a file or an HTTP response without holding it in memory.
+
+Quarantining the lots (no more dispensing from them) is a write and lives
+in services.quarantine_lots().
+
+Usage:
+    lots = recall.resolve_lots(drug_id=2003, expiry_from=date(2026, 3, 1), expiry_to=date(2026, 3, 31))
+    patients = recall.affected_patients(lots)
+    for chunk in recall.iter_csv(lots):
+        out.write(chunk)
+"""
+import csv
+import io
+import os
+
+import pandas as pd
+
+from archive import read_archive
+from db import get_read_connection, run_query
+
+RECALL_FETCH_ROWS = int(os.getenv("RECALL_FETCH_ROWS", "5000"))
+
+TRACE_COLUMNS = [
+    "lot_batch_id", "drug_name", "expiry_date", "dispense_id", "dispense_date", "qty_dispensed",
+    "rx_id", "patient_id", "patient_name", "date_of_birth", "doctor_id", "pharmacist_id", "archived",
+]
+
+_TRACE_LIVE = """
+    SELECT
+        di.lot_batch_id,
+        dc.drug_name,
+        il.expiry_date,
+        dp.dispense_id,
+        dp.dispense_date,
+        di.qty_dispensed,
+        rx.rx_id,
+        p.patient_id,
+        p.name AS patient_name,
+        p.date_of_birth,
+        rx.doctor_id,
+        dp.pharmacist_id,
+        FALSE AS archived
+    FROM dispensed_items di
+    JOIN dispense dp        ON dp.dispense_id = di.dispense_id
+    JOIN prescription rx    ON rx.rx_id = dp.rx_id
+    JOIN patient p          ON p.patient_id = rx.patient_id
+    JOIN inventory_lot il   ON il.lot_batch_id = di.lot_batch_id
+    JOIN drug_catalogue dc  ON dc.drug_id = il.drug_id
+    WHERE di.lot_batch_id = ANY(%s)
+    ORDER BY p.patient_id, dp.dispense_date, dp.dispense_id;
+"""
+
+
+def resolve_lots(lot_ids=None, drug_id=None, expiry_from=None, expiry_to=None) -> list:
+    """
+    The recalled lots: the given IDs that exist, or every lot of `drug_id`
+    whose expiry date falls in [expiry_from, expiry_to] (either end optional).
+    """
+    if lot_ids:
+        df = run_query(
+            "SELECT lot_batch_id FROM inventory_lot WHERE lot_batch_id = ANY(%s) ORDER BY lot_batch_id;",
+            params=([int(x) for x in lot_ids],),
+        )
+    elif drug_id is not None:
+        df = run_query(
+            """
+            SELECT lot_batch_id FROM inventory_lot
+            WHERE drug_id = %s
+              AND (%s::date IS NULL OR expiry_date >= %s::date)
+              AND (%s::date IS NULL OR expiry_date <= %s::date)
+            ORDER BY lot_batch_id;
+            """,
+            params=(int(drug_id), expiry_from, expiry_from, expiry_to, expiry_to),
+        )
+    else:
+        raise ValueError("Give lot IDs or a drug ID.")
+    return [int(x) for x in df["lot_batch_id"]]
+
+
+def _archived_trace(lot_ids) -> pd.DataFrame:
+    """Archived dispensed items of the lots, joined to the (live) prescriptions and patients."""
+    items = read_archive(
+        "dispensed_items",
+        columns=["lot_batch_id", "dispense_id", "qty_dispensed", "dispense_date"],
+        filters=[("lot_batch_id", "in", list(lot_ids))],
+    )
+    if items.empty:
+        return pd.DataFrame(columns=TRACE_COLUMNS)
+    dispenses = read_archive(
+        "dispense",
+        columns=["dispense_id", "rx_id", "pharmacist_id"],
+        filters=[("dispense_id", "in", items["dispense_id"].astype(int).unique().tolist())],
+    )
+    people = run_query(
+        """
+        SELECT rx.rx_id, p.patient_id, p.name AS patient_name, p.date_of_birth, rx.doctor_id
+        FROM prescription rx JOIN patient p ON p.patient_id = rx.patient_id
+        WHERE rx.rx_id = ANY(%s);
+        """,
+        params=(dispenses["rx_id"].astype(int).unique().tolist(),),
+    )
+    lots = run_query(
+        """
+        SELECT il.lot_batch_id, dc.drug_name, il.expiry_date
+        FROM inventory_lot il JOIN drug_catalogue dc ON dc.drug_id = il.drug_id
+        WHERE il.lot_batch_id = ANY(%s);
+        """,
+        params=(list(lot_ids),),
+    )
+    df = items.merge(dispenses, on="dispense_id").merge(people, on="rx_id").merge(lots, on="lot_batch_id")
+    df["archived"] = True
+    return df[TRACE_COLUMNS].sort_values(["patient_id", "dispense_date", "dispense_id"])
+
+
+def iter_trace(lot_ids, include_archive=True):
+    """Yield one tuple (TRACE_COLUMNS) per dispensed item from the lots: live rows first, then archived."""
+    lot_ids = [int(x) for x in lot_ids]
+    if not lot_ids:
+        return
+    conn = get_read_connection()
+    try:
+        # Named cursor = server-side: rows arrive RECALL_FETCH_ROWS at a time.
+        with conn.cursor(name="recall_trace") as cur:
+            cur.itersize = RECALL_FETCH_ROWS
+            cur.execute(_TRACE_LIVE, (lot_ids,))
+            for row in cur:
+                yield row
+    finally:
+        conn.close()
+    if include_archive:
+        yield from _archived_trace(lot_ids).itertuples(index=False, name=None)
+
+
+def iter_csv(lot_ids, include_archive=True):
+    """The trace as CSV text, header first, in chunks of up to RECALL_FETCH_ROWS rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(TRACE_COLUMNS)
+    for i, row in enumerate(iter_trace(lot_ids, include_archive), start=1):
+        writer.writerow(row)
+        if i % RECALL_FETCH_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def trace(lot_ids, include_archive=True) -> pd.DataFrame:
+    return pd.DataFrame.from_records(list(iter_trace(lot_ids, include_archive)), columns=TRACE_COLUMNS)
+
+
+def affected_patients(lot_ids, trace_df=None) -> pd.DataFrame:
+    """One row per patient who received any of the lots, most recent dispense first."""
+    df = trace(lot_ids) if trace_df is None else trace_df
+    if df.empty:
+        return pd.DataFrame(columns=["patient_id", "patient_name", "date_of_birth", "dispenses", "qty", "lots", "last_dispensed"])
+    return (
+        df.groupby(["patient_id", "patient_name", "date_of_birth"], as_index=False)
+        .agg(
+            dispenses=("dispense_id", "nunique"),
+            qty=("qty_dispensed", "sum"),
+            lots=("lot_batch_id", lambda s: ", ".join(str(x) for x in sorted(set(s)))),
+            last_dispensed=("dispense_date", "max"),
+        )
+        .sort_values("last_dispensed", ascending=False)
+    )
+
+
+def lot_summary(lot_ids, trace_df=None) -> pd.DataFrame:
+    """Per recalled lot: stock still on hand, quarantine state, and how much reached patients."""
+    lot_ids = [int(x) for x in lot_ids]
+    stock = run_query(
+        """
+        SELECT s.lot_batch_id, dc.drug_name, s.expiry_date, s.qty_on_hand, s.quarantined
+        FROM available_stock s JOIN drug_catalogue dc ON dc.drug_id = s.drug_id
+        WHERE s.lot_batch_id = ANY(%s)
+        ORDER BY s.lot_batch_id;
+        """,
+        params=(lot_ids,),
+        pin_primary=True,
+    )
+    df = trace(lot_ids) if trace_df is None else trace_df
+    reached = (
+        df.groupby("lot_batch_id", as_index=False)
+        .agg(dispenses=("dispense_id", "nunique"), patients=("patient_id", "nunique"), qty_dispensed=("qty_dispensed", "sum"))
+        if not df.empty else pd.DataFrame(columns=["lot_batch_id", "dispenses", "patients", "qty_dispensed"])
+    )
+    out = stock.merge(reached, on="lot_batch_id", how="left")
+    for col in ("dispenses", "patients", "qty_dispensed"):
+        out[col] = out[col].fillna(0).astype(int)
+    return out
@@ -0,0 +1,74 @@
+"""
+Headless pharmacy services.
+
+The transaction logic behind the Streamlit pages, as plain functions that
+take an open psycopg connection and return dataclasses. The pages, the HTTP
+API (api.py) and batch jobs all go through these, so a dispense made at a
+barcode station follows exactly the same rules as one made in the UI.
+
+    from db import get_connection
+    from services import DispenseRequest, dispense
+
+    conn = get_connection()
+    try:
+        result = dispense(conn, DispenseRequest(...))
+    finally:
+        conn.close()
+
+Every function commits on success and rolls back (and re-raises) on failure.
+Lock timeouts, deadlocks, serialization failures and auto-assigned ID
+collisions are retried a few times with jitter first (retry_on_conflict).
+Business-rule violations raise ServiceError / NotFoundError; database
+constraint and trigger violations surface as psycopg errors.
+
+Every change is audited by triggers (AUDIT_LOG); wrap calls in
+acting_as(...) to record who made them.
+"""
+from services.audit import drain_audit, start_audit_drainer
+from services.common import NotFoundError, ServiceError, acting_as, current_actor, next_id, retry_stats
+from services.dispense import (
+    BulkReversalResult,
+    DispenseRequest,
+    DispenseResult,
+    ReversalResult,
+    dispense,
+    reverse_dispense,
+    reverse_dispenses,
+)
+from services.insurance import Coverage, PaymentResult, coverage, record_payment, undo_payment
+from services.orders import (
+    OrderItem,
+    OrderRequest,
+    OrderResult,
+    OrderRevision,
+    cancel_order,
+    create_order,
+    revise_order,
+)
+from services.quarantine import QuarantineResult, quarantine_lots, release_quarantine
+from services.remittance import (
+    RemittanceException,
+    RemittanceLine,
+    RemittanceResult,
+    import_remittance,
+    parse_remittance,
+)
+from services.refills import RefillRunResult, process_refills, refills_due
+from services.reservations import Reservation, expire_holds, hold, release, start_sweeper
+from services.rx_queue import FillResult, QueueItem, claim_next, fill_claimed, heartbeat, queue_depth, release_claim
+from services.stock import refresh_stale_stock, set_reorder_levels
+
+__all__ = [
+    "ServiceError", "NotFoundError", "retry_stats", "acting_as", "current_actor", "next_id",
+    "drain_audit", "start_audit_drainer",
+    "DispenseRequest", "DispenseResult", "ReversalResult", "BulkReversalResult",
+    "dispense", "reverse_dispense", "reverse_dispenses",
+    "Coverage", "PaymentResult", "coverage", "record_payment", "undo_payment",
+    "OrderItem", "OrderRequest", "OrderResult", "OrderRevision", "create_order", "revise_order", "cancel_order",
+    "QuarantineResult", "quarantine_lots", "release_quarantine",
+    "RemittanceLine", "RemittanceException", "RemittanceResult", "import_remittance", "parse_remittance",
+    "RefillRunResult", "process_refills", "refills_due",
+    "Reservation", "hold", "release", "expire_holds", "start_sweeper",
+    "set_reorder_levels", "refresh_stale_stock",
+    "QueueItem", "FillResult", "claim_next", "heartbeat", "release_claim", "fill_claimed", "queue_depth",
+]
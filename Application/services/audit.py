@@ -0,0 +1,96 @@
+"""
+Drain the audit trail (Performance_Script.sql section 7).
+
+The audit triggers only append to the UNLOGGED table AUDIT_STAGING, so a
+dispense pays next to nothing for being audited. A background thread
+(start_audit_drainer()) moves the staged rows into the append-only AUDIT_LOG
+every AUDIT_DRAIN_SECONDS, AUDIT_DRAIN_ROWS at a time: one statement
+deletes a batch from staging and inserts it into the log, so a row is never
+lost or copied twice. SKIP LOCKED lets several processes drain side by side.
+
+Attribute changes to a person with acting_as():
+
+    with services.acting_as(f"pharmacist {pharmacist_id}"):
+        services.dispense(conn, request)
+"""
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from services.common import atomic
+
+AUDIT_DRAIN_SECONDS = float(os.getenv("AUDIT_DRAIN_SECONDS", "5"))
+AUDIT_DRAIN_ROWS = int(os.getenv("AUDIT_DRAIN_ROWS", "5000"))
+
+log = logging.getLogger(__name__)
+
+_drainer = None
+_drainer_lock = threading.Lock()
+
+_DRAIN_BATCH = """
+    WITH batch AS (
+        DELETE FROM audit_staging
+        WHERE audit_id IN (
+            SELECT audit_id FROM audit_staging ORDER BY audit_id LIMIT %s FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    )
+    INSERT INTO audit_log (audit_id, table_name, operation, old_row, new_row, actor, txid, changed_at)
+    SELECT audit_id, table_name, operation, old_row, new_row, actor, txid, changed_at FROM batch;
+"""
+
+
+def drain_audit(conn, batch_rows: int = AUDIT_DRAIN_ROWS) -> int:
+    """Move every staged audit row into AUDIT_LOG, one transaction per batch. Returns the rows moved."""
+    moved = 0
+    while True:
+        with atomic(conn) as cur:
+            cur.execute(_DRAIN_BATCH, (batch_rows,))
+            n = cur.rowcount
+        moved += n
+        if n < batch_rows:
+            return moved
+
+
+def _drain_forever(interval):
+    from db import get_connection
+
+    while True:
+        time.sleep(interval)
+        try:
+            conn = get_connection()
+            try:
+                moved = drain_audit(conn)
+            finally:
+                conn.close()
+            if moved:
+                log.debug("moved %d audit rows", moved)
+        except Exception:
+            log.exception("audit drain failed")
+
+
+def start_audit_drainer(interval: Optional[float] = None):
+    """Start the audit drainer once per process (a daemon thread; later calls do nothing)."""
+    global _drainer
+    with _drainer_lock:
+        if _drainer is None or not _drainer.is_alive():
+            _drainer = threading.Thread(
+                target=_drain_forever,
+                args=(interval or AUDIT_DRAIN_SECONDS,),
+                name="audit-drainer",
+                daemon=True,
+            )
+            _drainer.start()
+
+
+if __name__ == "__main__":
+    # From Application/: python -m services.audit  (drain once, e.g. from cron where no app process runs)
+    from db import get_connection
+
+    conn = get_connection()
+    try:
+        print(f"moved {drain_audit(conn)} audit rows")
+    finally:
+        conn.close()
@@ -0,0 +1,132 @@
+"""Shared pieces of the service layer: errors, the transaction helper, retries and ID allocation."""
+import collections
+import contextlib
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+
+from psycopg import errors
+
+# Bounded retry with full jitter for transactions that lost a race (see retry_on_conflict).
+TX_MAX_RETRIES = int(os.getenv("TX_MAX_RETRIES", "5"))
+TX_RETRY_BASE_MS = float(os.getenv("TX_RETRY_BASE_MS", "20"))
+TX_RETRY_CAP_MS = float(os.getenv("TX_RETRY_CAP_MS", "1000"))
+# How long a transaction waits for a row lock before giving up (and being retried). 0 = wait forever.
+TX_LOCK_TIMEOUT_MS = int(os.getenv("TX_LOCK_TIMEOUT_MS", "2000"))
+
+
+class ServiceError(Exception):
+    """A business rule was violated (e.g. amount above the remaining balance). Nothing was written."""
+
+
+class NotFoundError(ServiceError):
+    """The record the caller referred to does not exist (any more)."""
+
+
+class RetryableConflict(Exception):
+    """Raised inside a transaction for a race that a fresh attempt resolves (e.g. an auto-assigned ID taken meanwhile)."""
+
+
+RETRYABLE_ERRORS = (
+    errors.SerializationFailure,
+    errors.DeadlockDetected,
+    errors.LockNotAvailable,
+    RetryableConflict,
+)
+
+# Who is making the changes, recorded in AUDIT_LOG (see acting_as).
+_actor = contextvars.ContextVar("pharmacy_actor", default=None)
+
+_retry_counts = collections.Counter()  # (function, "retries" | "gave_up") -> count
+_retry_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def acting_as(actor):
+    """Attribute the transactions run inside the block to `actor` (e.g. "pharmacist 4") in the audit log."""
+    token = _actor.set(str(actor) if actor is not None else None)
+    try:
+        yield
+    finally:
+        _actor.reset(token)
+
+
+def current_actor():
+    """The actor set by the innermost acting_as() block, or None."""
+    return _actor.get()
+
+
+@contextlib.contextmanager
+def atomic(conn):
+    """
+    Run the block as one transaction on `conn` and yield a cursor.
+    Commits when the block finishes, rolls back on any exception and re-raises it.
+    """
+    try:
+        with conn.cursor() as cur:
+            actor = _actor.get()
+            if TX_LOCK_TIMEOUT_MS or actor:
+                # Both settings in the one round trip; they end with the transaction.
+                cur.execute(
+                    "SELECT set_config('lock_timeout', %s, true), set_config('pharmacy.actor', %s, true);",
+                    (f"{TX_LOCK_TIMEOUT_MS}ms", actor or ""),
+                )
+            yield cur
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def retry_on_conflict(fn):
+    """
+    Re-run a service function (which must do all its work inside atomic())
+    after serialization failures, deadlocks, lock timeouts and RetryableConflict,
+    sleeping a random 0..min(cap, base * 2^attempt) ms in between.
+    The last error is re-raised after TX_MAX_RETRIES retries.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(TX_MAX_RETRIES + 1):
+            try:
+                return fn(*args, **kwargs)
+            except RETRYABLE_ERRORS:
+                outcome = "gave_up" if attempt == TX_MAX_RETRIES else "retries"
+                with _retry_lock:
+                    _retry_counts[(fn.__name__, outcome)] += 1
+                if outcome == "gave_up":
+                    raise
+                time.sleep(random.uniform(0, min(TX_RETRY_CAP_MS, TX_RETRY_BASE_MS * 2 ** attempt)) / 1000)
+    return wrapper
+
+
+def retry_stats() -> dict:
+    """{(function, "retries" | "gave_up"): count} since start (or the last reset)."""
+    with _retry_lock:
+        return dict(_retry_counts)
+
+
+def reset_retry_stats():
+    with _retry_lock:
+        _retry_counts.clear()
+
+
+def next_id(cur, table_name: str, id_col: str) -> int:
+    """
+    MAX + 1 for tables whose keys are assigned by the application (no sequences
+    in the schema). Archived IDs (ARCHIVE_HIGH_WATER, written by archive.py)
+    are never handed out again.
+    """
+    cur.execute(
+        f"""
+        SELECT GREATEST(
+            (SELECT COALESCE(MAX({id_col}), 0) FROM {table_name}),
+            (SELECT COALESCE(MAX(max_id), 0) FROM archive_high_water WHERE table_name = %s)
+        ) + 1;
+        """,
+        (table_name.lower(),),
+    )
+    return int(cur.fetchone()[0])
@@ -0,0 +1,366 @@
+"""
+Dispensing (Tx1) and dispense reversal (Tx2).
+
+Inventory is reduced by the AFTER INSERT trigger on dispensed_items, which
+also rejects expired lots and quantities above qty_on_hand; those trigger
+errors surface as psycopg exceptions and roll the whole dispense back.
+
+The chosen lot is locked (SELECT ... FOR UPDATE) before anything is
+written, so concurrent dispenses from the same lot queue up on that row
+instead of racing the stock check. Stock held by other counters
+(services/reservations.py) does not count as available; the dispensing
+counter's own hold is consumed in the same transaction. Lock timeouts,
+deadlocks and ID collisions are retried by retry_on_conflict.
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import List, Optional
+
+from psycopg import errors
+
+from archive import archived_last_fills, is_archived_id
+from services.common import NotFoundError, RetryableConflict, ServiceError, atomic, next_id, retry_on_conflict
+from services.quarantine import is_quarantined
+from services.reservations import held_by_others
+
+COMMISSION_RATE = Decimal("0.05")
+
+
+@dataclass
+class DispenseRequest:
+    pharmacist_id: int
+    patient_id: int
+    doctor_id: int
+    drug_id: int
+    lot_batch_id: int
+    qty_prescribed: int
+    qty_dispensed: int
+    urgency: str = "High"
+    dosage: str = ""
+    frequency: str = ""
+    refills_allowed: int = 0
+    # Leave the IDs empty to have the next free ones assigned inside the transaction.
+    rx_id: Optional[int] = None
+    dispense_id: Optional[int] = None
+    line_item_id: Optional[int] = None
+    # Session / client whose stock hold (reservations.hold) this dispense consumes.
+    holder: Optional[str] = None
+
+
+@dataclass
+class DispenseResult:
+    rx_id: int
+    dispense_id: int
+    line_item_id: int
+    lot_batch_id: int
+    qty_dispensed: int
+    unit_cost: Decimal
+    total_amount: Decimal
+    commission: Decimal
+    qty_on_hand_after: int
+
+
+@dataclass
+class ReversalResult:
+    dispense_id: int
+    rx_id: int
+    # (lot_batch_id, quantity put back) per lot
+    restored: List[tuple] = field(default_factory=list)
+
+
+@dataclass
+class BulkReversalResult:
+    dispense_ids: List[int]
+    rx_ids: List[int]
+    # requested IDs that did not exist (any more)
+    not_found: List[int] = field(default_factory=list)
+    amount_reversed: Decimal = Decimal("0.00")
+    # (lot_batch_id, quantity put back) per lot
+    restored: List[tuple] = field(default_factory=list)
+    items_deleted: int = 0
+    payments_deleted: int = 0
+    prescriptions_deleted: int = 0
+    # refills given back to prescription items (reversed refill dispenses)
+    refills_restored: int = 0
+
+
+@retry_on_conflict
+def dispense(conn, req: DispenseRequest) -> DispenseResult:
+    """Create prescription, prescription item, dispense and dispensed item in one transaction."""
+    if req.qty_dispensed <= 0:
+        raise ServiceError("Quantity to dispense must be greater than 0.")
+    # Typed-in IDs must not be ones the archive still holds (next_id already skips those).
+    if req.dispense_id and is_archived_id("dispense", req.dispense_id):
+        raise ServiceError(f"Dispense #{req.dispense_id} already exists in the archive; choose another ID.")
+    if req.line_item_id and is_archived_id("dispensed_items", req.line_item_id):
+        raise ServiceError(f"Line item #{req.line_item_id} already exists in the archive; choose another ID.")
+
+    with atomic(conn) as cur:
+        unit_cost = lock_lot(cur, req.lot_batch_id, req.drug_id, req.qty_dispensed, req.holder)
+        total_amount = (unit_cost * req.qty_dispensed).quantize(Decimal("0.01"))
+        commission = commission_for(total_amount)
+
+        rx_id = req.rx_id or next_id(cur, "prescription", "rx_id")
+        dispense_id = req.dispense_id or next_id(cur, "dispense", "dispense_id")
+        line_item_id = req.line_item_id or next_id(cur, "dispensed_items", "line_item_id")
+        auto_ids = not (req.rx_id and req.dispense_id and req.line_item_id)
+
+        try:
+            _insert_dispense(cur, req, rx_id, dispense_id, line_item_id, total_amount, commission)
+        except errors.UniqueViolation as e:
+            # Another counter committed the same MAX + 1 first; a new attempt picks fresh IDs.
+            if auto_ids:
+                raise RetryableConflict(str(e)) from e
+            raise
+
+        if req.holder is not None:
+            cur.execute("DELETE FROM stock_reservation WHERE holder = %s;", (req.holder,))
+
+        cur.execute("SELECT qty_on_hand FROM inventory_lot WHERE lot_batch_id = %s;", (req.lot_batch_id,))
+        qty_on_hand_after = int(cur.fetchone()[0])
+
+    return DispenseResult(
+        rx_id=rx_id, dispense_id=dispense_id, line_item_id=line_item_id,
+        lot_batch_id=req.lot_batch_id, qty_dispensed=req.qty_dispensed, unit_cost=unit_cost,
+        total_amount=total_amount, commission=commission, qty_on_hand_after=qty_on_hand_after,
+    )
+
+
+def lock_lot(cur, lot_batch_id, drug_id, qty, holder=None) -> Decimal:
+    """
+    Lock the lot row until COMMIT, check it holds `drug_id` and has `qty`
+    not held by other counters, and return its unit cost.
+    """
+    # Row lock on the lot: held until COMMIT, so the stock check cannot go stale.
+    cur.execute(
+        "SELECT drug_id, unit_cost, qty_on_hand FROM inventory_lot WHERE lot_batch_id = %s FOR UPDATE;",
+        (lot_batch_id,),
+    )
+    lot = cur.fetchone()
+    if lot is None:
+        raise NotFoundError(f"Inventory lot {lot_batch_id} does not exist.")
+    if lot[0] != drug_id:
+        raise ServiceError(f"Lot {lot_batch_id} does not hold drug {drug_id}.")
+    if is_quarantined(cur, lot_batch_id):
+        raise ServiceError(f"Lot {lot_batch_id} is quarantined after a recall and cannot be dispensed.")
+    available = lot[2] - held_by_others(cur, lot_batch_id, holder)
+    if available < qty:
+        raise ServiceError(
+            f"Insufficient stock! You tried to dispense {qty}, "
+            f"but only {max(available, 0)} are available in Batch {lot_batch_id}."
+        )
+    return Decimal(lot[1])
+
+
+def commission_for(total_amount: Decimal) -> Decimal:
+    return (total_amount * COMMISSION_RATE).quantize(Decimal("0.01"))
+
+
+def _insert_dispense(cur, req, rx_id, dispense_id, line_item_id, total_amount, commission):
+    """The four INSERTs of Tx1, parent to child."""
+    cur.execute(
+        """
+        INSERT INTO prescription (rx_id, rx_date, status, urgency, patient_id, doctor_id, pharmacist_id)
+        VALUES (%s, CURRENT_DATE, 'Dispensed', %s, %s, %s, %s);
+        """,
+        (rx_id, req.urgency, req.patient_id, req.doctor_id, req.pharmacist_id),
+    )
+    cur.execute(
+        """
+        INSERT INTO prescription_items (rx_id, drug_id, qty_prescribed, dosage_instruc, frequency, refills_allowed)
+        VALUES (%s, %s, %s, %s, %s, %s);
+        """,
+        (rx_id, req.drug_id, req.qty_prescribed, req.dosage, req.frequency, req.refills_allowed),
+    )
+    cur.execute(
+        """
+        INSERT INTO dispense (dispense_id, dispense_date, total_amount, commission, pharmacist_id, rx_id)
+        VALUES (%s, CURRENT_DATE, %s, %s, %s, %s);
+        """,
+        (dispense_id, total_amount, commission, req.pharmacist_id, rx_id),
+    )
+    # triggers fire here
+    cur.execute(
+        """
+        INSERT INTO dispensed_items (line_item_id, qty_dispensed, dispense_id, lot_batch_id)
+        VALUES (%s, %s, %s, %s);
+        """,
+        (line_item_id, req.qty_dispensed, dispense_id, req.lot_batch_id),
+    )
+
+
+@retry_on_conflict
+def reverse_dispense(conn, dispense_id: int) -> ReversalResult:
+    """Put the stock back, then delete pays -> dispensed_items -> dispense -> prescription (child to parent)."""
+    with atomic(conn) as cur:
+        summary = _reverse(cur, [dispense_id])
+        if not summary.dispense_ids:
+            raise NotFoundError("Selected dispense no longer exists.")
+    return ReversalResult(dispense_id=dispense_id, rx_id=summary.rx_ids[0], restored=summary.restored)
+
+
+@retry_on_conflict
+def reverse_dispenses(conn, dispense_ids) -> BulkReversalResult:
+    """
+    Reverse many dispenses (e.g. everything from a recalled lot) in one short transaction.
+    IDs that no longer exist are skipped and listed in `not_found`.
+    """
+    with atomic(conn) as cur:
+        summary = _reverse(cur, sorted({int(d) for d in dispense_ids}))
+    return summary
+
+
+def _reverse(cur, dispense_ids) -> BulkReversalResult:
+    """Set-based reversal: one statement per table, however many dispenses are involved."""
+    # Locking the dispenses makes a second, concurrent reversal wait and then find nothing,
+    # so stock is never restored twice.
+    cur.execute(
+        """
+        SELECT dispense_id, rx_id, total_amount FROM dispense
+        WHERE dispense_id = ANY(%s) ORDER BY dispense_id FOR UPDATE;
+        """,
+        (dispense_ids,),
+    )
+    rows = cur.fetchall()
+    found = [int(r[0]) for r in rows]
+    rx_ids = sorted({int(r[1]) for r in rows})
+    result = BulkReversalResult(
+        dispense_ids=found,
+        rx_ids=rx_ids,
+        not_found=sorted(set(dispense_ids) - set(found)),
+        amount_reversed=sum((Decimal(r[2]) for r in rows), Decimal("0.00")),
+    )
+    if not found:
+        return result
+
+    # Lock the affected lots in ID order (the same order lock_lot() callers end up in), then
+    # restore stock with one aggregated UPDATE instead of one per dispensed item.
+    cur.execute(
+        """
+        SELECT lot_batch_id FROM inventory_lot
+        WHERE lot_batch_id IN (SELECT lot_batch_id FROM dispensed_items WHERE dispense_id = ANY(%s))
+        ORDER BY lot_batch_id FOR UPDATE;
+        """,
+        (found,),
+    )
+    cur.execute(
+        """
+        UPDATE inventory_lot il
+        SET qty_on_hand = il.qty_on_hand + r.qty
+        FROM (
+            SELECT lot_batch_id, SUM(qty_dispensed) AS qty
+            FROM dispensed_items
+            WHERE dispense_id = ANY(%s)
+            GROUP BY lot_batch_id
+        ) r
+        WHERE il.lot_batch_id = r.lot_batch_id
+        RETURNING il.lot_batch_id, r.qty;
+        """,
+        (found,),
+    )
+    result.restored = sorted((int(lot_id), int(qty)) for lot_id, qty in cur.fetchall())
+
+    # A reversed refill gives its refill back: every reversed dispense of an item that has an
+    # earlier dispense on the same prescription was a refill (services/refills.py), not the first fill.
+    cur.execute(
+        """
+        SELECT DISTINCT d.rx_id, il.drug_id
+        FROM dispense d
+        JOIN dispensed_items di ON di.dispense_id = d.dispense_id
+        JOIN inventory_lot il ON il.lot_batch_id = di.lot_batch_id
+        WHERE d.dispense_id = ANY(%s);
+        """,
+        (found,),
+    )
+    items = cur.fetchall()
+    item_rx = [int(r[0]) for r in items]
+    item_drug = [int(r[1]) for r in items]
+    # Older fills may already be in the Parquet archive (archive.py); they count like live ones.
+    archived = archived_last_fills(rx_ids)
+    cur.execute(
+        """
+        WITH fills AS (
+            SELECT DISTINCT d.dispense_id, d.dispense_date, d.rx_id, il.drug_id
+            FROM dispense d
+            JOIN dispensed_items di ON di.dispense_id = d.dispense_id
+            JOIN inventory_lot il ON il.lot_batch_id = di.lot_batch_id
+            WHERE d.rx_id = ANY(%(rx)s)
+        ), refills AS (
+            SELECT r.rx_id, r.drug_id, COUNT(*) AS n
+            FROM fills r
+            WHERE r.dispense_id = ANY(%(found)s)
+              AND (r.rx_id = ANY(%(archived)s) OR EXISTS (
+                  SELECT 1 FROM fills e
+                  WHERE e.rx_id = r.rx_id AND e.drug_id = r.drug_id
+                    AND (e.dispense_date, e.dispense_id) < (r.dispense_date, r.dispense_id)
+              ))
+            GROUP BY r.rx_id, r.drug_id
+        )
+        UPDATE prescription_items pi
+        SET refills_allowed = pi.refills_allowed + f.n
+        FROM refills f
+        WHERE pi.rx_id = f.rx_id AND pi.drug_id = f.drug_id
+        RETURNING f.n;
+        """,
+        {"rx": rx_ids, "found": found, "archived": list(archived)},
+    )
+    result.refills_restored = sum(int(r[0]) for r in cur.fetchall())
+
+    # delete child -> parent (include pays just in case)
+    cur.execute("DELETE FROM pays WHERE dispense_id = ANY(%s);", (found,))
+    result.payments_deleted = cur.rowcount
+    cur.execute("DELETE FROM dispensed_items WHERE dispense_id = ANY(%s);", (found,))
+    result.items_deleted = cur.rowcount
+    cur.execute("DELETE FROM dispense WHERE dispense_id = ANY(%s);", (found,))
+    # The refill schedule of every reversed item restarts from its latest remaining dispense;
+    # an item with no dispense left has nothing to refill from.
+    cur.execute(
+        """
+        WITH touched AS (
+            SELECT * FROM unnest(%(item_rx)s::int[], %(item_drug)s::int[]) AS t(rx_id, drug_id)
+        ), archived AS (
+            SELECT * FROM unnest(%(archived_rx)s::int[], %(archived_day)s::date[]) AS a(rx_id, last_fill)
+        ), last_fill AS (
+            SELECT t.rx_id, t.drug_id, COALESCE(MAX(d.dispense_date), MAX(a.last_fill)) AS last_fill
+            FROM touched t
+            LEFT JOIN dispense d ON d.rx_id = t.rx_id
+                AND EXISTS (
+                    SELECT 1 FROM dispensed_items di JOIN inventory_lot il ON il.lot_batch_id = di.lot_batch_id
+                    WHERE di.dispense_id = d.dispense_id AND il.drug_id = t.drug_id
+                )
+            LEFT JOIN archived a ON a.rx_id = t.rx_id
+            GROUP BY t.rx_id, t.drug_id
+        ), deleted AS (
+            DELETE FROM refill_schedule rs
+            USING last_fill f
+            WHERE rs.rx_id = f.rx_id AND rs.drug_id = f.drug_id AND f.last_fill IS NULL
+        )
+        UPDATE refill_schedule rs
+        SET last_refill_on = f.last_fill, next_due = f.last_fill + rs.interval_days
+        FROM last_fill f
+        WHERE rs.rx_id = f.rx_id AND rs.drug_id = f.drug_id AND f.last_fill IS NOT NULL;
+        """,
+        {
+            "item_rx": item_rx, "item_drug": item_drug,
+            "archived_rx": list(archived), "archived_day": list(archived.values()),
+        },
+    )
+    # A prescription goes only once none of its dispenses is left, live or archived:
+    # archived dispenses (and recall traces of them) still point at it.
+    unarchived = [rx for rx in rx_ids if rx not in archived]
+    cur.execute(
+        """
+        DELETE FROM prescription_items pi
+        WHERE pi.rx_id = ANY(%s) AND NOT EXISTS (SELECT 1 FROM dispense d WHERE d.rx_id = pi.rx_id);
+        """,
+        (unarchived,),
+    )
+    cur.execute(
+        """
+        DELETE FROM prescription rx
+        WHERE rx.rx_id = ANY(%s) AND NOT EXISTS (SELECT 1 FROM dispense d WHERE d.rx_id = rx.rx_id);
+        """,
+        (unarchived,),
+    )
+    result.prescriptions_deleted = cur.rowcount
+    return result
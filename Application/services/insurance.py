@@ -0,0 +1,90 @@
+"""
+Insurance payments against a dispense: record (INSERT into PAYS) and undo (DELETE).
+
+The remaining balance is computed inside the recording transaction with the
+dispense row locked, so two payments for the same dispense cannot both pass
+the balance check and over-cover it.
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+
+from services.common import NotFoundError, ServiceError, atomic, retry_on_conflict
+
+
+@dataclass
+class Coverage:
+    dispense_id: int
+    total_amount: Decimal
+    covered: Decimal
+
+    @property
+    def remaining(self) -> Decimal:
+        return self.total_amount - self.covered
+
+
+@dataclass
+class PaymentResult:
+    dispense_id: int
+    policy_id: int
+    amount_covered: Decimal
+    remaining: Decimal
+
+
+def _coverage(cur, dispense_id, lock=False) -> Coverage:
+    cur.execute(
+        "SELECT total_amount FROM dispense WHERE dispense_id = %s" + (" FOR UPDATE;" if lock else ";"),
+        (dispense_id,),
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise NotFoundError(f"Dispense {dispense_id} does not exist.")
+    cur.execute("SELECT COALESCE(SUM(amount_covered), 0) FROM pays WHERE dispense_id = %s;", (dispense_id,))
+    return Coverage(dispense_id=dispense_id, total_amount=Decimal(row[0]), covered=Decimal(cur.fetchone()[0]))
+
+
+def coverage(conn, dispense_id: int) -> Coverage:
+    """Total, already covered and remaining amount of one dispense."""
+    with atomic(conn) as cur:
+        result = _coverage(cur, dispense_id)
+    return result
+
+
+@retry_on_conflict
+def record_payment(conn, dispense_id: int, policy_id: int, amount) -> PaymentResult:
+    """Insert a PAYS row if the amount is positive and within the remaining balance."""
+    amount = Decimal(str(amount)).quantize(Decimal("0.01"))
+    if amount <= 0:
+        raise ServiceError("Amount must be greater than 0.")
+
+    with atomic(conn) as cur:
+        current = _coverage(cur, dispense_id, lock=True)
+        if amount > current.remaining:
+            raise ServiceError("Amount exceeds remaining balance.")
+        cur.execute(
+            """
+            INSERT INTO pays (dispense_id, policy_id, amount_covered)
+            VALUES (%s, %s, %s);
+            """,
+            (dispense_id, policy_id, amount),
+        )
+    return PaymentResult(dispense_id, policy_id, amount, current.remaining - amount)
+
+
+@retry_on_conflict
+def undo_payment(conn, dispense_id: int, policy_id: int) -> PaymentResult:
+    """Delete exactly one PAYS row (composite key dispense_id + policy_id)."""
+    with atomic(conn) as cur:
+        cur.execute(
+            """
+            DELETE FROM pays
+            WHERE dispense_id = %s AND policy_id = %s
+            RETURNING amount_covered;
+            """,
+            (dispense_id, policy_id),
+        )
+        rows = cur.fetchall()
+        # Safety: ensure exactly one row was deleted
+        if len(rows) != 1:
+            raise NotFoundError("Rollback failed: record not found or multiple rows affected.")
+        after = _coverage(cur, dispense_id)
+    return PaymentResult(dispense_id, policy_id, Decimal(rows[0][0]), after.remaining)
@@ -0,0 +1,150 @@
+"""
+Purchase orders: create (Tx3), revise a PENDING order (Tx4) and cancel.
+
+Only PENDING orders can be revised or cancelled; the order row is locked
+(FOR UPDATE) while that is checked so a concurrent cancel cannot slip in
+between the check and the change.
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import List, Optional
+
+from psycopg import errors
+
+from archive import is_archived_id
+from services.common import NotFoundError, RetryableConflict, ServiceError, atomic, next_id, retry_on_conflict
+
+# Unit cost used by the Revise tab for items added to an existing order.
+DEFAULT_ADDED_UNIT_COST = Decimal("2.00")
+
+
+@dataclass
+class OrderItem:
+    drug_id: int
+    qty: int
+    unit_cost: Decimal = DEFAULT_ADDED_UNIT_COST
+
+
+@dataclass
+class OrderRequest:
+    supplier_id: int
+    items: List[OrderItem]
+    # Leave empty to have the next free order ID assigned inside the transaction.
+    order_id: Optional[int] = None
+
+
+@dataclass
+class OrderRevision:
+    add: Optional[OrderItem] = None
+    update_drug_id: Optional[int] = None
+    update_qty: int = 0
+    remove_drug_id: Optional[int] = None
+
+
+@dataclass
+class OrderResult:
+    order_id: int
+    status: str
+    # (drug_id, qty_ordered, unit_cost) per item after the change
+    items: List[tuple] = field(default_factory=list)
+
+
+def _items(cur, order_id) -> list:
+    cur.execute(
+        "SELECT Drug_id, Qty_ordered, Unit_cost FROM PURCHASE_ORDER_ITEM WHERE Product_id = %s ORDER BY Drug_id;",
+        (order_id,),
+    )
+    return [(int(d), int(q), Decimal(c)) for d, q, c in cur.fetchall()]
+
+
+def _lock_pending(cur, order_id):
+    cur.execute("SELECT Status FROM PURCHASE_ORDER WHERE Order_id = %s FOR UPDATE;", (order_id,))
+    row = cur.fetchone()
+    if row is None:
+        raise NotFoundError(f"Order #{order_id} does not exist.")
+    if row[0] != "PENDING":
+        raise ServiceError(f"Order #{order_id} is {row[0]}; only PENDING orders can be changed.")
+
+
+@retry_on_conflict
+def create_order(conn, req: OrderRequest) -> OrderResult:
+    """Insert the order header and its items (quantity 0 items are skipped) atomically."""
+    items = [item for item in req.items if item.qty > 0]
+    if not items:
+        raise ServiceError("An order needs at least one item with a quantity above 0.")
+
+    # A typed-in ID must not be one the archive still holds (next_id already skips those).
+    if req.order_id and is_archived_id("purchase_order", req.order_id):
+        raise ServiceError(f"Order #{req.order_id} already exists in the archive; choose another ID.")
+
+    with atomic(conn) as cur:
+        order_id = req.order_id or next_id(cur, "PURCHASE_ORDER", "Order_id")
+        # CURRENT_DATE + 5 satisfies the check constraint Expected_delivery_date >= Order_date.
+        try:
+            cur.execute(
+                """
+                INSERT INTO PURCHASE_ORDER (Order_id, Order_date, Expected_delivery_date, Status, Supplier_ID)
+                VALUES (%s, CURRENT_DATE, CURRENT_DATE + 5, 'PENDING', %s);
+                """,
+                (order_id, req.supplier_id),
+            )
+        except errors.UniqueViolation as e:
+            # Only an auto-assigned ID can have been taken by a concurrent order; retry with a fresh one.
+            if req.order_id is None:
+                raise RetryableConflict(str(e)) from e
+            raise
+        for item in items:
+            cur.execute(
+                """
+                INSERT INTO PURCHASE_ORDER_ITEM (Product_id, Drug_id, Qty_ordered, Unit_cost)
+                VALUES (%s, %s, %s, %s);
+                """,
+                (order_id, item.drug_id, item.qty, item.unit_cost),
+            )
+        result = OrderResult(order_id=order_id, status="PENDING", items=_items(cur, order_id))
+    return result
+
+
+@retry_on_conflict
+def revise_order(conn, order_id: int, revision: OrderRevision) -> OrderResult:
+    """Apply an INSERT, an UPDATE and a DELETE to a PENDING order's items in one transaction."""
+    with atomic(conn) as cur:
+        _lock_pending(cur, order_id)
+
+        if revision.add is not None and revision.add.qty > 0:
+            cur.execute(
+                """
+                INSERT INTO PURCHASE_ORDER_ITEM (Product_id, Drug_id, Qty_ordered, Unit_cost)
+                VALUES (%s, %s, %s, %s);
+                """,
+                (order_id, revision.add.drug_id, revision.add.qty, revision.add.unit_cost),
+            )
+
+        if revision.update_drug_id is not None and revision.update_qty > 0:
+            cur.execute(
+                """
+                UPDATE PURCHASE_ORDER_ITEM
+                SET Qty_ordered = %s
+                WHERE Product_id = %s AND Drug_id = %s;
+                """,
+                (revision.update_qty, order_id, revision.update_drug_id),
+            )
+
+        if revision.remove_drug_id is not None:
+            cur.execute(
+                "DELETE FROM PURCHASE_ORDER_ITEM WHERE Product_id = %s AND Drug_id = %s;",
+                (order_id, revision.remove_drug_id),
+            )
+
+        result = OrderResult(order_id=order_id, status="PENDING", items=_items(cur, order_id))
+    return result
+
+
+@retry_on_conflict
+def cancel_order(conn, order_id: int) -> OrderResult:
+    """Set a PENDING order to CANCELLED."""
+    with atomic(conn) as cur:
+        _lock_pending(cur, order_id)
+        cur.execute("UPDATE PURCHASE_ORDER SET Status = 'CANCELLED' WHERE Order_id = %s;", (order_id,))
+        result = OrderResult(order_id=order_id, status="CANCELLED", items=_items(cur, order_id))
+    return result
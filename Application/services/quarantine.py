@@ -0,0 +1,61 @@
+"""
+Quarantine recalled lots (LOT_QUARANTINE, Performance_Script.sql section 4).
+
+A quarantined lot keeps its qty_on_hand (the boxes are still on the shelf,
+waiting to go back to the supplier) but shows 0 available in
+AVAILABLE_STOCK, cannot be held or dispensed from (services check it, and
+the trg_check_quarantine trigger enforces it), and its open holds are
+dropped.
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from services.common import atomic, retry_on_conflict
+
+
+@dataclass
+class QuarantineResult:
+    lot_batch_ids: List[int]
+    # stock holds that were cancelled because their lot was quarantined
+    holds_dropped: int = 0
+    # requested IDs that are not inventory lots
+    not_found: List[int] = field(default_factory=list)
+
+
+def is_quarantined(cur, lot_batch_id: int) -> bool:
+    cur.execute("SELECT 1 FROM lot_quarantine WHERE lot_batch_id = %s;", (lot_batch_id,))
+    return cur.fetchone() is not None
+
+
+@retry_on_conflict
+def quarantine_lots(conn, lot_batch_ids, reason: Optional[str] = None) -> QuarantineResult:
+    """Quarantine the lots (already quarantined ones keep their original reason and time)."""
+    ids = sorted({int(x) for x in lot_batch_ids})
+    with atomic(conn) as cur:
+        # Lot rows are locked like a dispense would, so no dispense is halfway through on them.
+        cur.execute(
+            "SELECT lot_batch_id FROM inventory_lot WHERE lot_batch_id = ANY(%s) ORDER BY lot_batch_id FOR UPDATE;",
+            (ids,),
+        )
+        found = [int(r[0]) for r in cur.fetchall()]
+        cur.execute(
+            """
+            INSERT INTO lot_quarantine (lot_batch_id, reason)
+            SELECT unnest(%s::int[]), %s
+            ON CONFLICT (lot_batch_id) DO NOTHING;
+            """,
+            (found, reason),
+        )
+        cur.execute("DELETE FROM stock_reservation WHERE lot_batch_id = ANY(%s);", (found,))
+        holds_dropped = cur.rowcount
+    return QuarantineResult(found, holds_dropped, sorted(set(ids) - set(found)))
+
+
+def release_quarantine(conn, lot_batch_ids) -> int:
+    """Make the lots dispensable again. Returns how many were quarantined."""
+    with atomic(conn) as cur:
+        cur.execute(
+            "DELETE FROM lot_quarantine WHERE lot_batch_id = ANY(%s);", ([int(x) for x in lot_batch_ids],)
+        )
+        released = cur.rowcount
+    return released
@@ -0,0 +1,324 @@
+"""
+Refill run: fill every prescription item whose next refill is due, in batches.
+
+PRESCRIPTION_ITEMS.Refills_allowed counts the refills left on an item and
+REFILL_SCHEDULE (Performance_Script.sql section 10) says when the next one
+is due. `process_refills()` walks the due items in (Next_due, Rx_id,
+Drug_id) order, REFILL_BATCH_SIZE at a time, and fills each batch in one
+transaction with a fixed number of set-based statements, however many
+items it holds:
+
+    claim     the batch's schedule and item rows (FOR UPDATE SKIP LOCKED)
+    allocate  lots first-expiry-first-out: running totals of demand per drug
+              are laid against running totals of free, unexpired stock per
+              drug, and every overlap becomes a dispensed item
+    write     one DISPENSE per prescription, its DISPENSED_ITEMS (the stock
+              triggers reduce the lots as usual), Refills_allowed - 1 and the
+              next due date for every filled item
+
+Only prescriptions that were dispensed once (Status 'Dispensed') are
+refilled; Pending ones are the prescription queue's, and a prescription a
+workstation currently has claimed (RX_CLAIM) is left alone. An item is
+filled completely or not at all. Items for which there is not enough free
+stock, or whose rows another transaction has locked, stay due and are
+counted as skipped; the next run picks them up again. Because the
+batches follow the keyset, a skipped item never blocks the rest of the run.
+
+    from db import get_connection
+    conn = get_connection()
+    result = services.process_refills(conn, pharmacist_id=4, progress=print)
+
+From Application/ (e.g. nightly from cron):
+    python -m services.refills --pharmacist 4
+"""
+import argparse
+import datetime as dt
+import logging
+import os
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Callable, Optional, Tuple
+
+from psycopg import errors
+
+from services.common import RetryableConflict, ServiceError, acting_as, atomic, next_id, retry_on_conflict
+from services.dispense import COMMISSION_RATE
+from services.rx_queue import RX_CLAIM_TIMEOUT_SECONDS
+
+REFILL_BATCH_SIZE = int(os.getenv("REFILL_BATCH_SIZE", "2000"))
+
+log = logging.getLogger(__name__)
+
+# Keyset position before the first due item.
+_START = (dt.date.min, 0, 0)
+
+
+@dataclass
+class RefillBatch:
+    claimed: int
+    refilled: int
+    dispenses: int
+    units: int
+    amount: Decimal
+    # (next_due, rx_id, drug_id) of the last claimed item; the next batch starts after it
+    last_key: Optional[Tuple[dt.date, int, int]]
+
+
+@dataclass
+class RefillRunResult:
+    as_of: dt.date
+    # items due when the run started
+    due: int
+    batches: int = 0
+    refilled: int = 0
+    dispenses: int = 0
+    units: int = 0
+    amount: Decimal = Decimal("0.00")
+    # due items left for the next run (not enough free stock, or locked elsewhere)
+    skipped: int = 0
+    seconds: float = 0.0
+
+
+_DUE = """
+    FROM refill_schedule rs
+    JOIN prescription_items pi ON pi.rx_id = rs.rx_id AND pi.drug_id = rs.drug_id
+    JOIN prescription rx ON rx.rx_id = rs.rx_id
+    WHERE rs.next_due <= %(as_of)s
+      AND pi.refills_allowed > 0
+      -- Pending prescriptions are the queue's (rx_queue.py); refills follow a first fill only
+      AND rx.status = 'Dispensed'
+      AND NOT EXISTS (
+          SELECT 1 FROM rx_claim c
+          WHERE c.rx_id = rs.rx_id AND c.heartbeat_at > now() - make_interval(secs => %(claim_timeout)s)
+      )
+      -- at most one refill per item and day, even when `as_of` lies further ahead
+      AND rs.last_refill_on IS DISTINCT FROM CURRENT_DATE
+"""
+
+_CLAIM = f"""
+    WITH claimed AS (
+        SELECT rs.next_due, rs.rx_id, rs.drug_id, pi.qty_prescribed
+        {_DUE}
+          AND (rs.next_due, rs.rx_id, rs.drug_id) > (%(due)s, %(rx)s, %(drug)s)
+        ORDER BY rs.next_due, rs.rx_id, rs.drug_id
+        LIMIT %(limit)s
+        FOR UPDATE OF rs, pi SKIP LOCKED
+    )
+    INSERT INTO refill_batch (next_due, rx_id, drug_id, qty)
+    SELECT next_due, rx_id, drug_id, qty_prescribed FROM claimed;
+"""
+
+# Demand interval (d_end - qty, d_end] of each item against supply interval (s_end - qty, s_end] of
+# each lot, per drug: the overlap is what the item takes from the lot. Only items whose whole
+# quantity fits into the drug's free stock are allocated (earliest due first).
+_ALLOCATE = """
+    INSERT INTO refill_alloc (rx_id, drug_id, lot_batch_id, qty, unit_cost)
+    WITH demand AS (
+        SELECT rx_id, drug_id, qty,
+               SUM(qty) OVER (PARTITION BY drug_id ORDER BY next_due, rx_id) AS d_end
+        FROM refill_batch
+    ), supply AS (
+        SELECT s.lot_batch_id, s.drug_id, s.unit_cost, s.qty_available AS qty,
+               SUM(s.qty_available) OVER (PARTITION BY s.drug_id ORDER BY s.expiry_date, s.lot_batch_id) AS s_end
+        FROM available_stock s
+        WHERE s.drug_id IN (SELECT drug_id FROM refill_batch)
+          AND s.expiry_date >= CURRENT_DATE
+          AND s.qty_available > 0
+          AND NOT s.quarantined
+    ), stock AS (
+        SELECT drug_id, MAX(s_end) AS total FROM supply GROUP BY drug_id
+    )
+    SELECT d.rx_id, d.drug_id, s.lot_batch_id,
+           LEAST(d.d_end, s.s_end) - GREATEST(d.d_end - d.qty, s.s_end - s.qty),
+           s.unit_cost
+    FROM demand d
+    JOIN stock t ON t.drug_id = d.drug_id AND d.d_end <= t.total
+    JOIN supply s ON s.drug_id = d.drug_id AND s.s_end - s.qty < d.d_end AND s.s_end > d.d_end - d.qty;
+"""
+
+
+def refills_due(conn, as_of: Optional[dt.date] = None) -> int:
+    """How many prescription items have a refill due on or before `as_of` (default today)."""
+    with atomic(conn) as cur:
+        cur.execute(
+            f"SELECT COUNT(*) {_DUE};",
+            {"as_of": as_of or dt.date.today(), "claim_timeout": RX_CLAIM_TIMEOUT_SECONDS},
+        )
+        return int(cur.fetchone()[0])
+
+
+@retry_on_conflict
+def refill_batch(conn, pharmacist_id: int, as_of: dt.date, after=_START,
+                 batch_size: int = REFILL_BATCH_SIZE) -> RefillBatch:
+    """Claim up to `batch_size` due items after the keyset position `after` and fill them in one transaction."""
+    with atomic(conn) as cur:
+        cur.execute(
+            """
+            CREATE TEMP TABLE refill_batch (
+                next_due DATE, rx_id INT, drug_id INT, qty INT, PRIMARY KEY (rx_id, drug_id)
+            ) ON COMMIT DROP;
+            """
+        )
+        cur.execute(
+            _CLAIM,
+            {
+                "as_of": as_of, "claim_timeout": RX_CLAIM_TIMEOUT_SECONDS,
+                "due": after[0], "rx": after[1], "drug": after[2], "limit": batch_size,
+            },
+        )
+        claimed = cur.rowcount
+        if not claimed:
+            return RefillBatch(0, 0, 0, 0, Decimal("0.00"), None)
+        cur.execute("SELECT next_due, rx_id, drug_id FROM refill_batch ORDER BY 1 DESC, 2 DESC, 3 DESC LIMIT 1;")
+        last_key = tuple(cur.fetchone())
+
+        # Lock the lots of every drug in the batch in ID order (like every other stock writer), then
+        # allocate in a separate statement, so it sees stock committed while this one waited.
+        cur.execute(
+            """
+            SELECT lot_batch_id FROM inventory_lot
+            WHERE drug_id IN (SELECT drug_id FROM refill_batch)
+            ORDER BY lot_batch_id FOR UPDATE;
+            """
+        )
+        cur.execute(
+            """
+            CREATE TEMP TABLE refill_alloc (
+                rx_id INT, drug_id INT, lot_batch_id INT, qty INT, unit_cost NUMERIC(10, 2)
+            ) ON COMMIT DROP;
+            """
+        )
+        cur.execute(_ALLOCATE)
+        # DISPENSE.Total_amount must be positive; free-of-charge lots cannot be booked this way.
+        cur.execute(
+            """
+            DELETE FROM refill_alloc
+            WHERE rx_id IN (SELECT rx_id FROM refill_alloc GROUP BY rx_id HAVING SUM(qty * unit_cost) <= 0);
+            """
+        )
+
+        first_dispense = next_id(cur, "dispense", "dispense_id")
+        first_line = next_id(cur, "dispensed_items", "line_item_id")
+        cur.execute(
+            """
+            CREATE TEMP TABLE refill_dispense (
+                rx_id INT PRIMARY KEY, dispense_id INT, total_amount NUMERIC(10, 2)
+            ) ON COMMIT DROP;
+            """
+        )
+        cur.execute(
+            """
+            INSERT INTO refill_dispense (rx_id, dispense_id, total_amount)
+            SELECT rx_id, %s - 1 + ROW_NUMBER() OVER (ORDER BY rx_id), ROUND(SUM(qty * unit_cost), 2)
+            FROM refill_alloc
+            GROUP BY rx_id;
+            """,
+            (first_dispense,),
+        )
+        try:
+            cur.execute(
+                """
+                INSERT INTO dispense (dispense_id, dispense_date, total_amount, commission, pharmacist_id, rx_id)
+                SELECT dispense_id, CURRENT_DATE, total_amount, ROUND(total_amount * %s, 2), %s, rx_id
+                FROM refill_dispense;
+                """,
+                (COMMISSION_RATE, pharmacist_id),
+            )
+            cur.execute(
+                """
+                INSERT INTO dispensed_items (line_item_id, qty_dispensed, dispense_id, lot_batch_id)
+                SELECT %s - 1 + ROW_NUMBER() OVER (ORDER BY a.rx_id, a.drug_id, a.lot_batch_id),
+                       a.qty, d.dispense_id, a.lot_batch_id
+                FROM refill_alloc a
+                JOIN refill_dispense d ON d.rx_id = a.rx_id;
+                """,
+                (first_line,),
+            )
+        except errors.UniqueViolation as e:
+            # A counter committed a dispense with one of the MAX + 1 IDs meanwhile; retry with fresh ones.
+            raise RetryableConflict(str(e)) from e
+
+        cur.execute(
+            """
+            UPDATE prescription_items pi
+            SET refills_allowed = pi.refills_allowed - 1
+            FROM (SELECT DISTINCT rx_id, drug_id FROM refill_alloc) f
+            WHERE pi.rx_id = f.rx_id AND pi.drug_id = f.drug_id;
+            """
+        )
+        refilled = cur.rowcount
+        cur.execute(
+            """
+            UPDATE refill_schedule rs
+            SET next_due = CURRENT_DATE + rs.interval_days, last_refill_on = CURRENT_DATE
+            FROM (SELECT DISTINCT rx_id, drug_id FROM refill_alloc) f
+            WHERE rs.rx_id = f.rx_id AND rs.drug_id = f.drug_id;
+            """
+        )
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(total_amount), 0) FROM refill_dispense;")
+        dispenses, amount = cur.fetchone()
+        cur.execute("SELECT COALESCE(SUM(qty), 0) FROM refill_alloc;")
+        units = cur.fetchone()[0]
+    return RefillBatch(claimed, refilled, int(dispenses), int(units), Decimal(amount), last_key)
+
+
+def process_refills(conn, pharmacist_id: int, as_of: Optional[dt.date] = None,
+                    batch_size: int = REFILL_BATCH_SIZE,
+                    progress: Optional[Callable[[RefillRunResult], None]] = None) -> RefillRunResult:
+    """
+    Fill every refill due on or before `as_of` (default today), booked to `pharmacist_id`.
+    Each batch commits on its own, so an interrupted run keeps the batches already filled.
+    `progress` is called with the running totals after every batch.
+    """
+    if batch_size <= 0:
+        raise ServiceError("The batch size must be greater than 0.")
+    as_of = as_of or dt.date.today()
+    started = time.perf_counter()
+    result = RefillRunResult(as_of=as_of, due=refills_due(conn, as_of))
+
+    after = _START
+    while True:
+        batch = refill_batch(conn, pharmacist_id, as_of, after, batch_size)
+        if not batch.claimed:
+            break
+        result.batches += 1
+        result.refilled += batch.refilled
+        result.dispenses += batch.dispenses
+        result.units += batch.units
+        result.amount += batch.amount
+        result.skipped += batch.claimed - batch.refilled
+        result.seconds = time.perf_counter() - started
+        log.debug("refill batch %d: %d of %d items filled", result.batches, batch.refilled, batch.claimed)
+        if progress is not None:
+            progress(result)
+        after = batch.last_key
+
+    # Items locked by another transaction for the whole run were never claimed.
+    result.skipped = max(result.skipped, result.due - result.refilled)
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+if __name__ == "__main__":
+    from db import get_connection
+
+    parser = argparse.ArgumentParser(description="Fill every prescription refill that is due.")
+    parser.add_argument("--pharmacist", type=int, required=True, help="pharmacist the refills are booked to")
+    parser.add_argument("--as-of", type=dt.date.fromisoformat, help="fill refills due on or before this date")
+    parser.add_argument("--batch-size", type=int, default=REFILL_BATCH_SIZE)
+    args = parser.parse_args()
+
+    def report(r):
+        done = r.refilled + r.skipped
+        print(f"batch {r.batches}: {done}/{r.due} items, {r.refilled} filled, {r.skipped} skipped, "
+              f"{r.refilled / max(r.seconds, 1e-9):,.0f} items/s")
+
+    conn = get_connection()
+    try:
+        with acting_as(f"pharmacist {args.pharmacist}"):
+            r = process_refills(conn, args.pharmacist, args.as_of, args.batch_size, progress=report)
+    finally:
+        conn.close()
+    print(f"{r.refilled} refills in {r.dispenses} dispenses ({r.units} units, €{r.amount:,.2f}) "
+          f"in {r.seconds:.1f}s; {r.skipped} left for the next run")
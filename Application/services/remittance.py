@@ -0,0 +1,254 @@
+"""
+Insurer remittance import: apply a whole remittance file to PAYS in one transaction.
+
+A remittance lists, for one insurer (policy), the amount paid per dispense.
+The lines are checked all at once rather than one by one: the file is
+parsed and de-duplicated with pandas, the dispenses it names are locked and
+their totals, covered amounts (DISPENSE_BALANCE) and existing payments from
+this policy are read in one query, and the merge decides per line:
+
+    insert            new payment from this policy
+    update            the policy already paid this dispense a different amount (correction)
+    invalid_line      dispense ID or amount missing / not a number / not positive, or an
+                      amount like "1,234" / "1.234" that may mean either 1234 or 1.234
+    duplicate_in_file the dispense appears earlier in the same file
+    unknown_dispense  no such (live) dispense
+    already_recorded  the same amount from this policy is already in PAYS
+    over_coverage     the payment would push the dispense above its total
+
+The accepted lines are loaded with COPY into a temporary table and written
+with one INSERT and one UPDATE; everything else is returned as exceptions.
+Pass dry_run=True to get the same result without writing anything.
+
+The dispense rows are locked like record_payment() locks them, so a payment
+keyed in at the counter meanwhile cannot over-cover a dispense either.
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from services.common import NotFoundError, ServiceError, atomic, retry_on_conflict
+
+# Accepted column names (lower case) in remittance files.
+DISPENSE_COLUMNS = ("dispense_id", "dispense", "claim_id", "claim")
+AMOUNT_COLUMNS = ("amount", "amount_covered", "paid", "amount_paid", "betrag")
+
+EXCEPTION_REASONS = ("invalid_line", "duplicate_in_file", "unknown_dispense", "already_recorded", "over_coverage")
+
+
+@dataclass
+class RemittanceLine:
+    dispense_id: int
+    amount: Decimal
+
+
+@dataclass
+class RemittanceException:
+    # 1-based line number in the file (after the header)
+    line: int
+    dispense_id: Optional[int]
+    amount: Optional[Decimal]
+    reason: str
+    detail: str = ""
+
+
+@dataclass
+class RemittanceResult:
+    policy_id: int
+    lines: int
+    inserted: int = 0
+    updated: int = 0
+    # net change of the covered amounts (updates count with their difference)
+    amount_applied: Decimal = Decimal("0.00")
+    dry_run: bool = False
+    exceptions: List[RemittanceException] = field(default_factory=list)
+
+
+def parse_remittance(source) -> pd.DataFrame:
+    """
+    Read a remittance CSV (path or file object; comma or semicolon separated,
+    decimal point or comma) into columns line, dispense_id, amount (both still text).
+    """
+    df = pd.read_csv(source, sep=None, engine="python", dtype=str, skipinitialspace=True)
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    dispense_col = next((c for c in DISPENSE_COLUMNS if c in df.columns), None)
+    amount_col = next((c for c in AMOUNT_COLUMNS if c in df.columns), None)
+    if dispense_col is None or amount_col is None:
+        raise ServiceError(
+            f"The file needs a dispense column ({', '.join(DISPENSE_COLUMNS)}) "
+            f"and an amount column ({', '.join(AMOUNT_COLUMNS)})."
+        )
+    return pd.DataFrame({
+        "line": np.arange(1, len(df) + 1),
+        "dispense_id": df[dispense_col],
+        "amount": df[amount_col],
+    })
+
+
+def _normalise(lines) -> pd.DataFrame:
+    """line, dispense_id (Int64), cents (Int64) for every line; unparsable values become <NA>."""
+    df = lines.copy() if isinstance(lines, pd.DataFrame) else pd.DataFrame(
+        [vars(l) if isinstance(l, RemittanceLine) else dict(l) for l in lines], columns=["dispense_id", "amount"]
+    )
+    if "line" not in df.columns:
+        df["line"] = np.arange(1, len(df) + 1)
+
+    amount = df["amount"].astype(str).str.replace("€", "", regex=False).str.strip()
+    # One separator before exactly three digits is a thousands separator in one locale and
+    # a decimal one in the other; such text is rejected rather than guessed.
+    ambiguous = df["amount"].map(lambda v: isinstance(v, str)) & amount.str.fullmatch(r"-?\d+[.,]\d{3}")
+    # "1.234,50" / "12,50" (decimal comma) -> "1234.50" / "12.50"
+    comma_decimal = amount.str.contains(",", regex=False) & ~amount.str.contains(r"\.\d{1,2}$")
+    amount = amount.where(~comma_decimal, amount.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+    amount = pd.to_numeric(amount.str.replace(",", "", regex=False), errors="coerce").mask(ambiguous)
+    dispense_id = pd.to_numeric(df["dispense_id"], errors="coerce")
+
+    out = pd.DataFrame({"line": df["line"].astype(int)})
+    out["dispense_id"] = dispense_id.where(dispense_id == dispense_id.round()).astype("Int64")
+    out["cents"] = (amount * 100).round().astype("Int64")
+    out["dispense_text"] = df["dispense_id"].astype(str)
+    out["amount_text"] = df["amount"].astype(str)
+    out["ambiguous"] = ambiguous
+    return out
+
+
+def _context(cur, policy_id, dispense_ids) -> pd.DataFrame:
+    """Lock the dispenses (in ID order, like every other writer), then read their balances."""
+    cur.execute(
+        "SELECT dispense_id FROM dispense WHERE dispense_id = ANY(%s) ORDER BY dispense_id FOR UPDATE;",
+        (dispense_ids,),
+    )
+    # A separate statement, so it sees payments committed while this one waited for the locks.
+    cur.execute(
+        """
+        SELECT
+            d.dispense_id,
+            ROUND(d.total_amount * 100)::bigint AS total_cents,
+            ROUND(COALESCE(b.covered_total, 0) * 100)::bigint AS covered_cents,
+            ROUND(p.amount_covered * 100)::bigint AS existing_cents
+        FROM dispense d
+        LEFT JOIN dispense_balance b ON b.dispense_id = d.dispense_id
+        LEFT JOIN pays p ON p.dispense_id = d.dispense_id AND p.policy_id = %s
+        WHERE d.dispense_id = ANY(%s);
+        """,
+        (policy_id, dispense_ids),
+    )
+    return pd.DataFrame(
+        cur.fetchall(), columns=["dispense_id", "total_cents", "covered_cents", "existing_cents"]
+    ).astype({"dispense_id": "Int64", "total_cents": "Int64", "covered_cents": "Int64", "existing_cents": "Int64"})
+
+
+def _classify(df: pd.DataFrame, context: pd.DataFrame) -> pd.DataFrame:
+    def mask(condition):
+        return condition.fillna(False).to_numpy(dtype=bool)
+
+    df = df.merge(context, on="dispense_id", how="left")
+    valid = mask(df["dispense_id"].notna() & (df["cents"] > 0))
+    # Only valid lines count as the first occurrence of a dispense.
+    duplicate = valid & df["dispense_id"].where(valid).duplicated(keep="first").to_numpy()
+    existing = df["existing_cents"].fillna(0)
+    # After this line the dispense would be covered by: others + this policy's new amount.
+    covered_after = df["covered_cents"].fillna(0) - existing + df["cents"].fillna(0)
+
+    df["status"] = np.select(
+        [
+            ~valid,
+            duplicate,
+            mask(df["total_cents"].isna()),
+            mask(df["existing_cents"] == df["cents"]),
+            mask(covered_after > df["total_cents"]),
+            mask(df["existing_cents"].notna()),
+        ],
+        ["invalid_line", "duplicate_in_file", "unknown_dispense", "already_recorded", "over_coverage", "update"],
+        default="insert",
+    )
+    df["covered_after"] = covered_after
+    df["existing"] = existing
+    return df
+
+
+def _detail(row) -> str:
+    if row["status"] == "invalid_line":
+        hint = " (ambiguous: thousands or decimal separator?)" if row["ambiguous"] else ""
+        return f"dispense '{row['dispense_text']}' / amount '{row['amount_text']}'{hint}"
+    if row["status"] == "already_recorded":
+        return f"€{row['cents'] / 100:.2f} already paid by this policy"
+    if row["status"] == "over_coverage":
+        remaining = (row["total_cents"] - row["covered_cents"] + row["existing"]) / 100
+        return f"€{row['cents'] / 100:.2f} exceeds the €{remaining:.2f} that can be covered"
+    return ""
+
+
+def _exceptions(df: pd.DataFrame) -> List[RemittanceException]:
+    rejected = df[df["status"].isin(EXCEPTION_REASONS)]
+    return [
+        RemittanceException(
+            line=int(row["line"]),
+            dispense_id=None if pd.isna(row["dispense_id"]) else int(row["dispense_id"]),
+            amount=None if pd.isna(row["cents"]) else Decimal(int(row["cents"])) / 100,
+            reason=row["status"],
+            detail=_detail(row),
+        )
+        for _, row in rejected.iterrows()
+    ]
+
+
+@retry_on_conflict
+def import_remittance(conn, policy_id: int, lines, dry_run: bool = False) -> RemittanceResult:
+    """
+    Apply a remittance for one policy. `lines` is a DataFrame with dispense_id
+    and amount columns (e.g. from parse_remittance()) or a list of RemittanceLine.
+    """
+    df = _normalise(lines)
+    if df.empty:
+        raise ServiceError("The remittance has no lines.")
+
+    with atomic(conn) as cur:
+        cur.execute("SELECT 1 FROM insurance WHERE policy_id = %s;", (policy_id,))
+        if cur.fetchone() is None:
+            raise NotFoundError(f"Insurance policy {policy_id} does not exist.")
+
+        ids = sorted(int(x) for x in df["dispense_id"].dropna().unique())
+        df = _classify(df, _context(cur, policy_id, ids))
+        accepted = df[df["status"].isin(["insert", "update"])]
+        result = RemittanceResult(
+            policy_id=policy_id,
+            lines=len(df),
+            inserted=int((accepted["status"] == "insert").sum()),
+            updated=int((accepted["status"] == "update").sum()),
+            amount_applied=(Decimal(int((accepted["cents"] - accepted["existing"]).sum())) / 100).quantize(Decimal("0.01")),
+            dry_run=dry_run,
+            exceptions=_exceptions(df),
+        )
+        if dry_run or accepted.empty:
+            # Nothing to write: end the transaction (and its locks) here.
+            conn.rollback()
+            return result
+
+        cur.execute(
+            "CREATE TEMP TABLE remittance_apply (dispense_id INT PRIMARY KEY, amount NUMERIC(10, 2)) ON COMMIT DROP;"
+        )
+        with cur.copy("COPY remittance_apply (dispense_id, amount) FROM STDIN") as copy:
+            for dispense_id, cents in zip(accepted["dispense_id"], accepted["cents"]):
+                copy.write_row((int(dispense_id), Decimal(int(cents)) / 100))
+        cur.execute(
+            """
+            UPDATE pays p SET amount_covered = a.amount
+            FROM remittance_apply a
+            WHERE p.dispense_id = a.dispense_id AND p.policy_id = %s;
+            """,
+            (policy_id,),
+        )
+        cur.execute(
+            """
+            INSERT INTO pays (dispense_id, policy_id, amount_covered)
+            SELECT a.dispense_id, %s, a.amount
+            FROM remittance_apply a
+            WHERE NOT EXISTS (SELECT 1 FROM pays p WHERE p.dispense_id = a.dispense_id AND p.policy_id = %s);
+            """,
+            (policy_id, policy_id),
+        )
+    return result
@@ -0,0 +1,143 @@
+"""
+Short-lived stock holds for the Dispense wizard (STOCK_RESERVATION, Performance_Script.sql section 2).
+
+Choosing a lot places a hold for the quantity about to be dispensed. Until
+it expires (RESERVATION_TTL_SECONDS) or is released, other counters see
+that much less available stock and their dispenses are refused up front
+instead of failing at the end. dispense() consumes the holder's own hold in
+its transaction.
+
+Each holder (one Streamlit session, one API client) has at most one hold;
+placing a new one replaces the old. Expired holds are ignored by every
+check and deleted in bulk by a background sweeper (start_sweeper()), which
+also refreshes drug stock summaries made stale by lots expiring.
+"""
+import datetime as dt
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from services.common import NotFoundError, ServiceError, atomic, retry_on_conflict
+from services.quarantine import is_quarantined
+from services.stock import refresh_stale_stock
+
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "300"))
+RESERVATION_SWEEP_SECONDS = float(os.getenv("RESERVATION_SWEEP_SECONDS", "60"))
+
+log = logging.getLogger(__name__)
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+@dataclass
+class Reservation:
+    reservation_id: int
+    lot_batch_id: int
+    qty: int
+    holder: str
+    expires_at: dt.datetime
+    # qty_on_hand minus everyone else's active holds, before this hold
+    qty_available: int
+
+
+def held_by_others(cur, lot_batch_id: int, holder: Optional[str]) -> int:
+    """Quantity of active holds on a lot, not counting `holder`'s own."""
+    cur.execute(
+        """
+        SELECT COALESCE(SUM(qty), 0) FROM stock_reservation
+        WHERE lot_batch_id = %s AND expires_at > now() AND holder IS DISTINCT FROM %s;
+        """,
+        (lot_batch_id, holder),
+    )
+    return int(cur.fetchone()[0])
+
+
+@retry_on_conflict
+def hold(conn, lot_batch_id: int, qty: int, holder: str, ttl_seconds: Optional[int] = None) -> Reservation:
+    """Replace `holder`'s hold with one on this lot, if enough unreserved stock is left."""
+    if qty <= 0:
+        raise ServiceError("Quantity to hold must be greater than 0.")
+    ttl = ttl_seconds or RESERVATION_TTL_SECONDS
+
+    with atomic(conn) as cur:
+        # Same lock as dispense(), so a hold and a dispense cannot both pass the check.
+        cur.execute("SELECT qty_on_hand FROM inventory_lot WHERE lot_batch_id = %s FOR UPDATE;", (lot_batch_id,))
+        row = cur.fetchone()
+        if row is None:
+            raise NotFoundError(f"Inventory lot {lot_batch_id} does not exist.")
+        if is_quarantined(cur, lot_batch_id):
+            raise ServiceError(f"Lot {lot_batch_id} is quarantined after a recall.")
+
+        cur.execute("DELETE FROM stock_reservation WHERE holder = %s;", (holder,))
+        held = held_by_others(cur, lot_batch_id, holder)
+        available = int(row[0]) - held
+        if qty > available:
+            raise ServiceError(
+                f"Only {max(available, 0)} of Batch {lot_batch_id} are free right now "
+                f"({row[0]} on hand, {held} held by other counters)."
+            )
+        cur.execute(
+            """
+            INSERT INTO stock_reservation (lot_batch_id, qty, holder, expires_at)
+            VALUES (%s, %s, %s, now() + make_interval(secs => %s))
+            RETURNING reservation_id, expires_at;
+            """,
+            (lot_batch_id, qty, holder, ttl),
+        )
+        reservation_id, expires_at = cur.fetchone()
+    return Reservation(int(reservation_id), lot_batch_id, qty, holder, expires_at, available)
+
+
+def release(conn, holder: str) -> int:
+    """Drop `holder`'s hold (if any). Returns the number of rows deleted."""
+    with atomic(conn) as cur:
+        cur.execute("DELETE FROM stock_reservation WHERE holder = %s;", (holder,))
+        deleted = cur.rowcount
+    return deleted
+
+
+def expire_holds(conn) -> int:
+    """Delete every expired hold in one statement. Returns the number of rows deleted."""
+    with atomic(conn) as cur:
+        cur.execute("DELETE FROM stock_reservation WHERE expires_at <= now();")
+        deleted = cur.rowcount
+    return deleted
+
+
+# =====================================================================
+# Background sweeper
+# =====================================================================
+def _sweep_forever(interval):
+    from db import get_connection
+
+    while True:
+        time.sleep(interval)
+        try:
+            conn = get_connection()
+            try:
+                deleted = expire_holds(conn)
+                refreshed = refresh_stale_stock(conn)
+            finally:
+                conn.close()
+            if deleted or refreshed:
+                log.info("expired %d stock holds, refreshed %d drug stock summaries", deleted, refreshed)
+        except Exception:
+            log.exception("stock hold sweep failed")
+
+
+def start_sweeper(interval: Optional[float] = None):
+    """Start the expiry sweeper once per process (a daemon thread; later calls do nothing)."""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = threading.Thread(
+                target=_sweep_forever,
+                args=(interval or RESERVATION_SWEEP_SECONDS,),
+                name="stock-hold-sweeper",
+                daemon=True,
+            )
+            _sweeper.start()
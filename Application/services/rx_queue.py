@@ -0,0 +1,238 @@
+"""
+Pending prescriptions as a shared work queue (RX_CLAIM, Performance_Script.sql section 3).
+
+Every workstation pulls its next prescription with claim_next(): the most
+urgent, then oldest, pending prescription that nobody holds a live claim
+on. The candidate is locked FOR UPDATE SKIP LOCKED, so concurrent claims
+never wait on each other; each gets a different prescription.
+
+A claim is a lease. The workstation calls heartbeat() while it works (the
+Dispense page does so on every rerun); a claim whose heartbeat is older
+than RX_CLAIM_TIMEOUT_SECONDS counts as abandoned and the prescription is
+handed out again. fill_claimed() dispenses every item of the prescription
+in one transaction, marks it Dispensed and ends the claim.
+
+    item = claim_next(conn, "counter-2")
+    ...
+    heartbeat(conn, item.rx_id, "counter-2")
+    fill_claimed(conn, item.rx_id, "counter-2", pharmacist_id=801)
+"""
+import datetime as dt
+import os
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from psycopg import errors
+
+from services.common import NotFoundError, RetryableConflict, ServiceError, atomic, next_id, retry_on_conflict
+from services.dispense import commission_for, lock_lot
+
+RX_CLAIM_TIMEOUT_SECONDS = int(os.getenv("RX_CLAIM_TIMEOUT_SECONDS", "120"))
+
+# Attempts per claim_next() call when a concurrent claim wins the race for the row just locked.
+_CLAIM_ATTEMPTS = 5
+
+# Same ordering as idx_prescription_pending_queue, so the claim reads the partial index in order.
+_URGENCY_RANK = "(CASE rx.urgency WHEN 'High' THEN 0 WHEN 'Medium' THEN 1 ELSE 2 END)"
+
+
+@dataclass
+class QueueItem:
+    rx_id: int
+    rx_date: dt.date
+    urgency: str
+    patient_id: int
+    doctor_id: int
+    claimed_at: dt.datetime
+    # (drug_id, qty_prescribed, dosage, frequency) per prescribed drug
+    items: List[tuple] = field(default_factory=list)
+
+
+@dataclass
+class FillResult:
+    rx_id: int
+    dispense_id: int
+    total_amount: Decimal
+    commission: Decimal
+    # (line_item_id, drug_id, lot_batch_id, qty_dispensed) per dispensed line
+    lines: List[tuple] = field(default_factory=list)
+
+
+@retry_on_conflict
+def claim_next(conn, workstation: str) -> Optional[QueueItem]:
+    """Claim the next pending prescription for `workstation`, or return None when the queue is empty."""
+    with atomic(conn) as cur:
+        for _ in range(_CLAIM_ATTEMPTS):
+            cur.execute(
+                f"""
+                SELECT rx.rx_id, rx.rx_date, rx.urgency, rx.patient_id, rx.doctor_id
+                FROM prescription rx
+                WHERE rx.status = 'Pending'
+                  AND NOT EXISTS (
+                      SELECT 1 FROM rx_claim c
+                      WHERE c.rx_id = rx.rx_id AND c.heartbeat_at > now() - make_interval(secs => %s)
+                  )
+                ORDER BY {_URGENCY_RANK}, rx.rx_date, rx.rx_id
+                LIMIT 1
+                FOR UPDATE OF rx SKIP LOCKED;
+                """,
+                (RX_CLAIM_TIMEOUT_SECONDS,),
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+
+            # A workstation that committed its claim after this statement's snapshot was taken is
+            # invisible to the NOT EXISTS above; the conditional upsert sees it and claims nothing.
+            cur.execute(
+                """
+                INSERT INTO rx_claim (rx_id, workstation) VALUES (%s, %s)
+                ON CONFLICT (rx_id) DO UPDATE
+                    SET workstation = EXCLUDED.workstation, claimed_at = now(), heartbeat_at = now()
+                    WHERE rx_claim.heartbeat_at <= now() - make_interval(secs => %s)
+                RETURNING claimed_at;
+                """,
+                (row[0], workstation, RX_CLAIM_TIMEOUT_SECONDS),
+            )
+            claimed = cur.fetchone()
+            if claimed is not None:
+                break
+        else:
+            return None
+
+        cur.execute(
+            """
+            SELECT drug_id, qty_prescribed, dosage_instruc, frequency
+            FROM prescription_items WHERE rx_id = %s ORDER BY drug_id;
+            """,
+            (row[0],),
+        )
+        items = [(int(d), int(q), dosage, freq) for d, q, dosage, freq in cur.fetchall()]
+    return QueueItem(
+        rx_id=int(row[0]), rx_date=row[1], urgency=row[2], patient_id=int(row[3]),
+        doctor_id=int(row[4]), claimed_at=claimed[0], items=items,
+    )
+
+
+def heartbeat(conn, rx_id: int, workstation: str) -> bool:
+    """Extend the claim. False means it was lost (timed out and taken by another workstation, or filled)."""
+    with atomic(conn) as cur:
+        cur.execute(
+            "UPDATE rx_claim SET heartbeat_at = now() WHERE rx_id = %s AND workstation = %s;",
+            (rx_id, workstation),
+        )
+        alive = cur.rowcount == 1
+    return alive
+
+
+def release_claim(conn, rx_id: int, workstation: str) -> bool:
+    """Hand a claimed prescription back to the queue unfilled."""
+    with atomic(conn) as cur:
+        cur.execute("DELETE FROM rx_claim WHERE rx_id = %s AND workstation = %s;", (rx_id, workstation))
+        released = cur.rowcount == 1
+    return released
+
+
+def queue_depth(conn) -> dict:
+    """Pending prescriptions in total, and how many of them are under a live claim."""
+    with atomic(conn) as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*),
+                   COUNT(c.rx_id) FILTER (WHERE c.heartbeat_at > now() - make_interval(secs => %s))
+            FROM prescription rx
+            LEFT JOIN rx_claim c ON c.rx_id = rx.rx_id
+            WHERE rx.status = 'Pending';
+            """,
+            (RX_CLAIM_TIMEOUT_SECONDS,),
+        )
+        pending, claimed = cur.fetchone()
+    return {"pending": int(pending), "claimed": int(claimed)}
+
+
+def _pick_lot(cur, drug_id, qty):
+    """First-expiry-first-out: the soonest-expiring unexpired lot with enough free stock."""
+    cur.execute(
+        """
+        SELECT lot_batch_id FROM available_stock
+        WHERE drug_id = %s AND expiry_date >= CURRENT_DATE AND qty_available >= %s
+        ORDER BY expiry_date, lot_batch_id
+        LIMIT 1;
+        """,
+        (drug_id, qty),
+    )
+    row = cur.fetchone()
+    if row is None:
+        raise ServiceError(f"No unexpired lot of drug {drug_id} has {qty} free units.")
+    return int(row[0])
+
+
+@retry_on_conflict
+def fill_claimed(conn, rx_id: int, workstation: str, pharmacist_id: int,
+                 lots: Optional[Dict[int, int]] = None) -> FillResult:
+    """
+    Dispense every item of a claimed prescription at its prescribed quantity.
+    `lots` maps drug_id -> lot_batch_id; drugs without an entry use the first-expiring lot.
+    """
+    lots = lots or {}
+    with atomic(conn) as cur:
+        cur.execute(
+            "SELECT 1 FROM rx_claim WHERE rx_id = %s AND workstation = %s FOR UPDATE;", (rx_id, workstation)
+        )
+        if cur.fetchone() is None:
+            raise ServiceError(f"Prescription {rx_id} is not claimed by this workstation (any more).")
+        cur.execute("SELECT status FROM prescription WHERE rx_id = %s FOR UPDATE;", (rx_id,))
+        row = cur.fetchone()
+        if row is None:
+            raise NotFoundError(f"Prescription {rx_id} does not exist.")
+        if row[0] != "Pending":
+            raise ServiceError(f"Prescription {rx_id} is {row[0]}; only Pending prescriptions can be filled.")
+
+        cur.execute("SELECT drug_id, qty_prescribed FROM prescription_items WHERE rx_id = %s;", (rx_id,))
+        items = [(int(d), int(q)) for d, q in cur.fetchall()]
+        if not items:
+            raise ServiceError(f"Prescription {rx_id} has no items.")
+
+        # Lock lots in ID order so two multi-item fills cannot deadlock on each other's lots.
+        plan = sorted((lots.get(d) or _pick_lot(cur, d, q), d, q) for d, q in items)
+        total_amount = Decimal("0.00")
+        for lot_batch_id, drug_id, qty in plan:
+            unit_cost = lock_lot(cur, lot_batch_id, drug_id, qty, holder=workstation)
+            total_amount += (unit_cost * qty).quantize(Decimal("0.01"))
+        commission = commission_for(total_amount)
+
+        try:
+            dispense_id = next_id(cur, "dispense", "dispense_id")
+            cur.execute(
+                """
+                INSERT INTO dispense (dispense_id, dispense_date, total_amount, commission, pharmacist_id, rx_id)
+                VALUES (%s, CURRENT_DATE, %s, %s, %s, %s);
+                """,
+                (dispense_id, total_amount, commission, pharmacist_id, rx_id),
+            )
+            lines = []
+            for lot_batch_id, drug_id, qty in plan:
+                line_item_id = next_id(cur, "dispensed_items", "line_item_id")
+                # triggers fire here
+                cur.execute(
+                    """
+                    INSERT INTO dispensed_items (line_item_id, qty_dispensed, dispense_id, lot_batch_id)
+                    VALUES (%s, %s, %s, %s);
+                    """,
+                    (line_item_id, qty, dispense_id, lot_batch_id),
+                )
+                lines.append((line_item_id, drug_id, lot_batch_id, qty))
+        except errors.UniqueViolation as e:
+            # Another counter committed the same MAX + 1 first; a new attempt picks fresh IDs.
+            raise RetryableConflict(str(e)) from e
+
+        cur.execute(
+            "UPDATE prescription SET status = 'Dispensed', pharmacist_id = %s WHERE rx_id = %s;",
+            (pharmacist_id, rx_id),
+        )
+        cur.execute("DELETE FROM rx_claim WHERE rx_id = %s;", (rx_id,))
+        cur.execute("DELETE FROM stock_reservation WHERE holder = %s;", (workstation,))
+
+    return FillResult(rx_id=rx_id, dispense_id=dispense_id, total_amount=total_amount,
+                      commission=commission, lines=lines)
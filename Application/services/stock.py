@@ -0,0 +1,35 @@
+"""
+Per-drug stock summary (DRUG_STOCK_SUMMARY, Performance_Script.sql section 5).
+
+The summary rows are kept current by a trigger on INVENTORY_LOT; from
+Python only the reorder levels are set, and rows made stale by the
+calendar (their nearest usable lot expired) are refreshed.
+"""
+from services.common import ServiceError, atomic, retry_on_conflict
+
+
+@retry_on_conflict
+def set_reorder_levels(conn, levels: dict) -> int:
+    """Set {drug_id: reorder level} in one statement. Returns how many drugs were updated."""
+    if any(int(level) < 0 for level in levels.values()):
+        raise ServiceError("Reorder levels cannot be negative.")
+    with atomic(conn) as cur:
+        cur.execute(
+            """
+            UPDATE drug_stock_summary s
+            SET reorder_level = v.level
+            FROM unnest(%s::int[], %s::int[]) AS v(drug_id, level)
+            WHERE s.drug_id = v.drug_id;
+            """,
+            ([int(d) for d in levels], [int(v) for v in levels.values()]),
+        )
+        updated = cur.rowcount
+    return updated
+
+
+def refresh_stale_stock(conn) -> int:
+    """Recalculate the summaries whose nearest usable expiry has passed. Returns how many were refreshed."""
+    with atomic(conn) as cur:
+        cur.execute("SELECT refresh_stale_drug_stock();")
+        refreshed = int(cur.fetchone()[0])
+    return refreshed
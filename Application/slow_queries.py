@@ -0,0 +1,251 @@
+"""
+Slow-query log with automatic EXPLAIN capture.
+
+Hooks into instrumentation.py: any statement slower than SLOW_QUERY_MS is
+re-planned on a separate connection in a background thread and stored,
+with its parameters and plan, in a local SQLite table (SLOW_QUERY_DB).
+
+* SELECT statements, and WITH statements without INSERT / UPDATE / DELETE,
+  are re-run with EXPLAIN (ANALYZE, BUFFERS), so the stored plan shows real
+  row counts, timings and buffer hits.
+* Writes, including data-modifying WITH statements, only get a plain
+  EXPLAIN (never ANALYZE, which would execute the write a second time).
+  So do SELECTs that take row locks (FOR UPDATE / FOR SHARE ...) or call
+  a function outside the read-only built-ins in _READ_ONLY_CALLS, such as
+  refresh_stale_drug_stock() or set_config(): re-running them would lock
+  rows or change state again.
+
+Every slow run is counted per fingerprint (slow_query_count), but a
+fingerprint is re-explained only when it gets slower than its worst
+recorded run or its last plan is older than SLOW_QUERY_REEXPLAIN_SECONDS,
+so a hot slow query does not double the load on the database.
+"""
+import concurrent.futures
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import instrumentation
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_DB = os.getenv(
+    "SLOW_QUERY_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics", "slow_queries.sqlite3"),
+)
+SLOW_QUERY_REEXPLAIN_SECONDS = float(os.getenv("SLOW_QUERY_REEXPLAIN_SECONDS", "600"))
+
+_READ_PREFIXES = ("select", "with")
+_WRITE_PREFIXES = ("insert", "update", "delete")
+_WRITE_WORDS = re.compile(r"\b(insert|update|delete|merge)\b")
+_LOCKING = re.compile(r"\bfor\s+(update|no key update|share|key share)\b")
+_CALLS = re.compile(r"(?<!as )\b([a-z_][a-z0-9_.]*)\s*\(")  # not "AS t(a, b)" column lists
+# Words followed by "(" that are not function calls, and built-ins that only read.
+_READ_ONLY_CALLS = frozenset(
+    """
+    select from where and or not in exists any all as on using values over filter within lateral
+    join row array interval date time timestamp numeric decimal int integer bigint text varchar
+    count sum min max avg string_agg array_agg bool_and bool_or json_agg jsonb_agg
+    row_number rank dense_rank lag lead first_value last_value percentile_cont percentile_disc
+    coalesce nullif greatest least abs round ceil floor mod sign extract date_part date_trunc age
+    now current_date current_timestamp make_interval to_char to_date to_timestamp
+    lower upper length trim btrim ltrim rtrim concat concat_ws substring position replace split_part left right
+    unnest generate_series cardinality array_length array_position
+    similarity word_similarity to_tsvector to_tsquery plainto_tsquery ts_rank
+    """.split()
+)
+
+# One worker keeps EXPLAINs off the page's thread and serialises SQLite writes.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-query")
+_explained = {}  # query_id -> (worst elapsed_ms, monotonic time of last capture)
+_explained_lock = threading.Lock()
+
+
+def _store():
+    os.makedirs(os.path.dirname(SLOW_QUERY_DB), exist_ok=True)
+    conn = sqlite3.connect(SLOW_QUERY_DB, timeout=10)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS slow_query (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            captured_at TEXT NOT NULL DEFAULT (datetime('now')),
+            page TEXT,
+            query_id TEXT NOT NULL,
+            normalised TEXT NOT NULL,
+            sql TEXT NOT NULL,
+            params TEXT,
+            elapsed_ms REAL NOT NULL,
+            rows INTEGER,
+            plan TEXT
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_slow_query_qid ON slow_query(query_id, elapsed_ms);")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS slow_query_count (
+            query_id TEXT PRIMARY KEY,
+            occurrences INTEGER NOT NULL,
+            total_ms REAL NOT NULL,
+            last_seen TEXT NOT NULL
+        );
+        """
+    )
+    return conn
+
+
+def _analyze_safe(normalised) -> bool:
+    """Whether re-running the statement under EXPLAIN ANALYZE cannot write or lock anything."""
+    if not normalised.startswith("select") and not (
+        normalised.startswith("with") and not _WRITE_WORDS.search(normalised)
+    ):
+        return False
+    if _LOCKING.search(normalised):
+        return False
+    return all(name in _READ_ONLY_CALLS for name in _CALLS.findall(normalised))
+
+
+def _should_explain(query_id, elapsed_ms) -> bool:
+    with _explained_lock:
+        worst, last = _explained.get(query_id, (0.0, 0.0))
+        if elapsed_ms > worst or time.monotonic() - last > SLOW_QUERY_REEXPLAIN_SECONDS:
+            _explained[query_id] = (max(worst, elapsed_ms), time.monotonic())
+            return True
+        return False
+
+
+def _explain(sql, params, analyze) -> str:
+    from db import get_read_connection
+
+    options = "ANALYZE, BUFFERS, FORMAT TEXT" if analyze else "FORMAT TEXT"
+    # SELECTs are re-run where reads are routed; plain EXPLAINs of writes go to the primary.
+    conn = get_read_connection(pin_primary=not analyze)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"EXPLAIN ({options}) {sql}", params)
+            return "\n".join(row[0] for row in cur.fetchall())
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def _capture(page, query_id, normalised, sql, params, elapsed_ms, rows):
+    try:
+        plan = _explain(sql, params, analyze=_analyze_safe(normalised))
+    except Exception as e:
+        plan = f"(plan capture failed: {e})"
+
+    conn = _store()
+    try:
+        conn.execute(
+            """
+            INSERT INTO slow_query (page, query_id, normalised, sql, params, elapsed_ms, rows, plan)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            (page, query_id, normalised, sql, json.dumps(params, default=str), elapsed_ms, rows, plan),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _count(query_id, elapsed_ms):
+    conn = _store()
+    try:
+        conn.execute(
+            """
+            INSERT INTO slow_query_count (query_id, occurrences, total_ms, last_seen)
+            VALUES (?, 1, ?, datetime('now'))
+            ON CONFLICT (query_id) DO UPDATE
+            SET occurrences = occurrences + 1,
+                total_ms = total_ms + excluded.total_ms,
+                last_seen = excluded.last_seen;
+            """,
+            (query_id, elapsed_ms),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _on_statement(sql, normalised, query_id, page, elapsed_ms, rows, params):
+    """instrumentation listener: count statements over the threshold and queue a capture when due."""
+    # EXPLAIN statements issued by _capture() never match these prefixes, so there is no feedback loop.
+    if elapsed_ms < SLOW_QUERY_MS:
+        return
+    if not isinstance(sql, str) or not normalised.startswith(_READ_PREFIXES + _WRITE_PREFIXES):
+        return
+    _executor.submit(_count, query_id, elapsed_ms)
+    if not _should_explain(query_id, elapsed_ms):
+        return
+    _executor.submit(_capture, page, query_id, normalised, sql, params, elapsed_ms, rows)
+
+
+def install():
+    """Start capturing slow statements (called once by db.py)."""
+    instrumentation.add_listener(_on_statement)
+
+
+# =====================================================================
+# Reading the log (Admin page)
+# =====================================================================
+def grouped():
+    """
+    One row per fingerprint: how often it was slow (every run over the
+    threshold), how many plans were captured, worst and average latency, last seen.
+    """
+    if not os.path.exists(SLOW_QUERY_DB):
+        return []
+    conn = _store()
+    try:
+        cur = conn.execute(
+            """
+            SELECT s.query_id, MAX(s.page), COALESCE(c.occurrences, COUNT(*)), COUNT(*),
+                   ROUND(MAX(s.elapsed_ms), 1),
+                   ROUND(COALESCE(c.total_ms / c.occurrences, AVG(s.elapsed_ms)), 1),
+                   COALESCE(c.last_seen, MAX(s.captured_at)), MAX(s.normalised)
+            FROM slow_query s
+            LEFT JOIN slow_query_count c ON c.query_id = s.query_id
+            GROUP BY s.query_id
+            ORDER BY MAX(s.elapsed_ms) DESC;
+            """
+        )
+        columns = ["query_id", "page", "slow_runs", "captures", "worst_ms", "avg_ms", "last_seen", "sql"]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+def worst_case(query_id):
+    """The slowest capture of one fingerprint, including its parameters and plan."""
+    conn = _store()
+    try:
+        cur = conn.execute(
+            """
+            SELECT captured_at, page, elapsed_ms, rows, sql, params, plan
+            FROM slow_query
+            WHERE query_id = ?
+            ORDER BY elapsed_ms DESC
+            LIMIT 1;
+            """,
+            (query_id,),
+        )
+        row = cur.fetchone()
+        columns = ["captured_at", "page", "elapsed_ms", "rows", "sql", "params", "plan"]
+        return dict(zip(columns, row)) if row else None
+    finally:
+        conn.close()
+
+
+def clear():
+    conn = _store()
+    try:
+        conn.execute("DELETE FROM slow_query;")
+        conn.execute("DELETE FROM slow_query_count;")
+        conn.commit()
+    finally:
+        conn.close()
+    with _explained_lock:
+        _explained.clear()
@@ -0,0 +1,291 @@
+"""
+Registry of hot, parameterised read queries, server-side prepared once per pooled connection.
+
+The pages normally open a fresh connection per query, so PostgreSQL parses
+and plans the same short SELECTs on every call. The statements in
+STATEMENTS are instead run on a small connection pool per server (primary
+and each replica); every pooled connection PREPAREs all of them once when
+it is created, and `query(name, params)` only sends `EXECUTE name(...)`.
+
+Plans are monitored per statement: every PLAN_SAMPLE_EVERY calls the
+connection that just ran a statement reports its pg_prepared_statements
+counters, so the Admin page can show how often PostgreSQL switched a
+statement to its generic plan. If a generic plan turns out to be bad for
+skewed parameters (e.g. a drug with thousands of lots), set
+PREPARED_PLAN_CACHE_MODE=force_custom_plan.
+
+Usage:
+    lots = statements.query("lots_for_drug", (drug_id,))
+    receipt = statements.query("dispense_receipt", (dispense_id,), pin_primary=True)
+"""
+import atexit
+import collections
+import os
+import random
+import threading
+import time
+
+import pandas as pd
+from psycopg import sql
+from psycopg_pool import ConnectionPool
+
+import db
+from instrumentation import InstrumentedCursor
+
+STATEMENT_POOL_MIN = int(os.getenv("STATEMENT_POOL_MIN", "1"))
+STATEMENT_POOL_MAX = int(os.getenv("STATEMENT_POOL_MAX", "8"))
+PLAN_SAMPLE_EVERY = int(os.getenv("PLAN_SAMPLE_EVERY", "50"))
+# auto (PostgreSQL default), force_generic_plan or force_custom_plan
+PREPARED_PLAN_CACHE_MODE = os.getenv("PREPARED_PLAN_CACHE_MODE", "auto")
+
+# name -> (parameter types, query with $n placeholders)
+STATEMENTS = {
+    # available_stock = inventory_lot minus active holds (Performance_Script.sql section 2)
+    "lots_for_drug": ("int", """
+        SELECT
+            lot_batch_id,
+            qty_on_hand,
+            qty_available,
+            unit_cost,
+            expiry_date
+        FROM available_stock
+        WHERE drug_id = $1
+        ORDER BY expiry_date ASC, qty_on_hand DESC
+    """),
+    "inventory_snapshot": ("int", """
+        SELECT lot_batch_id, qty_on_hand FROM inventory_lot WHERE lot_batch_id = $1
+    """),
+    "dispense_receipt": ("int", """
+        SELECT
+            di.line_item_id      AS "Line",
+            dp.dispense_id       AS "Dispense ID",
+            dp.dispense_date     AS "Date",
+            p.name               AS "Patient",
+            ph.name              AS "Pharmacist",
+            dc.drug_name         AS "Drug",
+            di.qty_dispensed     AS "Qty dispensed",
+            il.unit_cost         AS "Unit cost",
+            dp.total_amount      AS "Total amount",
+            dp.commission        AS "Commission",
+            il.lot_batch_id      AS "Lot batch",
+            il.expiry_date       AS "Expiry"
+        FROM dispensed_items di
+        JOIN dispense dp        ON di.dispense_id = dp.dispense_id
+        JOIN prescription rx    ON dp.rx_id = rx.rx_id
+        JOIN patient p          ON rx.patient_id = p.patient_id
+        JOIN pharmacist ph      ON dp.pharmacist_id = ph.pharmacist_id
+        JOIN inventory_lot il   ON di.lot_batch_id = il.lot_batch_id
+        JOIN drug_catalogue dc  ON il.drug_id = dc.drug_id
+        WHERE dp.dispense_id = $1
+        ORDER BY di.line_item_id
+    """),
+    "order_receipt": ("int", """
+        SELECT
+            po.Order_id AS "Order ID",
+            s.Company_name AS "Supplier",
+            po.Status AS "Status",
+            dc.Drug_Name AS "Drug Name",
+            poi.Qty_ordered AS "Quantity",
+            poi.Unit_cost AS "Unit Cost"
+        FROM PURCHASE_ORDER po
+        JOIN SUPPLIER s ON po.Supplier_ID = s.Supplier_ID
+        JOIN PURCHASE_ORDER_ITEM poi ON po.Order_id = poi.Product_id
+        JOIN DRUG_CATALOGUE dc ON poi.Drug_id = dc.Drug_id
+        WHERE po.Order_id = $1
+    """),
+    # DRUG_SEARCH (Performance_Script.sql section 8): $1 prefix tsquery, $2 raw text, $3 limit.
+    # Word matches rank above fuzzy-only matches; both predicates use their own GIN index.
+    "drug_search": ("text, text, int", """
+        SELECT
+            drug_id, drug_name, generic_name, form, strength,
+            ts_rank(document, to_tsquery('simple', $1)) + word_similarity($2, terms) AS score
+        FROM drug_search
+        WHERE document @@ to_tsquery('simple', $1) OR $2 <% terms
+        ORDER BY score DESC, drug_name, drug_id
+        LIMIT $3
+    """),
+    "drug_browse": ("int", """
+        SELECT drug_id, drug_name, generic_name, form, strength, 0.0 AS score
+        FROM drug_search
+        ORDER BY drug_name, drug_id
+        LIMIT $1
+    """),
+    # Patient history (Performance_Script.sql section 11). $1 name fragment, $2 patient ID or NULL, $3 limit.
+    "patient_find": ("text, int, int", """
+        SELECT patient_id, name, date_of_birth
+        FROM patient
+        WHERE name ILIKE '%' || $1 || '%' OR patient_id = $2
+        ORDER BY name, patient_id
+        LIMIT $3
+    """),
+    # One page of prescriptions, newest first: $2 / $3 is the (rx_date, rx_id) keyset cursor, $4 the limit.
+    "patient_prescriptions": ("int, date, int, int", """
+        SELECT rx.rx_id, rx.rx_date, rx.status, rx.urgency, doc.name AS doctor, ph.name AS pharmacist
+        FROM prescription rx
+        LEFT JOIN doctor doc    ON doc.doctor_id = rx.doctor_id
+        LEFT JOIN pharmacist ph ON ph.pharmacist_id = rx.pharmacist_id
+        WHERE rx.patient_id = $1 AND (rx.rx_date, rx.rx_id) < ($2, $3)
+        ORDER BY rx.rx_date DESC, rx.rx_id DESC
+        LIMIT $4
+    """),
+    # Items of those prescriptions, each with the lots it was dispensed from and the dispense's cover.
+    "patient_rx_items": ("int[]", """
+        SELECT
+            pi.rx_id, pi.drug_id, dc.drug_name, dc.form, dc.strength,
+            pi.qty_prescribed, pi.dosage_instruc, pi.frequency, pi.refills_allowed,
+            x.dispense_id, x.dispense_date, x.lot_batch_id, x.expiry_date, x.qty_dispensed,
+            x.total_amount, x.covered_total, x.remaining, x.insurers
+        FROM prescription_items pi
+        JOIN drug_catalogue dc ON dc.drug_id = pi.drug_id
+        LEFT JOIN LATERAL (
+            SELECT
+                d.dispense_id, d.dispense_date, di.lot_batch_id, il.expiry_date, di.qty_dispensed,
+                d.total_amount, b.covered_total, b.remaining,
+                (
+                    SELECT string_agg(i.company, ', ' ORDER BY i.company)
+                    FROM pays p JOIN insurance i ON i.policy_id = p.policy_id
+                    WHERE p.dispense_id = d.dispense_id
+                ) AS insurers
+            FROM dispense d
+            JOIN dispensed_items di     ON di.dispense_id = d.dispense_id
+            JOIN inventory_lot il       ON il.lot_batch_id = di.lot_batch_id
+            LEFT JOIN dispense_balance b ON b.dispense_id = d.dispense_id
+            WHERE d.rx_id = pi.rx_id AND il.drug_id = pi.drug_id
+        ) x ON TRUE
+        WHERE pi.rx_id = ANY($1)
+        ORDER BY pi.rx_id DESC, dc.drug_name, x.dispense_date DESC NULLS LAST, x.dispense_id DESC
+    """),
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+_calls = collections.Counter()                 # name -> executions in this process
+_plan_counters = {}                            # (server, backend pid) -> {name: (generic, custom)}
+_stats_lock = threading.Lock()
+
+
+# =====================================================================
+# Pools
+# =====================================================================
+def _configure(conn):
+    """Runs once for every new pooled connection: prepare the whole registry."""
+    with conn.cursor() as cur:
+        if PREPARED_PLAN_CACHE_MODE != "auto":
+            cur.execute("SELECT set_config('plan_cache_mode', %s, false);", (PREPARED_PLAN_CACHE_MODE,))
+        for name, (types, query) in STATEMENTS.items():
+            cur.execute(
+                sql.SQL("PREPARE {} ({}) AS {}").format(sql.Identifier(name), sql.SQL(types), sql.SQL(query))
+            )
+    conn.commit()
+
+
+def _pool(url):
+    with _pools_lock:
+        pool = _pools.get(url)
+        if pool is None:
+            pool = _pools[url] = ConnectionPool(
+                url,
+                min_size=STATEMENT_POOL_MIN,
+                max_size=STATEMENT_POOL_MAX,
+                kwargs={"cursor_factory": InstrumentedCursor},
+                configure=_configure,
+                name=f"statements-{len(_pools)}",
+                open=True,
+            )
+        return pool
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def _replica_ok(url) -> bool:
+    """Same policy as db._connect_replica(), but the lag check borrows a pooled connection."""
+    checked_at, lag = db._replica_health.get(url, (0.0, 0.0))
+    if time.monotonic() - checked_at <= db.REPLICA_CHECK_SECONDS:
+        return lag is not None and lag <= db.REPLICA_MAX_LAG_SECONDS
+    try:
+        with _pool(url).connection(timeout=3) as conn:
+            lag = float(conn.execute(db._LAG_QUERY).fetchone()[0])
+    except Exception:
+        lag = None
+    db._replica_health[url] = (time.monotonic(), lag)
+    return lag is not None and lag <= db.REPLICA_MAX_LAG_SECONDS
+
+
+def _server(pin_primary) -> str:
+    urls = db.DATABASE_REPLICA_URLS
+    if not pin_primary and urls:
+        start = random.randrange(len(urls))
+        for i in range(len(urls)):
+            url = urls[(start + i) % len(urls)]
+            if _replica_ok(url):
+                return url
+    if not db.DATABASE_URL:
+        db._missing_database_url()
+    return db.DATABASE_URL
+
+
+# =====================================================================
+# Running statements
+# =====================================================================
+def query(name: str, params=(), pin_primary=False) -> pd.DataFrame:
+    """EXECUTE a registered statement and return its rows like db.run_query() (Decimals as float)."""
+    types, _ = STATEMENTS[name]
+    if len(params) != len(types.split(",")):
+        raise ValueError(f"{name} expects {len(types.split(','))} parameter(s), got {len(params)}")
+
+    # EXECUTE is a utility statement and cannot take bind parameters, so the
+    # arguments are sent as quoted literals (sql.Literal escapes them).
+    statement = sql.SQL("EXECUTE {} ({})").format(
+        sql.Identifier(name), sql.SQL(", ").join(sql.Literal(p) for p in params)
+    )
+    url = _server(pin_primary)
+    with _pool(url).connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(statement)
+            columns = [d.name for d in cur.description]
+            rows = cur.fetchall()
+
+        with _stats_lock:
+            _calls[name] += 1
+            sample = _calls[name] % PLAN_SAMPLE_EVERY == 1 or PLAN_SAMPLE_EVERY <= 1
+        if sample:
+            _sample_plans(url, conn)
+
+    return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def _sample_plans(url, conn):
+    """Record this connection's generic/custom plan counters (pg_prepared_statements is per session)."""
+    try:
+        rows = conn.execute(
+            "SELECT name, generic_plans, custom_plans FROM pg_prepared_statements WHERE name = ANY(%s);",
+            (list(STATEMENTS),),
+        ).fetchall()
+    except Exception:
+        return  # generic_plans / custom_plans need PostgreSQL 14+
+    with _stats_lock:
+        _plan_counters[(url, conn.info.backend_pid)] = {name: (g, c) for name, g, c in rows}
+
+
+def plan_summary() -> list:
+    """Per statement: calls in this process and generic vs custom plans over the sampled connections."""
+    with _stats_lock:
+        calls = dict(_calls)
+        counters = list(_plan_counters.values())
+    rows = []
+    for name in STATEMENTS:
+        generic = sum(c.get(name, (0, 0))[0] for c in counters)
+        custom = sum(c.get(name, (0, 0))[1] for c in counters)
+        rows.append({
+            "statement": name, "calls": calls.get(name, 0),
+            "sampled_connections": sum(1 for c in counters if name in c),
+            "generic_plans": generic, "custom_plans": custom,
+            "generic_share": round(generic / (generic + custom), 2) if generic + custom else None,
+        })
+    return rows
@@ -0,0 +1,882 @@
+-- Performance & Operations Script
+-- Run this AFTER "Create_Database_ Script.sql" and "Populating_tables_Script.sql".
+-- Every statement is safe to re-run (IF NOT EXISTS / CREATE OR REPLACE / DROP TRIGGER IF EXISTS),
+-- so the script can be applied to an existing database whenever new sections are added.
+
+
+/*=======================
+ * 1. Change Tracking for the Analytics Mirror
+ =======================
+ The reporting workload can run against a local DuckDB copy of our 15 tables (Application/analytics.py).
+ To copy only what changed since the last sync, every INSERT, UPDATE and DELETE on those tables
+ writes the primary key of the touched row into CHANGE_LOG. The triggers that do this are only
+ installed when the mirror is enabled (its first sync); each sync then trims the log it has applied.
+
+ Txid records which transaction made the change. The sync job only reads transactions that are
+ older than the oldest still-running transaction (pg_snapshot_xmin), so a slow transaction that
+ commits late can never be skipped.
+
+ The archiver sets pharmacy.archiving and switches to the pharmacy_archiver role (section 13) for
+ its deletes: archived rows have only moved to Parquet, so the mirror keeps them and the Reports
+ still cover the full history. The setting alone, which any session can set, is not enough.
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS CHANGE_LOG (
+    Change_id BIGSERIAL PRIMARY KEY,
+    Table_name VARCHAR(63) NOT NULL,
+    Row_key JSONB NOT NULL,
+    Txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    Changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_change_log_txid ON CHANGE_LOG(Txid);
+
+CREATE OR REPLACE FUNCTION track_row_change()
+RETURNS TRIGGER AS $$
+DECLARE
+    new_row JSONB;
+    old_row JSONB;
+    new_key JSONB := '{}'::jsonb;
+    old_key JSONB := '{}'::jsonb;
+    col TEXT;
+BEGIN
+    -- Rows moved to the Parquet archive (archive.py) stay in the mirror, so their deletes are not logged.
+    IF current_setting('pharmacy.archiving', true) = 'on' AND current_user = 'pharmacy_archiver' THEN
+        RETURN NULL;
+    END IF;
+
+    -- The primary key column names are passed as trigger arguments (TG_ARGV).
+    IF TG_OP <> 'DELETE' THEN
+        new_row := to_jsonb(NEW);
+        FOREACH col IN ARRAY TG_ARGV LOOP
+            new_key := new_key || jsonb_build_object(col, new_row -> col);
+        END LOOP;
+        INSERT INTO CHANGE_LOG (Table_name, Row_key) VALUES (TG_TABLE_NAME, new_key);
+    END IF;
+
+    -- For DELETE, and for an UPDATE that changed the key, the old key must disappear from the mirror too.
+    IF TG_OP <> 'INSERT' THEN
+        old_row := to_jsonb(OLD);
+        FOREACH col IN ARRAY TG_ARGV LOOP
+            old_key := old_key || jsonb_build_object(col, old_row -> col);
+        END LOOP;
+        IF old_key IS DISTINCT FROM new_key THEN
+            INSERT INTO CHANGE_LOG (Table_name, Row_key) VALUES (TG_TABLE_NAME, old_key);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The trg_track_<table> triggers are created by analytics.py (first sync or `rebuild`), not here,
+-- so a database without the mirror does not log its changes. `python analytics.py disable` drops them.
+
+
+/*=======================
+ * 2. Short-Lived Stock Reservations
+ =======================
+ Between choosing a lot (step 2 of the Dispense wizard) and confirming, another counter could take
+ the same stock, and the first pharmacist's transaction would only fail at the very end.
+ Choosing a lot therefore places a hold on it for a few minutes (Application/services/reservations.py).
+
+ A hold only counts while Expires_at lies in the future, so an abandoned hold stops blocking stock
+ on its own; a background sweeper deletes expired rows in bulk to keep the table small.
+ AVAILABLE_STOCK is what the lot picker shows: on-hand minus the active holds.
+
+ The table is a normal (logged) table on purpose: the lot picker may read from a replica, and
+ unlogged tables cannot be read there.
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS STOCK_RESERVATION (
+    Reservation_id BIGSERIAL PRIMARY KEY,
+    Lot_batch_ID INT NOT NULL REFERENCES INVENTORY_LOT(Lot_batch_ID) ON DELETE CASCADE,
+    Qty INT NOT NULL CHECK (Qty > 0),
+    Holder VARCHAR(64) NOT NULL,
+    Created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    Expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_reservation_lot ON STOCK_RESERVATION(Lot_batch_ID, Expires_at);
+CREATE INDEX IF NOT EXISTS idx_stock_reservation_holder ON STOCK_RESERVATION(Holder);
+CREATE INDEX IF NOT EXISTS idx_stock_reservation_expires ON STOCK_RESERVATION(Expires_at);
+
+CREATE OR REPLACE VIEW AVAILABLE_STOCK AS
+SELECT
+    il.Lot_batch_ID,
+    il.Drug_id,
+    il.Expiry_date,
+    il.Unit_cost,
+    il.Qty_on_hand,
+    COALESCE(h.Qty_held, 0) AS Qty_held,
+    il.Qty_on_hand - COALESCE(h.Qty_held, 0) AS Qty_available
+FROM INVENTORY_LOT il
+LEFT JOIN (
+    SELECT Lot_batch_ID, SUM(Qty) AS Qty_held
+    FROM STOCK_RESERVATION
+    WHERE Expires_at > now()
+    GROUP BY Lot_batch_ID
+) h ON h.Lot_batch_ID = il.Lot_batch_ID;
+
+
+/*=======================
+ * 3. Work Queue for Pending Prescriptions
+ =======================
+ Prescriptions with Status = 'Pending' are filled from a shared queue (Application/services/rx_queue.py):
+ every workstation claims the next one by urgency, then date. The claim query locks the candidate
+ prescription with FOR UPDATE SKIP LOCKED, so workstations claiming at the same moment each get a
+ different prescription instead of waiting on one another.
+
+ A claim is a lease, kept in RX_CLAIM. The workstation refreshes Heartbeat_at while it works; once the
+ heartbeat is older than the claim timeout the prescription is back in the queue for anyone.
+ Keeping the lease out of PRESCRIPTION means heartbeats do not touch the prescription row (or CHANGE_LOG).
+
+ The partial index only covers pending prescriptions, in exactly the order the queue hands them out.
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS RX_CLAIM (
+    Rx_id INT PRIMARY KEY REFERENCES PRESCRIPTION(Rx_id) ON DELETE CASCADE,
+    Workstation VARCHAR(64) NOT NULL,
+    Claimed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    Heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_prescription_pending_queue ON PRESCRIPTION (
+    (CASE Urgency WHEN 'High' THEN 0 WHEN 'Medium' THEN 1 ELSE 2 END), Rx_date, Rx_id
+) WHERE Status = 'Pending';
+
+
+/*=======================
+ * 4. Lot Recalls
+ =======================
+ A recall starts from one or more lots and has to reach every patient who received them:
+ DISPENSED_ITEMS -> DISPENSE -> PRESCRIPTION -> PATIENT (Application/recall.py). Everything after the
+ first step is a primary key lookup, but DISPENSED_ITEMS had no index on Lot_batch_ID, so every recall
+ scanned the whole dispensing history. The covering index below answers "which dispenses used these
+ lots, and how much" from the index alone.
+
+ A recalled lot can also be quarantined: it stays on the shelf (Qty_on_hand is the physical count and
+ is returned to the supplier later), but AVAILABLE_STOCK reports nothing available and a trigger refuses
+ to dispense from it.
+ =====================
+ */
+
+CREATE INDEX IF NOT EXISTS idx_dispensed_items_lot
+    ON DISPENSED_ITEMS(Lot_batch_ID) INCLUDE (Dispense_id, Qty_dispensed);
+
+-- Recalls by drug and expiry window ("every lot of drug 2003 expiring in March").
+CREATE INDEX IF NOT EXISTS idx_inventory_lot_drug_expiry ON INVENTORY_LOT(Drug_id, Expiry_date);
+
+CREATE TABLE IF NOT EXISTS LOT_QUARANTINE (
+    Lot_batch_ID INT PRIMARY KEY REFERENCES INVENTORY_LOT(Lot_batch_ID) ON DELETE CASCADE,
+    Reason VARCHAR(255),
+    Quarantined_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE VIEW AVAILABLE_STOCK AS
+SELECT
+    il.Lot_batch_ID,
+    il.Drug_id,
+    il.Expiry_date,
+    il.Unit_cost,
+    il.Qty_on_hand,
+    COALESCE(h.Qty_held, 0) AS Qty_held,
+    CASE WHEN q.Lot_batch_ID IS NULL THEN il.Qty_on_hand - COALESCE(h.Qty_held, 0) ELSE 0 END AS Qty_available,
+    q.Lot_batch_ID IS NOT NULL AS Quarantined
+FROM INVENTORY_LOT il
+LEFT JOIN (
+    SELECT Lot_batch_ID, SUM(Qty) AS Qty_held
+    FROM STOCK_RESERVATION
+    WHERE Expires_at > now()
+    GROUP BY Lot_batch_ID
+) h ON h.Lot_batch_ID = il.Lot_batch_ID
+LEFT JOIN LOT_QUARANTINE q ON q.Lot_batch_ID = il.Lot_batch_ID;
+
+CREATE OR REPLACE FUNCTION prevent_quarantined_dispense()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM LOT_QUARANTINE WHERE Lot_batch_ID = NEW.Lot_batch_ID) THEN
+        RAISE EXCEPTION 'Cannot dispense Lot_batch_ID %. This lot is quarantined after a recall.', NEW.Lot_batch_ID;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_check_quarantine ON DISPENSED_ITEMS;
+CREATE TRIGGER trg_check_quarantine
+BEFORE INSERT ON DISPENSED_ITEMS
+FOR EACH ROW
+EXECUTE FUNCTION prevent_quarantined_dispense();
+
+
+/*=======================
+ * 5. Per-Drug Stock Summary
+ =======================
+ Low-stock alerts used to count lots with Qty_on_hand < 100: a drug with ten small lots raised ten alerts,
+ and a drug whose only lot had expired still looked healthy. DRUG_STOCK_SUMMARY keeps one row per drug
+ (total and usable stock, lot counts, nearest usable expiry) plus its own Reorder_level, and the
+ Dashboard and landing page read it instead of scanning every lot.
+
+ A trigger on INVENTORY_LOT follows every change, including the stock reductions made by
+ trg_reduce_stock. New lots and changes to a lot (a dispense, a delivery, a corrected expiry) are
+ applied as one signed-delta upsert of the drug's row: the row lock is held only for that statement's
+ increment, as with DISPENSE_BALANCE, and concurrent dispenses from different lots of a drug do not
+ wait for each other to recalculate. Only the rare changes that cannot be expressed as a delta
+ (a lot deleted or moved to another drug, a lot quarantined or released, the nearest lot leaving the
+ usable stock) recalculate the row from the drug's lots; refresh_drug_stock() locks the row first, so
+ it sees every change committed before it.
+
+ "Usable" means not expired and not quarantined (LOT_QUARANTINE, section 4), so a recalled drug whose
+ only stock is quarantined shows as out of stock. Expiry changes with the calendar and not only with
+ the lots: a row whose Nearest_expiry has passed is stale; refresh_stale_drug_stock() recalculates
+ exactly those rows and is run periodically by the application's background sweeper.
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS DRUG_STOCK_SUMMARY (
+    Drug_id INT PRIMARY KEY REFERENCES DRUG_CATALOGUE(Drug_id) ON DELETE CASCADE,
+    Total_on_hand INT NOT NULL DEFAULT 0,
+    Usable_on_hand INT NOT NULL DEFAULT 0,
+    Lot_count INT NOT NULL DEFAULT 0,
+    Usable_lot_count INT NOT NULL DEFAULT 0,
+    Nearest_expiry DATE,
+    -- Set per drug by the pharmacy (Order page); the triggers never touch it.
+    Reorder_level INT NOT NULL DEFAULT 100 CHECK (Reorder_level >= 0),
+    Refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_drug_stock_low ON DRUG_STOCK_SUMMARY(Drug_id) WHERE Usable_on_hand < Reorder_level;
+CREATE INDEX IF NOT EXISTS idx_drug_stock_nearest_expiry ON DRUG_STOCK_SUMMARY(Nearest_expiry);
+
+CREATE OR REPLACE FUNCTION refresh_drug_stock(p_drug_id INT)
+RETURNS VOID AS $$
+BEGIN
+    IF p_drug_id IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO DRUG_STOCK_SUMMARY (Drug_id) VALUES (p_drug_id) ON CONFLICT (Drug_id) DO NOTHING;
+    -- Serialise per drug: wait for any other transaction that is changing this drug's lots.
+    PERFORM 1 FROM DRUG_STOCK_SUMMARY WHERE Drug_id = p_drug_id FOR UPDATE;
+
+    UPDATE DRUG_STOCK_SUMMARY s
+    SET Total_on_hand = agg.total_on_hand,
+        Usable_on_hand = agg.usable_on_hand,
+        Lot_count = agg.lot_count,
+        Usable_lot_count = agg.usable_lot_count,
+        Nearest_expiry = agg.nearest_expiry,
+        Refreshed_at = now()
+    FROM (
+        SELECT
+            COALESCE(SUM(il.Qty_on_hand), 0) AS total_on_hand,
+            COALESCE(SUM(il.Qty_on_hand) FILTER (WHERE il.Expiry_date >= CURRENT_DATE AND q.Lot_batch_ID IS NULL), 0)
+                AS usable_on_hand,
+            COUNT(*) AS lot_count,
+            COUNT(*) FILTER (WHERE il.Expiry_date >= CURRENT_DATE AND q.Lot_batch_ID IS NULL) AS usable_lot_count,
+            MIN(il.Expiry_date) FILTER (WHERE il.Expiry_date >= CURRENT_DATE AND q.Lot_batch_ID IS NULL)
+                AS nearest_expiry
+        FROM INVENTORY_LOT il
+        LEFT JOIN LOT_QUARANTINE q ON q.Lot_batch_ID = il.Lot_batch_ID
+        WHERE il.Drug_id = p_drug_id
+    ) agg
+    WHERE s.Drug_id = p_drug_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION track_drug_stock()
+RETURNS TRIGGER AS $$
+DECLARE
+    quarantined BOOLEAN;
+    old_usable BOOLEAN := FALSE;
+    new_usable BOOLEAN;
+    lost_expiry DATE;
+BEGIN
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.Drug_id IS DISTINCT FROM NEW.Drug_id) THEN
+        -- Rare, and the lot's quarantine row may already be gone with it: recalculate both drugs.
+        PERFORM refresh_drug_stock(OLD.Drug_id);
+        IF TG_OP = 'UPDATE' THEN
+            PERFORM refresh_drug_stock(NEW.Drug_id);
+        END IF;
+        RETURN NULL;
+    END IF;
+    IF NEW.Drug_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    quarantined := EXISTS (SELECT 1 FROM LOT_QUARANTINE WHERE Lot_batch_ID = NEW.Lot_batch_ID);
+    new_usable := NEW.Expiry_date >= CURRENT_DATE AND NOT quarantined;
+    IF TG_OP = 'UPDATE' THEN
+        old_usable := OLD.Expiry_date >= CURRENT_DATE AND NOT quarantined;
+        -- The lot left the usable stock or moved its expiry: the nearest expiry may have to be looked up again.
+        IF old_usable AND (NOT new_usable OR NEW.Expiry_date > OLD.Expiry_date) THEN
+            lost_expiry := OLD.Expiry_date;
+        END IF;
+    END IF;
+
+    -- One signed-delta upsert; the row lock lasts for this increment only.
+    INSERT INTO DRUG_STOCK_SUMMARY AS s (Drug_id, Total_on_hand, Usable_on_hand, Lot_count, Usable_lot_count, Nearest_expiry)
+    VALUES (
+        NEW.Drug_id,
+        NEW.Qty_on_hand - CASE WHEN TG_OP = 'UPDATE' THEN OLD.Qty_on_hand ELSE 0 END,
+        CASE WHEN new_usable THEN NEW.Qty_on_hand ELSE 0 END - CASE WHEN old_usable THEN OLD.Qty_on_hand ELSE 0 END,
+        CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE 0 END,
+        new_usable::int - old_usable::int,
+        CASE WHEN new_usable THEN NEW.Expiry_date END
+    )
+    ON CONFLICT (Drug_id) DO UPDATE SET
+        Total_on_hand = s.Total_on_hand + EXCLUDED.Total_on_hand,
+        Usable_on_hand = s.Usable_on_hand + EXCLUDED.Usable_on_hand,
+        Lot_count = s.Lot_count + EXCLUDED.Lot_count,
+        Usable_lot_count = s.Usable_lot_count + EXCLUDED.Usable_lot_count,
+        Nearest_expiry = CASE
+            WHEN lost_expiry IS NOT NULL AND lost_expiry <= s.Nearest_expiry THEN (
+                SELECT MIN(il.Expiry_date)
+                FROM INVENTORY_LOT il
+                WHERE il.Drug_id = NEW.Drug_id
+                  AND il.Expiry_date >= CURRENT_DATE
+                  AND NOT EXISTS (SELECT 1 FROM LOT_QUARANTINE q WHERE q.Lot_batch_ID = il.Lot_batch_ID)
+            )
+            ELSE LEAST(s.Nearest_expiry, EXCLUDED.Nearest_expiry)
+        END,
+        Refreshed_at = now();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_drug_stock_summary ON INVENTORY_LOT;
+CREATE TRIGGER trg_drug_stock_summary
+AFTER INSERT OR DELETE OR UPDATE OF Qty_on_hand, Expiry_date, Drug_id ON INVENTORY_LOT
+FOR EACH ROW EXECUTE FUNCTION track_drug_stock();
+
+-- Quarantining or releasing a lot changes the drug's usable stock without touching INVENTORY_LOT.
+CREATE OR REPLACE FUNCTION track_quarantine_stock()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- On a cascaded delete the lot itself is gone, and its own trigger recalculates the drug.
+    PERFORM refresh_drug_stock(il.Drug_id)
+    FROM INVENTORY_LOT il
+    WHERE il.Lot_batch_ID = CASE WHEN TG_OP = 'DELETE' THEN OLD.Lot_batch_ID ELSE NEW.Lot_batch_ID END;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_quarantine_stock ON LOT_QUARANTINE;
+CREATE TRIGGER trg_quarantine_stock
+AFTER INSERT OR DELETE ON LOT_QUARANTINE
+FOR EACH ROW EXECUTE FUNCTION track_quarantine_stock();
+
+-- Rows whose nearest usable lot has expired since they were calculated. Returns how many were refreshed.
+CREATE OR REPLACE FUNCTION refresh_stale_drug_stock()
+RETURNS INT AS $$
+DECLARE
+    d INT;
+    n INT := 0;
+BEGIN
+    FOR d IN SELECT Drug_id FROM DRUG_STOCK_SUMMARY WHERE Nearest_expiry < CURRENT_DATE ORDER BY Drug_id LOOP
+        PERFORM refresh_drug_stock(d);
+        n := n + 1;
+    END LOOP;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Backfill every drug once (also picks up drugs without lots, which then show 0 usable stock).
+INSERT INTO DRUG_STOCK_SUMMARY (Drug_id)
+SELECT Drug_id FROM DRUG_CATALOGUE
+ON CONFLICT (Drug_id) DO NOTHING;
+
+SELECT refresh_drug_stock(Drug_id) FROM DRUG_STOCK_SUMMARY;
+
+
+/*=======================
+ * 6. KPI History
+ =======================
+ Application/kpi_history.py samples the Dashboard KPIs (stock health, low-stock drugs, pending orders,
+ expired lots, today's dispense count and revenue) on a schedule. Each sample is stored once in
+ KPI_SAMPLE and folded straight into hourly, daily and monthly buckets in KPI_ROLLUP (sum, count, min,
+ max, last), so trend charts read a few hundred small rows and never the transaction history.
+
+ Retention is per grain: raw samples and hourly buckets are pruned after a while, daily buckets much
+ later, monthly buckets are kept.
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS KPI_SAMPLE (
+    Metric VARCHAR(40) NOT NULL,
+    Sampled_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    Value NUMERIC(14, 2) NOT NULL,
+    PRIMARY KEY (Metric, Sampled_at)
+);
+
+CREATE TABLE IF NOT EXISTS KPI_ROLLUP (
+    Metric VARCHAR(40) NOT NULL,
+    Grain VARCHAR(5) NOT NULL CHECK (Grain IN ('hour', 'day', 'month')),
+    Bucket TIMESTAMPTZ NOT NULL,
+    Samples INT NOT NULL,
+    Sum_value NUMERIC(18, 2) NOT NULL,
+    Min_value NUMERIC(14, 2) NOT NULL,
+    Max_value NUMERIC(14, 2) NOT NULL,
+    Last_value NUMERIC(14, 2) NOT NULL,
+    Last_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (Metric, Grain, Bucket)
+);
+
+-- Retention deletes by age across all metrics.
+CREATE INDEX IF NOT EXISTS idx_kpi_sample_time ON KPI_SAMPLE(Sampled_at);
+CREATE INDEX IF NOT EXISTS idx_kpi_rollup_grain_bucket ON KPI_ROLLUP(Grain, Bucket);
+
+-- Today's dispense volume and revenue are read on every sample.
+CREATE INDEX IF NOT EXISTS idx_dispense_date ON DISPENSE(Dispense_date);
+
+
+/*=======================
+ * 7. Audit Log (Asynchronous, Batched)
+ =======================
+ Every INSERT, UPDATE and DELETE on the core tables is recorded with who, when and the row before
+ and after, so even a reversed (deleted) dispense stays on record.
+
+ The trigger only appends one row to AUDIT_STAGING, an UNLOGGED table: no WAL is written for it,
+ so the dispense transaction pays for a heap insert and nothing more. The background sweeper
+ (services.drain_audit, every few seconds) moves staged rows into the append-only AUDIT_LOG in
+ batches, deleting and inserting in one statement.
+ Trade-off: an unlogged table is emptied by a crash, so changes staged but not yet drained
+ (at most one sweep interval) are lost from the audit trail; the data changes themselves are not.
+
+ Who: the 'pharmacy.actor' setting that the service layer sets per transaction
+ (services.acting_as), otherwise the database user and application name.
+ AUDIT_LOG refuses UPDATE, DELETE and TRUNCATE.
+
+ The archiver's deletes (archive.py) are not audited: they move closed rows to Parquet unchanged,
+ so copying every before-image into AUDIT_LOG would only grow it by the size of the archive. The
+ Parquet files are the record of those rows. Only the pharmacy_archiver role (section 13) can skip
+ auditing, and only with pharmacy.archiving set; any other session that sets it is audited as usual.
+ =====================
+ */
+
+CREATE UNLOGGED TABLE IF NOT EXISTS AUDIT_STAGING (
+    Audit_id BIGSERIAL PRIMARY KEY,
+    Table_name VARCHAR(63) NOT NULL,
+    Operation CHAR(1) NOT NULL CHECK (Operation IN ('I', 'U', 'D')),
+    Old_row JSONB,
+    New_row JSONB,
+    Actor TEXT NOT NULL,
+    Txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    Changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS AUDIT_LOG (
+    Audit_id BIGINT PRIMARY KEY,
+    Table_name VARCHAR(63) NOT NULL,
+    Operation CHAR(1) NOT NULL,
+    Old_row JSONB,
+    New_row JSONB,
+    Actor TEXT NOT NULL,
+    Txid XID8 NOT NULL,
+    Changed_at TIMESTAMPTZ NOT NULL
+);
+
+-- Audit questions are "what happened to table X / done by Y in this period".
+CREATE INDEX IF NOT EXISTS idx_audit_log_table_time ON AUDIT_LOG(Table_name, Changed_at);
+CREATE INDEX IF NOT EXISTS idx_audit_log_actor_time ON AUDIT_LOG(Actor, Changed_at);
+
+CREATE OR REPLACE FUNCTION audit_row_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('pharmacy.archiving', true) = 'on' AND current_user = 'pharmacy_archiver' THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO AUDIT_STAGING (Table_name, Operation, Old_row, New_row, Actor)
+    VALUES (
+        TG_TABLE_NAME,
+        LEFT(TG_OP, 1),
+        CASE WHEN TG_OP <> 'INSERT' THEN to_jsonb(OLD) END,
+        CASE WHEN TG_OP <> 'DELETE' THEN to_jsonb(NEW) END,
+        COALESCE(
+            NULLIF(current_setting('pharmacy.actor', true), ''),
+            session_user || COALESCE(' / ' || NULLIF(current_setting('application_name', true), ''), '')
+        )
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION prevent_audit_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    RAISE EXCEPTION 'AUDIT_LOG is append-only (% refused)', TG_OP;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_audit_log_append_only ON AUDIT_LOG;
+CREATE TRIGGER trg_audit_log_append_only BEFORE UPDATE OR DELETE ON AUDIT_LOG
+FOR EACH ROW EXECUTE FUNCTION prevent_audit_change();
+
+DROP TRIGGER IF EXISTS trg_audit_log_no_truncate ON AUDIT_LOG;
+CREATE TRIGGER trg_audit_log_no_truncate BEFORE TRUNCATE ON AUDIT_LOG
+FOR EACH STATEMENT EXECUTE FUNCTION prevent_audit_change();
+
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY[
+        'doctor', 'patient', 'pharmacist', 'insurance', 'supplier', 'generics', 'drug_catalogue',
+        'inventory_lot', 'prescription', 'prescription_items', 'dispense', 'dispensed_items',
+        'purchase_order', 'purchase_order_item', 'pays', 'lot_quarantine'
+    ] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS trg_audit_%s ON %I;', t, t);
+        EXECUTE format(
+            'CREATE TRIGGER trg_audit_%s AFTER INSERT OR UPDATE OR DELETE ON %I '
+            'FOR EACH ROW EXECUTE FUNCTION audit_row_change();', t, t
+        );
+    END LOOP;
+END $$;
+
+
+/*=======================
+ * 8. Drug Search
+ =======================
+ Pharmacists look drugs up by brand name, generic name, form or strength ("amoxi 500", "ibuprofen gel").
+ DRUG_SEARCH holds one row per drug with those four fields combined twice:
+   - Document, a weighted tsvector (name A, generic B, form and strength C) for word and prefix matches,
+     ranked with ts_rank;
+   - Terms, the same words as plain lower-case text, for pg_trgm similarity, so typos ("ibuprofn") and
+     partial words still find the drug.
+ Both have a GIN index, and a search is one indexed query with a LIMIT (Application/drug_search.py).
+
+ The generic name lives in GENERICS, so a generated column cannot be used; triggers on DRUG_CATALOGUE
+ and GENERICS rebuild the affected rows instead.
+ =====================
+ */
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE TABLE IF NOT EXISTS DRUG_SEARCH (
+    Drug_id INT PRIMARY KEY REFERENCES DRUG_CATALOGUE(Drug_id) ON DELETE CASCADE,
+    Drug_name VARCHAR(100),
+    Generic_name VARCHAR(100),
+    Form VARCHAR(50),
+    Strength VARCHAR(50),
+    Terms TEXT NOT NULL,
+    Document TSVECTOR NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_drug_search_document ON DRUG_SEARCH USING GIN (Document);
+CREATE INDEX IF NOT EXISTS idx_drug_search_terms ON DRUG_SEARCH USING GIN (Terms gin_trgm_ops);
+-- The empty search lists drugs alphabetically.
+CREATE INDEX IF NOT EXISTS idx_drug_search_name ON DRUG_SEARCH(Drug_name, Drug_id);
+
+CREATE OR REPLACE FUNCTION refresh_drug_search(p_drug_ids INT[])
+RETURNS VOID AS $$
+    INSERT INTO DRUG_SEARCH (Drug_id, Drug_name, Generic_name, Form, Strength, Terms, Document)
+    SELECT
+        dc.Drug_id,
+        dc.Drug_Name,
+        g.Generic_name,
+        dc.Form,
+        dc.Strength,
+        lower(concat_ws(' ', dc.Drug_Name, g.Generic_name, dc.Form, dc.Strength)),
+        setweight(to_tsvector('simple', COALESCE(dc.Drug_Name, '')), 'A')
+            || setweight(to_tsvector('simple', COALESCE(g.Generic_name, '')), 'B')
+            || setweight(to_tsvector('simple', concat_ws(' ', dc.Form, dc.Strength)), 'C')
+    FROM DRUG_CATALOGUE dc
+    LEFT JOIN GENERICS g ON g.Drug_Name = dc.Drug_Name
+    WHERE dc.Drug_id = ANY(p_drug_ids)
+    ON CONFLICT (Drug_id) DO UPDATE SET
+        Drug_name = EXCLUDED.Drug_name,
+        Generic_name = EXCLUDED.Generic_name,
+        Form = EXCLUDED.Form,
+        Strength = EXCLUDED.Strength,
+        Terms = EXCLUDED.Terms,
+        Document = EXCLUDED.Document;
+$$ LANGUAGE sql;
+
+-- Deleted drugs leave DRUG_SEARCH through the ON DELETE CASCADE.
+CREATE OR REPLACE FUNCTION track_drug_search_catalogue()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM refresh_drug_search(ARRAY[NEW.Drug_id]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_drug_search_catalogue ON DRUG_CATALOGUE;
+CREATE TRIGGER trg_drug_search_catalogue
+AFTER INSERT OR UPDATE OF Drug_Name, Form, Strength ON DRUG_CATALOGUE
+FOR EACH ROW EXECUTE FUNCTION track_drug_search_catalogue();
+
+CREATE OR REPLACE FUNCTION track_drug_search_generics()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM refresh_drug_search(ARRAY(
+        SELECT Drug_id FROM DRUG_CATALOGUE
+        WHERE Drug_Name IN (
+            CASE WHEN TG_OP <> 'DELETE' THEN NEW.Drug_Name END,
+            CASE WHEN TG_OP <> 'INSERT' THEN OLD.Drug_Name END
+        )
+    ));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_drug_search_generics ON GENERICS;
+CREATE TRIGGER trg_drug_search_generics
+AFTER INSERT OR UPDATE OR DELETE ON GENERICS
+FOR EACH ROW EXECUTE FUNCTION track_drug_search_generics();
+
+-- Backfill every drug once.
+SELECT refresh_drug_search(ARRAY(SELECT Drug_id FROM DRUG_CATALOGUE));
+
+
+/*=======================
+ * 9. Maintained Insurance Balances
+ =======================
+ The Insurance page needs, per dispense, how much insurers have covered and what is still open.
+ Summing PAYS for every dispense on every visit does not scale, so DISPENSE_BALANCE keeps one row per
+ dispense with its total, Covered_total and the generated Remaining.
+
+ Triggers keep it exact: a new dispense adds its row, a PAYS insert/update/delete adds the difference
+ to Covered_total with a single UPDATE (the row lock serialises concurrent payments, nothing is lost),
+ and deleting a dispense (reversal, archiving) removes the row through ON DELETE CASCADE.
+
+ The outstanding list pages through a partial index that only contains dispenses with Remaining > 0,
+ newest first (keyset pagination on Dispense_id), so fully paid dispenses cost nothing.
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS DISPENSE_BALANCE (
+    Dispense_id INT PRIMARY KEY REFERENCES DISPENSE(Dispense_id) ON DELETE CASCADE,
+    Dispense_date DATE NOT NULL,
+    Total_amount DECIMAL(10, 2) NOT NULL,
+    Covered_total DECIMAL(10, 2) NOT NULL DEFAULT 0,
+    Remaining DECIMAL(10, 2) GENERATED ALWAYS AS (Total_amount - Covered_total) STORED
+);
+
+CREATE INDEX IF NOT EXISTS idx_dispense_balance_outstanding
+    ON DISPENSE_BALANCE(Dispense_id DESC) WHERE Remaining > 0;
+CREATE INDEX IF NOT EXISTS idx_dispense_balance_outstanding_date
+    ON DISPENSE_BALANCE(Dispense_date, Dispense_id) WHERE Remaining > 0;
+
+CREATE OR REPLACE FUNCTION track_dispense_balance()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO DISPENSE_BALANCE (Dispense_id, Dispense_date, Total_amount)
+    VALUES (NEW.Dispense_id, NEW.Dispense_date, NEW.Total_amount)
+    ON CONFLICT (Dispense_id) DO UPDATE SET
+        Dispense_date = EXCLUDED.Dispense_date,
+        Total_amount = EXCLUDED.Total_amount;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_dispense_balance ON DISPENSE;
+CREATE TRIGGER trg_dispense_balance
+AFTER INSERT OR UPDATE OF Dispense_date, Total_amount ON DISPENSE
+FOR EACH ROW EXECUTE FUNCTION track_dispense_balance();
+
+CREATE OR REPLACE FUNCTION track_covered_total()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        -- The dispense row may already be gone (its PAYS rows are deleted first in a reversal).
+        UPDATE DISPENSE_BALANCE
+        SET Covered_total = Covered_total - COALESCE(OLD.Amount_covered, 0)
+        WHERE Dispense_id = OLD.Dispense_id;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        UPDATE DISPENSE_BALANCE
+        SET Covered_total = Covered_total + COALESCE(NEW.Amount_covered, 0)
+        WHERE Dispense_id = NEW.Dispense_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_covered_total ON PAYS;
+CREATE TRIGGER trg_covered_total
+AFTER INSERT OR DELETE OR UPDATE OF Dispense_id, Amount_covered ON PAYS
+FOR EACH ROW EXECUTE FUNCTION track_covered_total();
+
+-- Backfill (or repair) every live dispense.
+INSERT INTO DISPENSE_BALANCE (Dispense_id, Dispense_date, Total_amount, Covered_total)
+SELECT d.Dispense_id, d.Dispense_date, d.Total_amount, COALESCE(p.covered, 0)
+FROM DISPENSE d
+LEFT JOIN (
+    SELECT Dispense_id, SUM(Amount_covered) AS covered FROM PAYS GROUP BY Dispense_id
+) p ON p.Dispense_id = d.Dispense_id
+ON CONFLICT (Dispense_id) DO UPDATE SET
+    Dispense_date = EXCLUDED.Dispense_date,
+    Total_amount = EXCLUDED.Total_amount,
+    Covered_total = EXCLUDED.Covered_total;
+
+
+/*=======================
+ * 10. Refill Schedule
+ =======================
+ PRESCRIPTION_ITEMS.Refills_allowed counts the refills still left on an item. REFILL_SCHEDULE keeps,
+ per item with refills, the date the next refill is due (Next_due) and the days between refills
+ (Interval_days, default 30: a month's supply of a chronic medication).
+
+ A trigger on DISPENSED_ITEMS adds or moves the schedule row whenever an item with refills left is
+ dispensed, so the first refill falls due one interval after the first actual fill, and every later fill
+ (at the counter or by the nightly refill run, services/refills.py) moves Next_due on from that day.
+ Only prescriptions with Status 'Dispensed' are refilled: Pending ones belong to the prescription queue.
+ Items drop out of the schedule with their prescription through ON DELETE CASCADE. Reversing a refill
+ (services/dispense.py) gives the refill back and restarts Next_due from the latest remaining dispense.
+
+ The run reads the due items in (Next_due, Rx_id, Drug_id) order, batch by batch, from the index below.
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS REFILL_SCHEDULE (
+    Rx_id INT NOT NULL,
+    Drug_id INT NOT NULL,
+    Interval_days INT NOT NULL DEFAULT 30 CHECK (Interval_days > 0),
+    Next_due DATE NOT NULL,
+    Last_refill_on DATE,
+    PRIMARY KEY (Rx_id, Drug_id),
+    FOREIGN KEY (Rx_id, Drug_id) REFERENCES PRESCRIPTION_ITEMS(Rx_id, Drug_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_refill_schedule_due
+    ON REFILL_SCHEDULE(Next_due, Rx_id, Drug_id);
+
+-- Every dispense of an item with refills left (re)starts its schedule from the dispense date,
+-- so only items that have actually been filled are ever due.
+CREATE OR REPLACE FUNCTION schedule_refill_after_dispense()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO REFILL_SCHEDULE AS rs (Rx_id, Drug_id, Next_due, Last_refill_on)
+    SELECT pi.Rx_id, pi.Drug_id, d.Dispense_date + 30, d.Dispense_date
+    FROM DISPENSE d
+    JOIN INVENTORY_LOT il ON il.Lot_batch_ID = NEW.Lot_batch_ID
+    JOIN PRESCRIPTION_ITEMS pi ON pi.Rx_id = d.Rx_id AND pi.Drug_id = il.Drug_id
+    WHERE d.Dispense_id = NEW.Dispense_id AND pi.Refills_allowed > 0
+    ON CONFLICT (Rx_id, Drug_id) DO UPDATE SET
+        Next_due = EXCLUDED.Last_refill_on + rs.Interval_days,
+        Last_refill_on = EXCLUDED.Last_refill_on;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_schedule_refill_after_dispense ON DISPENSED_ITEMS;
+CREATE TRIGGER trg_schedule_refill_after_dispense
+AFTER INSERT ON DISPENSED_ITEMS
+FOR EACH ROW EXECUTE FUNCTION schedule_refill_after_dispense();
+
+-- Refills added to an item that was already dispensed: schedule from its last dispense.
+CREATE OR REPLACE FUNCTION schedule_refills()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO REFILL_SCHEDULE (Rx_id, Drug_id, Next_due, Last_refill_on)
+    SELECT NEW.Rx_id, NEW.Drug_id, MAX(d.Dispense_date) + 30, MAX(d.Dispense_date)
+    FROM DISPENSE d
+    JOIN DISPENSED_ITEMS di ON di.Dispense_id = d.Dispense_id
+    JOIN INVENTORY_LOT il ON il.Lot_batch_ID = di.Lot_batch_ID
+    WHERE d.Rx_id = NEW.Rx_id AND il.Drug_id = NEW.Drug_id
+    HAVING MAX(d.Dispense_date) IS NOT NULL
+    ON CONFLICT (Rx_id, Drug_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_schedule_refills ON PRESCRIPTION_ITEMS;
+CREATE TRIGGER trg_schedule_refills
+AFTER UPDATE OF Refills_allowed ON PRESCRIPTION_ITEMS
+FOR EACH ROW
+WHEN (COALESCE(NEW.Refills_allowed, 0) > COALESCE(OLD.Refills_allowed, 0))
+EXECUTE FUNCTION schedule_refills();
+
+-- Backfill: the next refill is due one interval after the item's last dispense. Items that were never
+-- dispensed get no schedule (and lose one an earlier version of this section gave them).
+DELETE FROM REFILL_SCHEDULE rs
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM DISPENSE d
+    JOIN DISPENSED_ITEMS di ON di.Dispense_id = d.Dispense_id
+    JOIN INVENTORY_LOT il ON il.Lot_batch_ID = di.Lot_batch_ID
+    WHERE d.Rx_id = rs.Rx_id AND il.Drug_id = rs.Drug_id
+);
+
+INSERT INTO REFILL_SCHEDULE (Rx_id, Drug_id, Next_due, Last_refill_on)
+SELECT pi.Rx_id, pi.Drug_id, f.last_fill + 30, f.last_fill
+FROM PRESCRIPTION_ITEMS pi
+JOIN (
+    SELECT d.Rx_id, il.Drug_id, MAX(d.Dispense_date) AS last_fill
+    FROM DISPENSE d
+    JOIN DISPENSED_ITEMS di ON di.Dispense_id = d.Dispense_id
+    JOIN INVENTORY_LOT il ON il.Lot_batch_ID = di.Lot_batch_ID
+    GROUP BY d.Rx_id, il.Drug_id
+) f ON f.Rx_id = pi.Rx_id AND f.Drug_id = pi.Drug_id
+WHERE pi.Refills_allowed > 0
+ON CONFLICT (Rx_id, Drug_id) DO NOTHING;
+
+
+/*=======================
+ * 11. Patient Medication History
+ =======================
+ The pharmacist looks up a patient's history at every counter visit (Application/patient_history.py):
+ prescriptions newest first, a page at a time, then their items, dispenses, lots and insurance cover.
+ Before these indexes every lookup scanned PRESCRIPTION for the patient and DISPENSE / DISPENSED_ITEMS
+ for the prescriptions, because the foreign key columns had no index of their own.
+
+ Pages are keyset-paginated on (Rx_date, Rx_id) descending, which idx_prescription_patient_date reads
+ backwards, so page 50 costs the same as page 1. PAYS is reached through its primary key (Dispense_id
+ first). Patients are found by any part of their name through a trigram index (pg_trgm, section 8).
+ =====================
+ */
+
+CREATE INDEX IF NOT EXISTS idx_prescription_patient_date ON PRESCRIPTION(Patient_id, Rx_date, Rx_id);
+CREATE INDEX IF NOT EXISTS idx_dispense_rx ON DISPENSE(Rx_id);
+CREATE INDEX IF NOT EXISTS idx_dispensed_items_dispense
+    ON DISPENSED_ITEMS(Dispense_id) INCLUDE (Lot_batch_ID, Qty_dispensed);
+CREATE INDEX IF NOT EXISTS idx_patient_name_trgm ON PATIENT USING GIN (Name gin_trgm_ops);
+
+
+/*=======================
+ * 12. Archive High-Water Marks
+ =======================
+ Keys of DISPENSE, DISPENSED_ITEMS and PURCHASE_ORDER are assigned by the application as MAX + 1
+ (services/common.py next_id). Once the archiver (Application/archive.py) has moved the newest rows
+ of a table to Parquet, MAX + 1 over the live rows would hand out an ID that archived rows,
+ recall traces and insurance history still use.
+
+ The archiver records the highest archived ID of each table here, in the transaction that deletes
+ the rows, and next_id allocates above GREATEST(live max, archived max).
+ =====================
+ */
+
+CREATE TABLE IF NOT EXISTS ARCHIVE_HIGH_WATER (
+    Table_name VARCHAR(40) PRIMARY KEY,
+    Max_id INT NOT NULL
+);
+
+
+/*=======================
+ * 13. Archiver Role
+ =======================
+ The CHANGE_LOG and audit triggers (sections 1 and 7) skip the archiver's deletes. A session
+ setting would let any connection delete rows without an audit trail, so the skip also requires
+ the pharmacy_archiver role: archive.py runs SET LOCAL ROLE pharmacy_archiver just before its
+ deletes, and the role can do nothing but move closed history out.
+
+ The role cannot log in. Membership is granted to the user running this script (the application
+ owner); where the pages and the API connect as a separate user, do not grant it to that user.
+ =====================
+ */
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'pharmacy_archiver') THEN
+        CREATE ROLE pharmacy_archiver NOLOGIN;
+    END IF;
+END $$;
+
+GRANT SELECT, DELETE ON DISPENSE, DISPENSED_ITEMS, PAYS, PURCHASE_ORDER, PURCHASE_ORDER_ITEM TO pharmacy_archiver;
+-- Deleting PAYS rows updates DISPENSE_BALANCE through trg_covered_total (section 9).
+GRANT SELECT, UPDATE ON DISPENSE_BALANCE TO pharmacy_archiver;
+GRANT SELECT, INSERT, UPDATE ON ARCHIVE_HIGH_WATER TO pharmacy_archiver;
+GRANT pharmacy_archiver TO CURRENT_USER;